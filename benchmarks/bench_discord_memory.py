@@ -0,0 +1,158 @@
+"""
+Compares the Discord client's profiles (see DISCORD_PROFILE in gvars.py):
+memory used and time to get ready, in servers full of members served by
+the load test's fake Discord. Run from the repository's root folder:
+
+    python -m benchmarks.bench_discord_memory [--guilds 20] [--members 5000] [--save results.json]
+
+Each profile runs in its own process, so they don't share any memory.
+"""
+import argparse, asyncio, gc, json, os, platform, resource, sys
+from aiohttp import web
+from time import perf_counter
+from typing import Any
+from loadtest.fake_discord import FakeDiscord
+from .bench_markdown import _get_commit
+
+PROFILES: tuple[str, ...] = ("full", "lean")
+
+Stats = dict[str, float]
+
+
+def _rss_mb() -> float:
+    """
+    The process' resident memory, in MB.
+    """
+
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # Not Linux: the peak instead, in KB (bytes on macOS)
+        peak: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+async def _measure(profile: str, url: str) -> Stats:
+    """
+    Connect a client with the profile's options and measure it once ready.
+    """
+
+    import discord, yarl
+    from src.commons.methods.discord.client_profile import get_client_options
+
+    # Like the bot does, see discord_bot.py
+    discord.http.Route.BASE = f"{url}/api/v10"
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(
+        f"{url.replace("http", "ws", 1)}/gateway"
+    )
+
+    client: discord.Client = discord.Client(**get_client_options(profile))
+    gc.collect()
+    before: float = _rss_mb()
+    start: float = perf_counter()
+    await client.login("benchmark")
+    connection: asyncio.Task = asyncio.create_task(client.connect())
+
+    try:
+        await asyncio.wait_for(client.wait_until_ready(), timeout=600)
+        ready: float = perf_counter() - start
+
+        gc.collect()
+
+        return {
+            "ready_seconds": ready,
+            "rss_mb": _rss_mb(),
+            "client_mb": _rss_mb() - before,
+            "members_cached": sum(len(guild.members) for guild in client.guilds),
+            "users_cached": len(client.users)
+        }
+    finally:
+        await client.close()
+        await asyncio.gather(connection, return_exceptions=True)
+
+
+async def _run_profile(profile: str, url: str) -> Stats:
+    process: asyncio.subprocess.Process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.bench_discord_memory",
+        "--child", profile, url,
+        stdout=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+
+    if process.returncode:
+        raise RuntimeError(f"The {profile} profile's process failed ({process.returncode})")
+
+    return json.loads(stdout.decode().splitlines()[-1])
+
+
+async def run(guilds: int, members: int) -> dict[str, Stats]:
+    fake: FakeDiscord = FakeDiscord(
+        "",
+        lambda *_: None,
+        guilds=guilds,
+        members=members
+    )
+    runner: web.AppRunner = web.AppRunner(fake.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+
+    fake.base_url = url = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    try:
+        return {profile: await _run_profile(profile, url) for profile in PROFILES}
+    finally:
+        await fake.close()
+        await runner.cleanup()
+
+
+def report(results: dict[str, Stats]) -> None:
+    print(
+        f"{"profile":<10}{"ready s":>10}{"RSS MB":>10}{"client MB":>11}"
+        f"{"members":>10}{"users":>10}"
+    )
+
+    for profile, stats in results.items():
+        print(
+            f"{profile:<10}{stats["ready_seconds"]:>10.2f}{stats["rss_mb"]:>10.1f}"
+            f"{stats["client_mb"]:>11.1f}{stats["members_cached"]:>10.0f}"
+            f"{stats["users_cached"]:>10.0f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the Discord client's profiles' memory and startup time."
+    )
+    parser.add_argument("--guilds", type=int, default=20, help="servers the bot is in")
+    parser.add_argument("--members", type=int, default=5000, help="members of each server")
+    parser.add_argument("--save", help="save the results to this JSON file")
+    # Internal: measure a profile against the given fake Discord, printing the results
+    parser.add_argument("--child", nargs=2, metavar=("PROFILE", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(_measure(*args.child))))
+        return
+
+    results: dict[str, Stats] = asyncio.run(run(args.guilds, args.members))
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(
+                {
+                    "commit": _get_commit(),
+                    "python": platform.python_version(),
+                    "guilds": args.guilds,
+                    "members": args.members,
+                    "results": results
+                },
+                file,
+                indent=4
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Benchmarks both markdown conversion directions, and their splitting,
+on a fixed corpus. Run from the repository's root folder:
+
+    python -m benchmarks.bench_markdown [--save results.json] [--compare old.json]
+
+Results saved on a commit can be compared with any other commit's.
+"""
+import argparse, gc, json, platform, subprocess
+from statistics import median, quantiles
+from textwrap import wrap
+from time import perf_counter_ns
+from typing import Any, Callable, Optional
+from limits import DISCORD_MESSAGE_LENGTH_LIMIT
+from src.commons.methods import parse_discord_entities, parse_telegram_entities
+from .corpus import get_corpus, to_telegram
+
+# Put before every Discord message, like the bot does
+SUFFIX: str = "Benchmark User\n"
+
+Stats = dict[str, float]
+
+
+def _measure(
+    function: Callable[[Any], Any],
+    messages: list[Any],
+    repeat: int
+) -> Stats:
+    """
+    Run the function on every message, repeat times.
+    Returns latency percentiles (in microseconds) and throughput.
+    """
+
+    latencies: list[int] = []
+    passes: list[int] = []
+
+    # Warm up caches and lazy imports
+    for message in messages:
+        function(message)
+
+    gc.disable()
+
+    try:
+        for _ in range(repeat):
+            pass_start: int = perf_counter_ns()
+
+            for message in messages:
+                start: int = perf_counter_ns()
+                function(message)
+                latencies.append(perf_counter_ns() - start)
+
+            passes.append(perf_counter_ns() - pass_start)
+    finally:
+        gc.enable()
+
+    percentiles: list[float] = quantiles(latencies, n=100, method="inclusive")
+
+    return {
+        "p50_us": percentiles[49] / 1000,
+        "p90_us": percentiles[89] / 1000,
+        "p99_us": percentiles[98] / 1000,
+        "max_us": max(latencies) / 1000,
+        "messages_per_second": len(messages) / (median(passes) / 1e9)
+    }
+
+
+def _get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    size: int,
+    repeat: int,
+    only: Optional[str]
+) -> dict[str, dict[str, Stats]]:
+    discord_corpus = get_corpus(size=size)
+    telegram_corpus = to_telegram(discord_corpus)
+    # What the Telegram to Discord splitter gets
+    discord_markdown: dict[str, list[str]] = {
+        category: [
+            parse_telegram_entities.parse_markdown(text, entities)
+            for text, entities in messages
+        ]
+        for category, messages in telegram_corpus.items()
+    }
+
+    benchmarks: dict[str, tuple[Callable[[Any], Any], dict[str, list[Any]]]] = {
+        "discord_to_telegram.parse": (
+            lambda message: parse_discord_entities.parse_markdown(0, message),
+            discord_corpus
+        ),
+        # Parsing included: it's done once for all the chunks
+        "discord_to_telegram.wrap": (
+            lambda message: parse_discord_entities.get_entities_wrapped(
+                SUFFIX,
+                message
+            ),
+            discord_corpus
+        ),
+        "telegram_to_discord.parse": (
+            lambda message: parse_telegram_entities.parse_markdown(*message),
+            telegram_corpus
+        ),
+        "telegram_to_discord.wrap": (
+            lambda message: wrap(
+                message,
+                DISCORD_MESSAGE_LENGTH_LIMIT,
+                break_long_words=False,
+                replace_whitespace=False
+            ),
+            discord_markdown
+        )
+    }
+
+    results: dict[str, dict[str, Stats]] = {}
+
+    for name, (function, corpus) in benchmarks.items():
+        if only and only not in name:
+            continue
+
+        results[name] = {
+            category: _measure(function, messages, repeat)
+            for category, messages in corpus.items()
+        }
+
+    return results
+
+
+def report(
+    results: dict[str, dict[str, Stats]],
+    baseline: Optional[dict[str, dict[str, Stats]]] = None
+) -> None:
+    print(
+        f"{"benchmark":<28}{"category":<12}"
+        f"{"p50 µs":>10}{"p90 µs":>10}{"p99 µs":>10}{"msg/s":>11}"
+        + (f"{"p50 vs base":>13}" if baseline else "")
+    )
+
+    for name, categories in results.items():
+        for category, stats in categories.items():
+            line: str = (
+                f"{name:<28}{category:<12}"
+                f"{stats["p50_us"]:>10.1f}{stats["p90_us"]:>10.1f}"
+                f"{stats["p99_us"]:>10.1f}{stats["messages_per_second"]:>11.0f}"
+            )
+
+            if baseline and (old := baseline.get(name, {}).get(category)):
+                line += f"{stats["p50_us"] / old["p50_us"]:>12.2f}x"
+
+            print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the markdown conversions on a fixed corpus."
+    )
+    parser.add_argument("--size", type=int, default=40, help="messages per category")
+    parser.add_argument("--repeat", type=int, default=5, help="passes over the corpus")
+    parser.add_argument("--only", help="only run benchmarks containing this")
+    parser.add_argument("--save", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved before")
+    args = parser.parse_args()
+
+    baseline: Optional[dict[str, dict[str, Stats]]] = None
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+
+    results: dict[str, dict[str, Stats]] = run(args.size, args.repeat, args.only)
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(
+                {
+                    "commit": _get_commit(),
+                    "python": platform.python_version(),
+                    "size": args.size,
+                    "repeat": args.repeat,
+                    "results": results
+                },
+                file,
+                indent=4
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Checks the Discord to Telegram conversion against a golden corpus:
+messages (some after an author's name, like the bot sends them) and
+the text, entities and link preview the converter gave for them before
+it was rewritten for speed. Run from the repository's root folder:
+
+    python -m benchmarks.check_markdown
+
+Exits with an error if any message converts differently. The corpus
+only has messages the parser doesn't fail on, in the BMP (outside of
+it, the old converter got the entities' UTF-16 offsets wrong).
+"""
+import argparse, json, sys
+from pathlib import Path
+from typing import Any
+from src.commons.methods.parse_discord_entities import TelegramContents, parse_markdown
+
+GOLDEN: Path = Path(__file__).parent / "golden" / "discord_to_telegram.jsonl"
+
+
+def _to_json(contents: TelegramContents) -> dict[str, Any]:
+    text, entities, link_preview_options = contents
+
+    return {
+        "text": text,
+        "entities": [
+            entity.model_dump(mode="json", exclude_none=True) for entity in entities
+        ],
+        # Unset unless the message has links
+        "link_preview_disabled": link_preview_options.is_disabled
+        if isinstance(link_preview_options.is_disabled, bool)
+        else None
+    }
+
+
+def check(verbose: bool) -> int:
+    """
+    Returns how many messages convert differently.
+    """
+
+    cases: int = 0
+    failures: int = 0
+
+    with open(GOLDEN, encoding="utf-8") as file:
+        for line in file:
+            case: dict[str, Any] = json.loads(line)
+            got: dict[str, Any] = _to_json(parse_markdown(case["offset"], case["message"]))
+            cases += 1
+
+            if got == case["expected"]:
+                continue
+
+            failures += 1
+
+            if verbose or failures <= 5:
+                print(f"Message: {case["message"]!r}")
+                print(f"Expected: {case["expected"]}")
+                print(f"Got: {got}\n")
+
+    print(f"{cases - failures}/{cases} messages convert as expected.")
+
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Check the Discord to Telegram conversion against a golden corpus."
+    )
+    parser.add_argument("--verbose", action="store_true", help="print every difference")
+    args = parser.parse_args()
+
+    sys.exit(1 if check(args.verbose) else 0)
+
+
+if __name__ == "__main__":
+    main()
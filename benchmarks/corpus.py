@@ -0,0 +1,126 @@
+from random import Random
+from aiogram.types import MessageEntity
+from src.commons.methods.parse_discord_entities import parse_markdown
+
+# Discord messages, by category. Generated from a fixed seed,
+# so every run (and every commit) measures the same messages.
+Corpus = dict[str, list[str]]
+
+_WORDS: list[str] = (
+    "the a to and of is in it you that for on was with this be have are "
+    "not but at what so if my just like can do about we they get one all "
+    "bridge telegram discord message chat group channel bot webhook link"
+).split()
+_EMOJIS: list[str] = ["😀", "😂", "👍", "🎉", "❤️", "🔥", "🤔", "👀", "🙏", "✨"]
+_CJK: str = "的一是不了人我在有他这中大来上国个到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而能好都然没日于起还发成事只作当想看文无开手十用主行方又如前所本见经头面公同三已老从动两长知民样现分将外但身些与高意进"
+
+
+def _sentence(random: Random, words: int) -> str:
+    return " ".join(random.choice(_WORDS) for _ in range(words))
+
+
+def _formatted(random: Random, words: int) -> str:
+    parts: list[str] = []
+
+    for _ in range(words):
+        word: str = random.choice(_WORDS)
+
+        match random.randrange(12):
+            case 0: parts.append(f"**{word}**")
+            case 1: parts.append(f"*{word}*")
+            case 2: parts.append(f"__{word}__")
+            case 3: parts.append(f"~~{word}~~")
+            case 4: parts.append(f"||{word}||")
+            case 5: parts.append(f"`{word}`")
+            case 6: parts.append(f"[{word}](https://example.com/{word})")
+            case 7: parts.append(f"https://example.com/{word}")
+            case _: parts.append(word)
+
+    return " ".join(parts)
+
+
+def _code(random: Random) -> str:
+    lines: list[str] = [
+        f"    {random.choice(_WORDS)} = {random.choice(_WORDS)}({random.randrange(100)})"
+        for _ in range(random.randint(3, 40))
+    ]
+
+    return (
+        f"{_sentence(random, random.randint(3, 12))}\n"
+        f"```py\n" + "\n".join(lines) + "\n```\n"
+        f"{_sentence(random, random.randint(3, 12))}"
+    )
+
+
+def _unicode(random: Random) -> str:
+    parts: list[str] = []
+
+    for _ in range(random.randint(5, 80)):
+        match random.randrange(4):
+            case 0: parts.append(random.choice(_EMOJIS) * random.randint(1, 3))
+            case 1: parts.append("".join(random.sample(_CJK, random.randint(2, 8))))
+            case 2: parts.append(f"**{random.choice(_EMOJIS)}{random.choice(_WORDS)}**")
+            case _: parts.append(random.choice(_WORDS))
+
+    return " ".join(parts)
+
+
+def _max_length(random: Random) -> str:
+    # Discord allows up to 4000 characters with Nitro,
+    # which is close enough to Telegram's limit to need splitting
+    lines: list[str] = []
+    length: int = 0
+
+    while length + (len(line := _formatted(random, 20)) + 1) <= 3900:
+        lines.append(line)
+        length += len(line) + 1
+
+    return "\n".join(lines)
+
+
+def _nested(random: Random) -> str:
+    markers: list[str] = ["**", "*", "__", "~~", "||"]
+    depth: int = random.randint(3, len(markers))
+    text: str = _sentence(random, 3)
+
+    for marker in random.sample(markers, depth):
+        text = f"{marker}{_sentence(random, 2)} {text} {_sentence(random, 2)}{marker}"
+
+    quoted: str = "\n".join(
+        f"> {_formatted(random, 6)}" for _ in range(random.randint(2, 10))
+    )
+
+    return f"{text}\n{quoted}\nafter the quote"
+
+
+def get_corpus(seed: int = 0, size: int = 40) -> Corpus:
+    """
+    size messages for every category.
+    """
+
+    random: Random = Random(seed)
+
+    return {
+        "plain": [
+            _sentence(random, random.randint(2, 60)) for _ in range(size)
+        ],
+        "formatting": [
+            _formatted(random, random.randint(5, 120)) for _ in range(size)
+        ],
+        "code": [_code(random) for _ in range(size)],
+        "unicode": [_unicode(random) for _ in range(size)],
+        # Slower to parse: fewer of them are enough
+        "max_length": [_max_length(random) for _ in range(max(1, size // 8))],
+        "nested": [_nested(random) for _ in range(size)]
+    }
+
+
+def to_telegram(corpus: Corpus) -> dict[str, list[tuple[str, list[MessageEntity]]]]:
+    """
+    The same messages, as Telegram would send them (text and entities).
+    """
+
+    return {
+        category: [parse_markdown(0, message)[:2] for message in messages]
+        for category, messages in corpus.items()
+    }
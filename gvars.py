@@ -1,3 +1,78 @@
+from typing import Optional
+
 DATABASE_NAME: str = "database"
 PENDING_TIMEOUT: int = 60 * 10
-PENDING_CHECKS_INTERVAL: float = 0.5
+DATABASE_READERS: int = 4
+MESSAGE_BATCH_SIZE: int = 64
+MESSAGE_BATCH_INTERVAL: float = 0.25
+FAN_OUT_CONCURRENCY: int = 16
+SCHEDULER_MAX_RETRIES: int = 5
+# Avatars are refreshed this often: their links expire after an hour
+AVATAR_TTL: int = 60 * 45
+# Discord channels are cached this long, unless changed or deleted before.
+# Channels that can't be fetched (deleted, or forbidden) are only retried
+# after CHANNEL_NEGATIVE_TTL. Besides the linked ones, CHANNEL_CACHE_SLACK
+# more are kept (e.g. looked up by commands).
+CHANNEL_TTL: int = 60 * 60
+CHANNEL_NEGATIVE_TTL: int = 60 * 5
+CHANNEL_CACHE_SLACK: int = 128
+MESSAGE_RETENTION: int = 60 * 60 * 24 * 2
+RETENTION_BATCH_SIZE: int = 500
+RETENTION_SWEEP_INTERVAL: int = 60
+RETENTION_VACUUM_PAGES: int = 1000
+# Set to a name to keep expired message associations
+# in a compressed file instead of dropping them
+MESSAGE_ARCHIVE_NAME: Optional[str] = None
+# Set to use other servers instead of Telegram's and Discord's,
+# such as a self-hosted Bot API server or the load test's fake ones
+TELEGRAM_API_SERVER: Optional[str] = None
+DISCORD_API_BASE: Optional[str] = None
+DISCORD_GATEWAY: Optional[str] = None
+# Set to serve Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_PORT: Optional[int] = None
+METRICS_HOST: str = "127.0.0.1"
+# Set TRACE_FILE (JSON lines) and/or TRACE_OTLP_ENDPOINT
+# (e.g. "http://127.0.0.1:4318/v1/traces") to export per-message traces.
+# TRACE_SAMPLE_RATE of them are exported, plus any slower than
+# TRACE_SLOW_THRESHOLD seconds if set.
+TRACE_SAMPLE_RATE: float = 0
+TRACE_SLOW_THRESHOLD: Optional[float] = None
+TRACE_FILE: Optional[str] = None
+TRACE_OTLP_ENDPOINT: Optional[str] = None
+TRACE_EXPORT_INTERVAL: float = 5
+# Set to receive Telegram's updates on a webhook instead of long polling,
+# e.g. "https://example.com/telegram". Telegram only posts to ports
+# 443, 80, 88 and 8443, so it's usually behind a reverse proxy that
+# forwards to TELEGRAM_WEBHOOK_HOST:TELEGRAM_WEBHOOK_PORT (same path).
+TELEGRAM_WEBHOOK_URL: Optional[str] = None
+# Checked on every update. If unset, a random one is used: instances
+# sharing the webhook need the same one.
+TELEGRAM_WEBHOOK_SECRET: Optional[str] = None
+TELEGRAM_WEBHOOK_HOST: str = "0.0.0.0"
+TELEGRAM_WEBHOOK_PORT: int = 8080
+# Updates handled at once: Telegram waits to deliver more
+TELEGRAM_WEBHOOK_CONCURRENCY: int = 64
+# Set to forward messages from this many worker processes: this one
+# keeps receiving updates (and commands) and hands each linked pair's
+# to the same worker every time, so they stay in order.
+SHARD_WORKERS: int = 0
+# Seconds a process waits for another one (such as a shard worker)
+# to be done writing to the database, before giving up
+DATABASE_BUSY_TIMEOUT: float = 30
+# Run Discord's gateway with an AutoShardedBot, in DISCORD_SHARD_COUNT
+# shards (or as many as Discord recommends if None). Required past 2500 servers.
+DISCORD_AUTO_SHARDED: bool = False
+DISCORD_SHARD_COUNT: Optional[int] = None
+# "lean" only receives and caches what forwarding needs (messages,
+# channels and webhooks, no members nor presences), "full" everything
+DISCORD_PROFILE: str = "lean"
+# Messages kept in discord.py's cache, with the lean profile.
+# Forwarding doesn't need it: edits are handled from their raw events.
+DISCORD_MAX_MESSAGES: int = 100
+# Media is streamed from Telegram into Discord MEDIA_CHUNK_SIZE bytes
+# at a time, at most MEDIA_UPLOAD_CONCURRENCY files at once
+MEDIA_CHUNK_SIZE: int = 64 * 2 ** 10
+MEDIA_UPLOAD_CONCURRENCY: int = 8
+# Telegram sends albums' items one by one: they're forwarded together
+# once no more came for this many seconds
+ALBUM_WINDOW: float = 1
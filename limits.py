@@ -2,3 +2,20 @@ from typing import Final
 
 DISCORD_MESSAGE_LENGTH_LIMIT: Final[int] = 2000
 TELEGRAM_MESSAGE_LENGTH_LIMIT: Final[int] = 4096
+
+# Rate limits, as (calls, every these seconds)
+TELEGRAM_GLOBAL_RATE: Final[tuple[int, float]] = (30, 1)
+TELEGRAM_CHAT_RATE: Final[tuple[int, float]] = (1, 1)
+TELEGRAM_GROUP_RATE: Final[tuple[int, float]] = (20, 60)
+DISCORD_GLOBAL_RATE: Final[tuple[int, float]] = (50, 1)
+DISCORD_CHANNEL_RATE: Final[tuple[int, float]] = (5, 5)
+DISCORD_WEBHOOK_RATE: Final[tuple[int, float]] = (5, 2)
+
+# File sizes, in bytes: Discord's upload cap without boosts,
+# and what bots can download from Telegram's Bot API
+DISCORD_UPLOAD_LIMIT: Final[int] = 10 * 2 ** 20
+TELEGRAM_DOWNLOAD_LIMIT: Final[int] = 20 * 2 ** 20
+# Items of a Telegram album, and attachments of a Discord message
+ALBUM_ITEMS_LIMIT: Final[int] = 10
+# Seconds Telegram's file links are guaranteed to work for
+TELEGRAM_FILE_LINK_LIFETIME: Final[int] = 60 * 60
@@ -0,0 +1,497 @@
+import asyncio, json, random
+from aiohttp import WSMsgType, web
+from datetime import datetime, timezone
+from itertools import count
+from typing import Any, Callable, Optional
+
+# Called with (route, channel id, content) whenever the bridge sends or edits
+DeliveryCallback = Callable[[str, int, str], None]
+
+GUILD_ID: int = 1
+# Shards recommended on /gateway/bot, for AutoShardedBot
+RECOMMENDED_SHARDS: int = 2
+# Intents changing what's sent about the servers' members
+MEMBERS_INTENT: int = 1 << 1
+PRESENCES_INTENT: int = 1 << 8
+# Like Discord's default: larger servers are sent without their offline members
+LARGE_THRESHOLD: int = 250
+MEMBERS_CHUNK_SIZE: int = 1000
+ONLINE_RATIO: float = 0.25
+# discord.py checks webhook URLs' ids and tokens look like real ones
+WEBHOOK_TOKEN: str = "loadtest" * 8
+BOT_USER: dict[str, Any] = {
+    "id": "2",
+    "username": "bridge",
+    "discriminator": "0",
+    "global_name": "Bridge",
+    "avatar": None,
+    "bot": True
+}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _json(
+    data: Any,
+    status: int = 200,
+    headers: Optional[dict[str, str]] = None
+) -> web.Response:
+    # discord.py only decodes bodies whose content type is exactly this
+    return web.Response(
+        body=json.dumps(data).encode(),
+        status=status,
+        headers={"Content-Type": "application/json", **(headers or {})}
+    )
+
+
+class FakeDiscord:
+    """
+    Just enough of Discord's REST API and gateway for the bridge:
+    logging in, receiving messages and edits, and sending (with files),
+    editing and deleting messages through webhooks, with optional
+    latency and rate limits (429s).
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        on_delivery: DeliveryCallback,
+        latency: float = 0,
+        rate_limit_ratio: float = 0,
+        guilds: int = 0,
+        members: int = 0
+    ) -> None:
+        """
+        guilds are servers (with members each) the bot is in, besides
+        the one messages come from, to measure what caching them costs.
+        """
+
+        self.base_url: str = base_url
+        self.on_delivery: DeliveryCallback = on_delivery
+        self.latency: float = latency
+        self.rate_limit_ratio: float = rate_limit_ratio
+        self.guilds: int = guilds
+        self.members: int = members
+
+        self.snowflakes = count(10 ** 17)
+        self.sequence = count(1)
+        # Connected sockets and their (shard id, shard count), once identified
+        self.sockets: dict[web.WebSocketResponse, tuple[int, int]] = {}
+        self.intents: dict[web.WebSocketResponse, int] = {}
+        self.ready: asyncio.Event = asyncio.Event()
+        # Webhook of every channel, by channel id
+        self.webhooks: dict[int, dict[str, Any]] = {}
+        self.requests: int = 0
+        self.rate_limited: int = 0
+        self.unknown: int = 0
+        # Files received, and their bytes
+        self.uploads: int = 0
+        self.uploaded: int = 0
+
+        self.app: web.Application = web.Application()
+        self.app.router.add_get("/gateway", self.gateway)
+        self.app.router.add_route("*", "/api/v10/{path:.*}", self.handle)
+
+    # Gateway
+
+    async def _send(self, socket: web.WebSocketResponse, event: str, data: dict[str, Any]) -> None:
+        await socket.send_str(json.dumps({
+            "op": 0,
+            "t": event,
+            "s": next(self.sequence),
+            "d": data
+        }))
+
+    async def dispatch(self, event: str, data: dict[str, Any]) -> None:
+        """
+        Send a guild event to the shard it belongs to, like Discord does.
+        """
+
+        for socket, (shard_id, shard_count) in list(self.sockets.items()):
+            if (GUILD_ID >> 22) % shard_count == shard_id:
+                await self._send(socket, event, data)
+
+    def user_message(
+        self,
+        channel_id: int,
+        message_id: int,
+        author_id: int,
+        content: str,
+        edited: bool = False
+    ) -> dict[str, Any]:
+        return {
+            "id": str(message_id),
+            "channel_id": str(channel_id),
+            "guild_id": str(GUILD_ID),
+            "author": {
+                "id": str(author_id),
+                "username": f"user{author_id}",
+                "discriminator": "0",
+                "global_name": f"User {author_id}",
+                "avatar": None
+            },
+            "content": content,
+            "timestamp": _now(),
+            "edited_timestamp": _now() if edited else None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0
+        }
+
+    def _member(self, user_id: int) -> dict[str, Any]:
+        return {
+            "user": {
+                "id": str(user_id),
+                "username": f"user{user_id}",
+                "discriminator": "0",
+                "global_name": f"User {user_id}",
+                "avatar": None
+            },
+            "roles": [],
+            "joined_at": _now(),
+            "deaf": False,
+            "mute": False,
+            "flags": 0
+        }
+
+    def _presence(self, user_id: int) -> dict[str, Any]:
+        return {
+            "user": {"id": str(user_id)},
+            "status": "online",
+            "activities": [],
+            "client_status": {"desktop": "online"}
+        }
+
+    def _guild_members(self, guild_id: int) -> range:
+        # Every server has its own users
+        first: int = 1_000_000 + (guild_id - GUILD_ID - 1) * self.members
+
+        return range(first, first + self.members)
+
+    def _guild(self, guild_id: int, intents: int) -> dict[str, Any]:
+        user_ids: range = self._guild_members(guild_id)
+        online: range = user_ids[:int(len(user_ids) * ONLINE_RATIO)]
+        large: bool = len(user_ids) > LARGE_THRESHOLD
+        presences: bool = bool(intents & PRESENCES_INTENT)
+
+        return {
+            "id": str(guild_id),
+            "name": f"Server {guild_id}",
+            "icon": None,
+            "owner_id": "1",
+            "afk_timeout": 300,
+            "verification_level": 0,
+            "default_message_notifications": 0,
+            "explicit_content_filter": 0,
+            "mfa_level": 0,
+            "nsfw_level": 0,
+            "premium_tier": 0,
+            "preferred_locale": "en-US",
+            "features": [],
+            "roles": [{
+                "id": str(guild_id),
+                "name": "@everyone",
+                "permissions": "0",
+                "position": 0,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+                "flags": 0
+            }],
+            "emojis": [],
+            "stickers": [],
+            "channels": [
+                {**self._channel(guild_id * 100 + i), "guild_id": str(guild_id)}
+                for i in range(5)
+            ],
+            "threads": [],
+            "voice_states": [],
+            "member_count": len(user_ids) + 1,
+            "large": large,
+            # Without presences, only the bot is sent
+            "members": [{**self._member(int(BOT_USER["id"])), "user": BOT_USER}] + ([
+                self._member(user_id) for user_id in (online if large else user_ids)
+            ] if presences else []),
+            "presences": [
+                self._presence(user_id) for user_id in online
+            ] if presences else []
+        }
+
+    async def _send_members(
+        self,
+        socket: web.WebSocketResponse,
+        request: dict[str, Any]
+    ) -> None:
+        """
+        Answer a request for a server's members, in chunks.
+        """
+
+        if not self.intents.get(socket, 0) & MEMBERS_INTENT:
+            return
+
+        guild_id: int = int(request["guild_id"])
+        user_ids: range = self._guild_members(guild_id)
+        chunks: int = max(1, -(-len(user_ids) // MEMBERS_CHUNK_SIZE))
+
+        for index in range(chunks):
+            chunk: range = user_ids[index * MEMBERS_CHUNK_SIZE:(index + 1) * MEMBERS_CHUNK_SIZE]
+
+            await self._send(socket, "GUILD_MEMBERS_CHUNK", {
+                "guild_id": str(guild_id),
+                "members": [self._member(user_id) for user_id in chunk],
+                "presences": [
+                    self._presence(user_id) for user_id in chunk
+                    if user_id < user_ids[0] + len(user_ids) * ONLINE_RATIO
+                ] if request.get("presences") else [],
+                "chunk_index": index,
+                "chunk_count": chunks,
+                "nonce": request.get("nonce")
+            })
+
+    async def gateway(self, request: web.Request) -> web.WebSocketResponse:
+        socket: web.WebSocketResponse = web.WebSocketResponse()
+        await socket.prepare(request)
+        await socket.send_json({"op": 10, "d": {"heartbeat_interval": 41250}})
+
+        try:
+            async for message in socket:
+                if message.type is not WSMsgType.TEXT:
+                    continue
+
+                payload: dict[str, Any] = json.loads(message.data)
+
+                match payload["op"]:
+                    # Heartbeat
+                    case 1:
+                        await socket.send_json({"op": 11})
+
+                    # Identify: ready, then the shard's servers
+                    case 2:
+                        shard: list[int] = payload["d"].get("shard") or [0, 1]
+                        self.sockets[socket] = (shard[0], shard[1])
+                        self.intents[socket] = payload["d"].get("intents", 0)
+                        guild_ids: list[int] = [
+                            guild_id
+                            for guild_id in range(GUILD_ID + 1, GUILD_ID + 1 + self.guilds)
+                            if (guild_id >> 22) % shard[1] == shard[0]
+                        ]
+
+                        await self._send(socket, "READY", {
+                            "v": 10,
+                            "user": BOT_USER,
+                            "guilds": [
+                                {"id": str(guild_id), "unavailable": True}
+                                for guild_id in guild_ids
+                            ],
+                            "session_id": "loadtest",
+                            "resume_gateway_url": f"{self.base_url}/gateway",
+                            "application": {"id": BOT_USER["id"], "flags": 0},
+                            "shard": shard
+                        })
+                        self.ready.set()
+
+                        for guild_id in guild_ids:
+                            await self._send(
+                                socket,
+                                "GUILD_CREATE",
+                                self._guild(guild_id, self.intents[socket])
+                            )
+
+                    # Request guild members
+                    case 8:
+                        await self._send_members(socket, payload["d"])
+        finally:
+            self.sockets.pop(socket, None)
+            self.intents.pop(socket, None)
+
+        return socket
+
+    async def close(self) -> None:
+        for socket in list(self.sockets):
+            await socket.close()
+
+    # REST
+
+    def _channel(self, channel_id: int) -> dict[str, Any]:
+        return {
+            "id": str(channel_id),
+            "type": 0,
+            "guild_id": str(GUILD_ID),
+            "name": f"channel-{channel_id}",
+            "position": 0,
+            "permission_overwrites": [],
+            "nsfw": False,
+            "parent_id": None
+        }
+
+    def _webhook(self, channel_id: int) -> dict[str, Any]:
+        if not (webhook := self.webhooks.get(channel_id)):
+            webhook = self.webhooks[channel_id] = {
+                "id": str(next(self.snowflakes)),
+                "type": 1,
+                "channel_id": str(channel_id),
+                "guild_id": str(GUILD_ID),
+                "name": "telegram",
+                "avatar": None,
+                "token": WEBHOOK_TOKEN,
+                "user": BOT_USER
+            }
+
+        return webhook
+
+    def _webhook_channel(self, webhook_id: str) -> int:
+        return next(
+            channel_id
+            for channel_id, webhook in self.webhooks.items()
+            if webhook["id"] == webhook_id
+        )
+
+    def _message(
+        self,
+        channel_id: int,
+        content: str,
+        message_id: Optional[int] = None,
+        webhook_id: Optional[str] = None
+    ) -> dict[str, Any]:
+        message: dict[str, Any] = {
+            "id": str(message_id or next(self.snowflakes)),
+            "channel_id": str(channel_id),
+            "author": BOT_USER,
+            "content": content,
+            "timestamp": _now(),
+            "edited_timestamp": None if message_id is None else _now(),
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [],
+            "attachments": [],
+            "embeds": [],
+            "pinned": False,
+            "type": 0
+        }
+
+        if webhook_id:
+            message["webhook_id"] = webhook_id
+
+        return message
+
+    async def _read_multipart(self, request: web.Request) -> dict[str, Any]:
+        """
+        The JSON payload of a message with files, reading
+        (and dropping) the files a chunk at a time.
+        """
+
+        body: dict[str, Any] = {}
+
+        async for part in await request.multipart():
+            if part.name == "payload_json":
+                body = await part.json() # type: ignore
+                continue
+
+            while chunk := await part.read_chunk(): # type: ignore
+                self.uploaded += len(chunk)
+
+            self.uploads += 1
+
+        return body
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        path: list[str] = request.match_info["path"].split("/")
+        body: dict[str, Any] = {}
+
+        if request.can_read_body and request.content_type == "application/json":
+            body = await request.json()
+        elif request.can_read_body and request.content_type == "multipart/form-data":
+            body = await self._read_multipart(request)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if path[0] in ("channels", "webhooks") \
+        and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+
+            return _json(
+                {"message": "You are being rate limited.", "retry_after": 0.1, "global": False},
+                status=429,
+                headers={"Retry-After": "0.1", "X-RateLimit-Scope": "user"}
+            )
+
+        match request.method, path:
+            case "GET", ["gateway", "bot"]:
+                return _json({
+                    "url": f"{self.base_url.replace("http", "ws", 1)}/gateway",
+                    "shards": RECOMMENDED_SHARDS,
+                    "session_start_limit": {
+                        "total": 1000,
+                        "remaining": 1000,
+                        "reset_after": 0,
+                        "max_concurrency": 1
+                    }
+                })
+
+            case "GET", ["users", "@me"]:
+                return _json(BOT_USER)
+
+            case "GET", ["oauth2", "applications", "@me"]:
+                return _json({
+                    "id": BOT_USER["id"],
+                    "name": "Bridge",
+                    "description": "",
+                    "icon": None,
+                    "bot_public": True,
+                    "bot_require_code_grant": False,
+                    "owner": BOT_USER,
+                    "team": None,
+                    "verify_key": "",
+                    "flags": 0
+                })
+
+            case "GET", ["channels", channel_id]:
+                return _json(self._channel(int(channel_id)))
+
+            case "GET", ["channels", channel_id, "webhooks"]:
+                webhook: Optional[dict[str, Any]] = self.webhooks.get(int(channel_id))
+                return _json([webhook] if webhook else [])
+
+            case "POST", ["channels", channel_id, "webhooks"]:
+                return _json(self._webhook(int(channel_id)))
+
+            case "POST", ["channels", channel_id, "messages", "bulk-delete"]:
+                return web.Response(status=204)
+
+            case "POST", ["webhooks", webhook_id, _]:
+                channel_id: int = self._webhook_channel(webhook_id)
+                self.on_delivery("webhook_send", channel_id, body["content"])
+
+                return _json(
+                    self._message(channel_id, body["content"], webhook_id=webhook_id)
+                )
+
+            case "PATCH", ["webhooks", webhook_id, _, "messages", message_id]:
+                channel_id: int = self._webhook_channel(webhook_id)
+                self.on_delivery("webhook_edit", channel_id, body["content"])
+
+                return _json(self._message(
+                    channel_id,
+                    body["content"],
+                    int(message_id),
+                    webhook_id
+                ))
+
+            case "DELETE", ["webhooks", _, _, "messages", _] \
+            | ["channels", _, "messages", _]:
+                return web.Response(status=204)
+
+        self.unknown += 1
+
+        return _json({"message": "404: Not Found", "code": 0}, status=404)
@@ -0,0 +1,218 @@
+import aiohttp, asyncio, json, random
+from aiohttp import web
+from time import time
+from typing import Any, Callable, Optional
+
+# Called with (method, chat id, text) whenever the bridge sends or edits
+DeliveryCallback = Callable[[str, int, str], None]
+
+# Files are streamed as this many zeros at a time
+FILE_CHUNK: bytes = bytes(64 * 2 ** 10)
+
+BOT_USER: dict[str, Any] = {
+    "id": 1,
+    "is_bot": True,
+    "first_name": "Bridge",
+    "username": "bridge_bot"
+}
+
+
+class FakeTelegram:
+    """
+    Just enough of the Bot API for the bridge: long polling or
+    webhooks, sending, editing and deleting messages, downloading
+    files, with optional latency and rate limits (retry-afters).
+    Files' ids are their size, then anything: "1048576-photo".
+    """
+
+    def __init__(
+        self,
+        on_delivery: DeliveryCallback,
+        latency: float = 0,
+        rate_limit_ratio: float = 0
+    ) -> None:
+        self.on_delivery: DeliveryCallback = on_delivery
+        self.latency: float = latency
+        self.rate_limit_ratio: float = rate_limit_ratio
+
+        self.updates: list[dict[str, Any]] = []
+        self.new_updates: asyncio.Event = asyncio.Event()
+        # Set once the bridge polls or sets a webhook
+        self.listening: asyncio.Event = asyncio.Event()
+        # Where to post updates to and with which secret, if set
+        self.webhook: Optional[tuple[str, str]] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.deliveries: set[asyncio.Task] = set()
+        self.webhook_errors: int = 0
+        self.message_ids: dict[int, int] = {}
+        self.requests: int = 0
+        self.rate_limited: int = 0
+        self.unknown: int = 0
+
+        self.app: web.Application = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self.app.router.add_get("/file/bot{token}/{path:.*}", self.download)
+
+    def push_update(self, update: dict[str, Any]) -> None:
+        """
+        Queue an update (without its id) for the bridge to poll,
+        or post it to its webhook if set.
+        """
+
+        self.updates.append(update := {"update_id": len(self.updates) + 1, **update})
+
+        if not self.webhook:
+            self.new_updates.set()
+            return
+
+        delivery: asyncio.Task = asyncio.create_task(self._post_update(update))
+        self.deliveries.add(delivery)
+        delivery.add_done_callback(self.deliveries.discard)
+
+    async def _post_update(self, update: dict[str, Any]) -> None:
+        url, secret_token = self.webhook # type: ignore
+
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+
+        try:
+            async with self.session.post(
+                url,
+                json=update,
+                headers={"X-Telegram-Bot-Api-Secret-Token": secret_token}
+            ) as response:
+                if response.status != 200:
+                    self.webhook_errors += 1
+        except aiohttp.ClientError:
+            self.webhook_errors += 1
+
+    async def close(self) -> None:
+        if self.session:
+            await self.session.close()
+
+    async def _get_updates(self, parameters: dict[str, Any]) -> list[dict[str, Any]]:
+        self.listening.set()
+        offset: int = int(parameters.get("offset") or 1)
+
+        if offset > len(self.updates):
+            self.new_updates.clear()
+
+            try:
+                await asyncio.wait_for(
+                    self.new_updates.wait(),
+                    float(parameters.get("timeout") or 0)
+                )
+            except TimeoutError:
+                pass
+
+        return self.updates[offset - 1:offset + 99]
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict[str, Any]:
+        if message_id is None:
+            message_id = self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+
+        return {
+            "message_id": message_id,
+            "date": int(time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": BOT_USER,
+            "text": text
+        }
+
+    async def download(self, request: web.Request) -> web.StreamResponse:
+        """
+        Stream a file of its size, without ever holding it.
+        """
+
+        size: int = int(request.match_info["path"].split("/")[-1].split("-")[0])
+        response: web.StreamResponse = web.StreamResponse()
+        response.content_length = size
+        await response.prepare(request)
+
+        for start in range(0, size, len(FILE_CHUNK)):
+            await response.write(FILE_CHUNK[:size - start])
+
+        await response.write_eof()
+
+        return response
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        method: str = request.match_info["method"]
+        parameters: dict[str, Any] = dict(await request.post())
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method not in ("getUpdates", "getMe", "deleteWebhook", "setWebhook") \
+        and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            })
+
+        result: Any
+
+        match method:
+            case "getMe":
+                result = BOT_USER
+
+            case "deleteWebhook" | "deleteMessages" | "deleteMessage":
+                result = True
+
+            case "getUpdates":
+                result = await self._get_updates(parameters)
+
+            case "setWebhook":
+                self.webhook = (parameters["url"], parameters.get("secret_token", ""))
+                self.listening.set()
+                result = True
+
+            case "sendMessage":
+                chat_id: int = int(parameters["chat_id"])
+                result = self._message(chat_id, parameters["text"])
+                self.on_delivery(method, chat_id, parameters["text"])
+
+            case "editMessageText":
+                chat_id: int = int(parameters["chat_id"])
+                result = self._message(
+                    chat_id,
+                    parameters["text"],
+                    int(parameters["message_id"])
+                )
+                self.on_delivery(method, chat_id, parameters["text"])
+
+            case "getChat":
+                chat_id: int = int(parameters["chat_id"])
+                result = {
+                    "id": chat_id,
+                    "type": "supergroup",
+                    "title": f"Chat {chat_id}",
+                    "accent_color_id": 0,
+                    "max_reaction_count": 0
+                }
+
+            case "getFile":
+                result = {
+                    "file_id": parameters["file_id"],
+                    "file_unique_id": parameters["file_id"],
+                    "file_size": int(parameters["file_id"].split("-")[0]),
+                    "file_path": f"documents/{parameters["file_id"]}"
+                }
+
+            case "getUserProfilePhotos":
+                result = {"total_count": 0, "photos": []}
+
+            case _:
+                self.unknown += 1
+
+                return web.json_response(
+                    {"ok": False, "error_code": 404, "description": "Not Found"},
+                    status=404
+                )
+
+        return web.json_response({"ok": True, "result": result}, dumps=json.dumps)
@@ -0,0 +1,460 @@
+"""
+End-to-end load test: the whole bridge, talking to local fake
+Telegram and Discord servers, under synthetic traffic.
+Run from the repository's root folder:
+
+    python -m loadtest.run --chats 50 --rate 20 --duration 30
+
+No tokens nor network are needed.
+"""
+import argparse, asyncio, json, logging, re, resource, socket, sys, tempfile
+from aiohttp import web
+from dataclasses import dataclass, field
+from itertools import count
+from pathlib import Path
+from random import Random
+from statistics import quantiles
+from time import monotonic, time
+from types import ModuleType
+from typing import Any, Optional
+from .fake_discord import FakeDiscord
+from .fake_telegram import FakeTelegram
+
+# Everything the bridge forwards carries one of these,
+# ending with "e" if it's from an edit
+MARKER: re.Pattern[str] = re.compile(r"lt-(\d+)(e?)\b")
+
+
+@dataclass
+class Flow:
+    """
+    Latencies of one kind of traffic, such as Discord to Telegram edits.
+    """
+
+    sent: int = 0
+    expected: int = 0
+    latencies: list[float] = field(default_factory=list)
+
+    def report(self, name: str) -> dict[str, Any]:
+        delivered: int = len(self.latencies)
+        percentiles: list[float] = quantiles(self.latencies, n=100, method="inclusive") \
+            if delivered > 1 else [self.latencies[0] if delivered else 0] * 99
+
+        print(
+            f"{name:<30}{self.sent:>7}{delivered:>10}{self.expected - delivered:>7}"
+            f"{percentiles[49] * 1000:>10.1f}{percentiles[89] * 1000:>10.1f}"
+            f"{percentiles[98] * 1000:>10.1f}"
+        )
+
+        return {
+            "sent": self.sent,
+            "delivered": delivered,
+            "lost": self.expected - delivered,
+            "p50_ms": percentiles[49] * 1000,
+            "p90_ms": percentiles[89] * 1000,
+            "p99_ms": percentiles[98] * 1000
+        }
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts the errors the bots log (such as exceptions in handlers).
+    """
+
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self.errors: int = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.errors += 1
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _configure(
+    telegram_url: str,
+    discord_url: str,
+    database_folder: Path,
+    traces: Optional[str],
+    telegram_webhook_port: Optional[int],
+    workers: int,
+    discord_shards: Optional[int]
+) -> None:
+    """
+    Point the bridge to the fake servers.
+    Must run before any of the bridge's modules is imported.
+    """
+
+    import gvars
+
+    if traces:
+        gvars.TRACE_FILE = traces
+        gvars.TRACE_SAMPLE_RATE = 1
+
+    if telegram_webhook_port:
+        gvars.TELEGRAM_WEBHOOK_URL = f"http://127.0.0.1:{telegram_webhook_port}/telegram"
+        gvars.TELEGRAM_WEBHOOK_HOST = "127.0.0.1"
+        gvars.TELEGRAM_WEBHOOK_PORT = telegram_webhook_port
+
+    if discord_shards is not None:
+        gvars.DISCORD_AUTO_SHARDED = True
+        gvars.DISCORD_SHARD_COUNT = discord_shards or None
+
+    gvars.SHARD_WORKERS = workers
+    gvars.TELEGRAM_API_SERVER = telegram_url
+    gvars.DISCORD_API_BASE = f"{discord_url}/api/v10"
+    gvars.DISCORD_GATEWAY = f"{discord_url.replace("http", "ws", 1)}/gateway"
+    # An absolute path replaces the database's folder
+    gvars.DATABASE_NAME = str(database_folder / "loadtest")
+
+    # The fake servers accept any token, but tokens.py might not exist
+    if "tokens" not in sys.modules:
+        tokens = ModuleType("tokens")
+        tokens.TELEGRAM_TOKEN = "123456:loadtest" # type: ignore
+        tokens.DISCORD_TOKEN = "loadtest" # type: ignore
+        sys.modules["tokens"] = tokens
+
+
+async def _serve(app: web.Application, port: int) -> web.AppRunner:
+    runner: web.AppRunner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    return runner
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    random: Random = Random(args.seed)
+    telegram_port: int = _free_port()
+    discord_port: int = _free_port()
+    database_folder: tempfile.TemporaryDirectory = tempfile.TemporaryDirectory()
+
+    _configure(
+        f"http://127.0.0.1:{telegram_port}",
+        f"http://127.0.0.1:{discord_port}",
+        Path(database_folder.name),
+        args.traces,
+        _free_port() if args.telegram_webhook else None,
+        args.workers,
+        args.discord_shards
+    )
+
+    from src import shards
+    from src.commons import metrics, tracing
+    from src.commons.database import database
+    from src.discord import discord_bot
+    from src.telegram import telegram_bot
+
+    flows: dict[str, Flow] = {
+        name: Flow() for name in (
+            "discord_to_telegram.forward",
+            "discord_to_telegram.edit",
+            "telegram_to_discord.forward",
+            "telegram_to_discord.edit"
+        )
+    }
+    # When each marker was injected, and into which flow
+    injected: dict[str, tuple[float, Flow]] = {}
+    # Messages that can be edited: (marker, platform, chat, message id).
+    # Only once fully forwarded, or the bridge would have nothing to edit.
+    editable: list[tuple[str, str, int, int]] = []
+    # Deliveries left before a message is fully forwarded
+    forwarding: dict[str, tuple[int, tuple[str, str, int, int]]] = {}
+    # Telegram messages sent with a file, their text being its caption
+    with_media: set[str] = set()
+    last_delivery: float = 0
+
+    def on_delivery(_: str, __: int, text: str) -> None:
+        nonlocal last_delivery
+
+        if not (match := MARKER.search(text)) or not (sent := injected.get(match[0])):
+            return
+
+        last_delivery = monotonic()
+        sent[1].latencies.append(last_delivery - sent[0])
+
+        if match[0] in forwarding:
+            left, message = forwarding.pop(match[0])
+
+            if left > 1:
+                forwarding[match[0]] = (left - 1, message)
+            else:
+                editable.append(message)
+
+    fake_telegram: FakeTelegram = FakeTelegram(
+        on_delivery,
+        args.api_latency / 1000,
+        args.rate_limit_ratio
+    )
+    fake_discord: FakeDiscord = FakeDiscord(
+        f"http://127.0.0.1:{discord_port}",
+        on_delivery,
+        args.api_latency / 1000,
+        args.rate_limit_ratio
+    )
+    runners: list[web.AppRunner] = [
+        await _serve(fake_telegram.app, telegram_port),
+        await _serve(fake_discord.app, discord_port)
+    ]
+
+    errors: ErrorCounter = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    database.init()
+
+    # Link every Discord channel to links Telegram chats
+    chats: list[tuple[int, list[int]]] = [
+        (10_000 + i, [-(20_000 + i * args.links + j) for j in range(args.links)])
+        for i in range(args.chats)
+    ]
+
+    for discord_chat_id, telegram_chat_ids in chats:
+        for telegram_chat_id in telegram_chat_ids:
+            await database.associate_chats(
+                uuid=f"{discord_chat_id}{telegram_chat_id}",
+                discord_chat_id=discord_chat_id,
+                telegram_chat_id=telegram_chat_id,
+                owner_discord_id=1,
+                owner_telegram_id=1
+            )
+
+    shards.start()
+    discord_client: asyncio.Task = asyncio.create_task(discord_bot.start())
+    telegram_client: asyncio.Task = asyncio.create_task(telegram_bot.start())
+    exporter: asyncio.Task = asyncio.create_task(tracing.export_traces())
+
+    await asyncio.wait_for(
+        asyncio.gather(fake_discord.ready.wait(), fake_telegram.listening.wait()),
+        timeout=30
+    )
+    await discord_bot.bot.wait_until_ready()
+    await shards.wait_until_ready()
+
+    markers = count(1)
+    discord_message_ids = count(5_000_000)
+    telegram_message_ids: dict[int, int] = {}
+
+    def inject(edit: bool) -> None:
+        if edit and editable:
+            marker, platform, chat_id, message_id = random.choice(editable)
+            marker = f"{marker}e"
+        else:
+            platform = "discord" if random.random() < args.discord_ratio else "telegram"
+            marker = f"lt-{next(markers)}"
+            discord_chat_id, telegram_chat_ids = random.choice(chats)
+
+            if platform == "discord":
+                chat_id, message_id = discord_chat_id, next(discord_message_ids)
+            else:
+                chat_id = random.choice(telegram_chat_ids)
+                message_id = telegram_message_ids[chat_id] = \
+                    telegram_message_ids.get(chat_id, 0) + 1
+
+            forwarding[marker] = (
+                args.links if platform == "discord" else 1,
+                (marker, platform, chat_id, message_id)
+            )
+            edit = False
+
+            if platform == "telegram" and random.random() < args.media_ratio:
+                with_media.add(marker)
+
+        text: str = f"{marker} {" ".join(random.choices(WORDS, k=random.randint(3, 40)))}"
+        flow: Flow = flows[
+            f"{platform}_to_{"telegram" if platform == "discord" else "discord"}"
+            f".{"edit" if edit else "forward"}"
+        ]
+        flow.sent += 1
+        injected[marker] = (monotonic(), flow)
+
+        if platform == "discord":
+            flow.expected += args.links
+            asyncio.create_task(fake_discord.dispatch(
+                "MESSAGE_UPDATE" if edit else "MESSAGE_CREATE",
+                fake_discord.user_message(chat_id, message_id, 100, text, edit)
+            ))
+        else:
+            flow.expected += 1
+            message: dict[str, Any] = {
+                "message_id": message_id,
+                "date": int(time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+                "from": {"id": 200, "is_bot": False, "first_name": "User"},
+                "text": text
+            }
+
+            if (original := marker.removesuffix("e")) in with_media:
+                # The fake Bot API serves files as large as their id says
+                message["caption"] = message.pop("text")
+                message["document"] = {
+                    "file_id": f"{args.media_size}-{original}",
+                    "file_unique_id": original,
+                    "file_name": f"{original}.bin",
+                    "file_size": args.media_size
+                }
+
+                if args.album_size > 1:
+                    message["media_group_id"] = original
+
+            if edit:
+                message["edit_date"] = int(time())
+
+            fake_telegram.push_update({"edited_message" if edit else "message": message})
+
+            # The album's other items, without a caption
+            for i in range(1, args.album_size if "media_group_id" in message and not edit else 1):
+                item: dict[str, Any] = {
+                    **message,
+                    "message_id": telegram_message_ids[chat_id] + 1,
+                    "document": {
+                        **message["document"],
+                        "file_unique_id": f"{original}-{i}",
+                        "file_name": f"{original}-{i}.bin"
+                    }
+                }
+                telegram_message_ids[chat_id] += 1
+                del item["caption"]
+
+                fake_telegram.push_update({"message": item})
+
+    # Inject at a steady rate
+    started: float = monotonic()
+    injections: int = int(args.rate * args.duration)
+
+    for i in range(injections):
+        if (delay := started + i / args.rate - monotonic()) > 0:
+            await asyncio.sleep(delay)
+
+        inject(edit=random.random() < args.edit_ratio)
+
+    # Let the bridge catch up
+    deadline: float = monotonic() + args.drain
+    expected: int = sum(flow.expected for flow in flows.values())
+
+    while monotonic() < deadline \
+    and sum(len(flow.latencies) for flow in flows.values()) < expected:
+        await asyncio.sleep(0.1)
+
+    # Up to the last delivery, not counting the wait for lost ones
+    elapsed: float = (last_delivery or monotonic()) - started
+
+    await telegram_bot.stop()
+    await discord_bot.close()
+    await shards.stop()
+    await fake_discord.close()
+    await fake_telegram.close()
+    exporter.cancel()
+    await asyncio.gather(
+        discord_client,
+        telegram_client,
+        exporter,
+        return_exceptions=True
+    )
+
+    for runner in runners:
+        await runner.cleanup()
+
+    database.close()
+    database_folder.cleanup()
+
+    if args.metrics:
+        with open(args.metrics, "w") as file:
+            file.write(metrics.render())
+
+    print(
+        f"{"flow":<30}{"sent":>7}{"delivered":>10}{"lost":>7}"
+        f"{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}"
+    )
+    results: dict[str, Any] = {
+        "flows": {name: flow.report(name) for name, flow in flows.items()}
+    }
+    delivered: int = sum(len(flow.latencies) for flow in flows.values())
+
+    results.update(
+        deliveries_per_second=delivered / elapsed,
+        bridge_errors=errors.errors,
+        rate_limited=fake_telegram.rate_limited + fake_discord.rate_limited,
+        webhook_errors=fake_telegram.webhook_errors,
+        media_uploaded=fake_discord.uploads,
+        media_uploaded_mb=fake_discord.uploaded / 2 ** 20,
+        # In KB on Linux, this process' only (fakes included, shard workers not)
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+        unknown_requests=fake_telegram.unknown + fake_discord.unknown,
+        api_requests=fake_telegram.requests + fake_discord.requests
+    )
+
+    print(
+        f"\n{delivered / elapsed:.1f} deliveries/s, "
+        f"{errors.errors} bridge errors, "
+        f"{results["rate_limited"]} rate limited and "
+        f"{results["unknown_requests"]} unknown API requests "
+        f"(out of {results["api_requests"]})"
+    )
+
+    if with_media:
+        print(
+            f"{fake_discord.uploads} files uploaded ({results["media_uploaded_mb"]:.1f} MB), "
+            f"{results["peak_rss_mb"]:.1f} MB peak memory"
+        )
+
+    return results
+
+
+WORDS: list[str] = (
+    "the a to and of is in it you that for on was with this be have are "
+    "**bold** *italic* `code` ||spoiler|| bridge telegram discord 😀 👍"
+).split()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load test the bridge against local fake servers."
+    )
+    parser.add_argument("--chats", type=int, default=20, help="linked Discord channels")
+    parser.add_argument("--links", type=int, default=1, help="Telegram chats linked to each channel")
+    parser.add_argument("--rate", type=float, default=10, help="injected messages per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of traffic")
+    parser.add_argument("--drain", type=float, default=30, help="max seconds to wait for deliveries")
+    parser.add_argument("--discord-ratio", type=float, default=0.5, help="share of messages from Discord")
+    parser.add_argument("--edit-ratio", type=float, default=0.2, help="share of edits")
+    parser.add_argument("--api-latency", type=float, default=0, help="fake API latency, in ms")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0, help="share of API calls answered with a 429")
+    parser.add_argument("--media-ratio", type=float, default=0, help="share of Telegram messages with a file")
+    parser.add_argument("--media-size", type=int, default=2 ** 20, help="size of those files, in bytes")
+    parser.add_argument("--album-size", type=int, default=1, help="send those files in albums of this many")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="save the results to this JSON file")
+    parser.add_argument("--metrics", help="save the bridge's metrics at the end to this file")
+    parser.add_argument("--traces", help="trace every message, saving them to this JSON lines file")
+    parser.add_argument(
+        "--telegram-webhook",
+        action="store_true",
+        help="have the fake Bot API post updates to the bridge's webhook instead of polling"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="forward from this many shard worker processes"
+    )
+    parser.add_argument(
+        "--discord-shards",
+        type=int,
+        help="run Discord's gateway as an AutoShardedBot with this many shards (0 for the recommended ones)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results: dict[str, Any] = asyncio.run(run(args))
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"arguments": vars(args), "results": results}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
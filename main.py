@@ -9,33 +9,57 @@ if __name__ == "__main__":
         exit(1)
     
     
-    from threading import Thread
+    import asyncio
     from src.discord import discord_bot
     from src.telegram import telegram_bot
-    from src.commons import commons
+    from src import shards
+    from src.commons import commons, metrics, tracing
     from src.commons.database import database
+    
+    
+    async def run() -> None:
+        # Served only if METRICS_PORT is set
+        await metrics.start()
+        # Started only if SHARD_WORKERS is set, to forward what the bots receive
+        shards.start()
+        await shards.wait_until_ready()
+        
+        # Both bots share the same loop, so neither of them
+        # has to block while waiting for the other one
+        discord_client: asyncio.Task = asyncio.create_task(discord_bot.start())
+        # Expired message associations are swept in the background
+        sweeper: asyncio.Task = asyncio.create_task(
+            database.sweep_message_associations()
+        )
+        # So are traces, if enabled
+        exporter: asyncio.Task = asyncio.create_task(tracing.export_traces())
+        
+        try:
+            # This will wait until polling is stopped.
+            # Luckily, aiogram stops it by itself
+            # in case of a KeyboardInterrupt.
+            await telegram_bot.start()
+        finally:
+            sweeper.cancel()
+            exporter.cancel()
+            
+            # Close Discord and wait for it to end its process (necessary)
+            await discord_bot.close()
+            await discord_client
+            
+            # Nothing else is received: let the workers finish forwarding
+            await shards.stop()
+            
+            await metrics.stop()
+            # Wait for the last traces to be exported
+            await asyncio.gather(exporter, return_exceptions=True)
+    
 
     # Init commons
     commons.init()
     database.init()
     
-    # Initialize discord as a separate thread
-    discord_client: Thread = Thread(
-        target=discord_bot.init
-    )
-
-    # Start the discord process
-    discord_client.start()
-
-    # Start the telegram process in the main thread
-    # This will also wait until its process is done.
-    # Luckily, aiogram automatically closes the bot
-    # in case of a KeyboardInterrupt.
-    telegram_bot.init()
-
-    # Close Discord and wait for it to end its process (necessary)
-    discord_bot.close()
-    discord_client.join()
+    commons.runner.run(run())
 
     # Close what was opened before
     commons.close()
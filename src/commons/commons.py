@@ -1,15 +1,12 @@
-from asyncio import AbstractEventLoop, Runner
+from asyncio import Runner
 
 
 def close() -> None:
     runner.close()
-    telegram_loop.close()
-    discord_loop.close()
 
 
 def init() -> None:
-    global runner, telegram_loop, discord_loop
+    global runner
 
+    # Both bots run on this runner's loop
     runner = Runner()
-    telegram_loop = AbstractEventLoop()
-    discord_loop = AbstractEventLoop()
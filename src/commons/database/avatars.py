@@ -0,0 +1,31 @@
+from typing import Iterable, NamedTuple, Optional
+
+
+class Avatar(NamedTuple):
+    # None if the user has no profile photo
+    file_unique_id: Optional[str]
+    file_path: Optional[str]
+    update_date_unix: int
+
+
+# Every known avatar, so sending a message never hits the database.
+# Entries are replaced as a whole, so readers never see an half-updated one.
+_avatars: dict[int, Avatar] = {}
+
+
+def lookup(telegram_user_id: int) -> Optional[Avatar]:
+    return _avatars.get(telegram_user_id)
+
+
+def store(telegram_user_id: int, avatar: Avatar) -> None:
+    _avatars[telegram_user_id] = avatar
+
+
+def load(rows: Iterable[tuple[int, Optional[str], Optional[str], int]]) -> None:
+    """
+    Replace the whole cache with the given
+    (TelegramUserID, FileUniqueID, FilePath, UpdateDateUnix) rows.
+    """
+    global _avatars
+
+    _avatars = {row[0]: Avatar(*row[1:]) for row in rows}
@@ -1,103 +1,240 @@
-import sqlite3
+import asyncio, csv, gzip, sqlite3, threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from itertools import chain
-from typing import Optional
-from gvars import DATABASE_NAME, PENDING_TIMEOUT
+from typing import Any, Callable, Optional, Sequence, TypeVar
+from time import time
+from gvars import (
+    DATABASE_BUSY_TIMEOUT,
+    DATABASE_NAME,
+    DATABASE_READERS,
+    MESSAGE_ARCHIVE_NAME,
+    MESSAGE_BATCH_INTERVAL,
+    MESSAGE_BATCH_SIZE,
+    MESSAGE_RETENTION,
+    RETENTION_BATCH_SIZE,
+    RETENTION_SWEEP_INTERVAL,
+    RETENTION_VACUUM_PAGES
+)
+from . import avatars, message_buffer, routing
+from .. import metrics, signals, tracing
+from ... import shards
 
+T = TypeVar("T")
+
+
+class AlreadyLinked(Exception):
+    """
+    The chats are already linked (or the association was already accepted).
+    """
+
+
+# Every worker thread owns exactly one connection, stored here
+_local = threading.local()
+_connections: list[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+
+_round_trips = metrics.Histogram(
+    "bridge_database_seconds",
+    "Database calls' duration as seen by the bots, waiting for a connection included.",
+    ("mode",),
+    metrics.FAST_BUCKETS
+)
+_statements = metrics.Histogram(
+    "bridge_database_statement_seconds",
+    "Time spent running statements (and their transaction) on a connection.",
+    ("operation",),
+    metrics.FAST_BUCKETS
+)
+_buffered_messages = metrics.Gauge(
+    "bridge_database_buffered_messages",
+    "Message associations waiting to be written.",
+    collect=lambda: {(): message_buffer.size()}
+)
+
+
+def _connect(read_only: bool) -> None:
+    """
+    Open the connection of the current worker thread.
+    Readers are opened read-only, so they can never take the write lock.
+    """
+    
+    connection: sqlite3.Connection = sqlite3.connect(
+        database=f"file:{database_path}?mode=ro" if read_only else database_path,
+        uri=read_only,
+        # Shard workers write to it too
+        timeout=DATABASE_BUSY_TIMEOUT,
+        # Connections are only used by their own thread,
+        # this is needed just to close them from close()
+        check_same_thread=False
+    )
+    
+    connection.execute("PRAGMA foreign_keys = ON;")
+    
+    if not read_only:
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute("PRAGMA synchronous = NORMAL;")
+    
+    _local.connection = connection
+    
+    with _connections_lock:
+        _connections.append(connection)
+
+
+def _call(function: Callable[..., T], *args: Any) -> T:
+    with _statements.time(function.__name__.lstrip("_")):
+        return function(_local.connection, *args)
+
+
+async def _read(function: Callable[..., T], *args: Any) -> T:
+    """Run function(connection, *args) on one of the read-only connections."""
+    with _round_trips.time("read"), \
+    tracing.span("database.read", operation=function.__name__.lstrip("_")):
+        return await asyncio.get_running_loop().run_in_executor(
+            _readers, _call, function, *args
+        )
+
+
+async def _write(function: Callable[..., T], *args: Any) -> T:
+    """Run function(connection, *args) on the only writing connection."""
+    with _round_trips.time("write"), \
+    tracing.span("database.write", operation=function.__name__.lstrip("_")):
+        return await asyncio.get_running_loop().run_in_executor(
+            _writer, _call, function, *args
+        )
+
+
+def _fetchall(
+    connection: sqlite3.Connection,
+    sql: str,
+    parameters: list[Any]
+) -> list[Any]:
+    return connection.execute(sql, parameters).fetchall()
 
-def lookup_discord_chats(telegram_chat_id: int) -> set[int]:
-    return set(chain(*cursor.execute(
-        """
-        SELECT DiscordChatID FROM Associations
-        WHERE TelegramChatID = ?;
-        """,
-        [telegram_chat_id]
-    ).fetchall()))
 
+def _fetchone(
+    connection: sqlite3.Connection,
+    sql: str,
+    parameters: list[Any]
+) -> Any:
+    return connection.execute(sql, parameters).fetchone()
 
-def lookup_discord_messages(
+
+def _execute(
+    connection: sqlite3.Connection,
+    sql: str,
+    parameters: list[Any]
+) -> None:
+    # Commits on success, rolls back on failure
+    with connection:
+        connection.execute(sql, parameters)
+
+
+def lookup_discord_chats(telegram_chat_id: int) -> frozenset[int]:
+    """
+    Served from memory: never touches the database.
+    """
+    
+    return routing.lookup_discord_chats(telegram_chat_id)
+
+
+async def lookup_discord_messages(
     telegram_chat_id: int,
     telegram_message_id: int
 ) -> dict[int, list[int]]:
-    return {
-        chat_id: list(chain(*cursor.execute(
-                """
-                SELECT DiscordMessageID FROM MessageAssociations
-                WHERE TelegramChatID = ?
-                    AND TelegramMessageID = ?
-                    AND DiscordChatID = ?
-                ORDER BY DiscordMessageID;
-                """,
-                [
-                    telegram_chat_id,
-                    telegram_message_id,
-                    chat_id
-                ]
-            ).fetchall()
-        ))
-        for chat_id in [
-            association[0] for association in cursor.execute(
-                """
-                SELECT DISTINCT DiscordChatID FROM MessageAssociations
-                WHERE TelegramChatID = ? AND TelegramMessageID = ?;
-                """,
-                [
-                    telegram_chat_id,
-                    telegram_message_id
-                ]
-            ).fetchall()
-        ]
-    }
-
-
-def lookup_telegram_chats(discord_chat_id: int) -> set[int]:
-    """"""
-    return set(chain(*cursor.execute(
-        """
-        SELECT TelegramChatID FROM Associations
-        WHERE DiscordChatID = ?;
-        """,
-        [discord_chat_id]
-    ).fetchall()))
+    # Check the buffer first: rows leave it only after being committed
+    buffered: list[tuple[int, int]] = message_buffer.lookup_discord_messages(
+        telegram_chat_id,
+        telegram_message_id
+    )
     
+    return _merge_buffered(
+        _group_by_chat(await _read(
+            _fetchall,
+            """
+            SELECT DiscordChatID, DiscordMessageID FROM MessageAssociations
+            WHERE TelegramChatID = ? AND TelegramMessageID = ?
+            ORDER BY DiscordChatID, DiscordMessageID;
+            """,
+            [
+                telegram_chat_id,
+                telegram_message_id
+            ]
+        )),
+        buffered
+    )
+
 
-def lookup_telegram_messages(
+def lookup_telegram_chats(discord_chat_id: int) -> frozenset[int]:
+    """
+    Served from memory: never touches the database.
+    """
+    
+    return routing.lookup_telegram_chats(discord_chat_id)
+
+
+def count_linked_discord_chats() -> int:
+    """
+    Served from memory: never touches the database.
+    """
+    
+    return routing.count_discord_chats()
+    
+
+async def lookup_telegram_messages(
     discord_chat_id: int,
     discord_message_id: int
 ) -> dict[int, list[int]]:
-    return {
-        chat_id: list(chain(*cursor.execute(
-                """
-                SELECT TelegramMessageID FROM MessageAssociations
-                WHERE DiscordChatID = ?
-                    AND DiscordMessageID = ?
-                    AND TelegramChatID = ?
-                ORDER BY TelegramMessageID;
-                """,
-                [
-                    discord_chat_id,
-                    discord_message_id,
-                    chat_id
-                ]
-            ).fetchall()
-        ))
-        for chat_id in [
-            association[0] for association in cursor.execute(
-                """
-                SELECT DISTINCT TelegramChatID FROM MessageAssociations
-                WHERE DiscordChatID = ? AND DiscordMessageID = ?;
-                """,
-                [
-                    discord_chat_id,
-                    discord_message_id
-                ]
-            ).fetchall()
-        ]
-    }
-
-
-# TODO: handle exceptions and integrity checks
-def associate_chats(
+    # Check the buffer first: rows leave it only after being committed
+    buffered: list[tuple[int, int]] = message_buffer.lookup_telegram_messages(
+        discord_chat_id,
+        discord_message_id
+    )
+    
+    return _merge_buffered(
+        _group_by_chat(await _read(
+            _fetchall,
+            """
+            SELECT TelegramChatID, TelegramMessageID FROM MessageAssociations
+            WHERE DiscordChatID = ? AND DiscordMessageID = ?
+            ORDER BY TelegramChatID, TelegramMessageID;
+            """,
+            [
+                discord_chat_id,
+                discord_message_id
+            ]
+        )),
+        buffered
+    )
+
+
+def _group_by_chat(rows: list[tuple[int, int]]) -> dict[int, list[int]]:
+    """
+    Group (chat id, message id) rows, keeping the order they come in.
+    """
+    
+    associations: dict[int, list[int]] = {}
+    
+    for chat_id, message_id in rows:
+        associations.setdefault(chat_id, []).append(message_id)
+    
+    return associations
+
+
+def _merge_buffered(
+    associations: dict[int, list[int]],
+    buffered: list[tuple[int, int]]
+) -> dict[int, list[int]]:
+    for chat_id, message_id in buffered:
+        message_ids: list[int] = associations.setdefault(chat_id, [])
+        
+        if message_id not in message_ids:
+            message_ids.append(message_id)
+            message_ids.sort()
+    
+    return associations
+
+
+async def associate_chats(
     *,
     uuid: str,
     discord_chat_id: int,
@@ -105,23 +242,89 @@ def associate_chats(
     owner_discord_id: int,
     owner_telegram_id: int
 ) -> None:
-    cursor.execute(
-        """
-        INSERT INTO Associations VALUES (?, ?, ?, ?, ?);
-        """,
-        [
-            uuid,
-            discord_chat_id,
-            telegram_chat_id,
-            owner_discord_id,
-            owner_telegram_id
-        ]
+    """
+    Raises AlreadyLinked if the chats are, or the UUID was used.
+    """
+    
+    try:
+        await _write(
+            _execute,
+            """
+            INSERT INTO Associations VALUES (?, ?, ?, ?, ?);
+            """,
+            [
+                uuid,
+                discord_chat_id,
+                telegram_chat_id,
+                owner_discord_id,
+                owner_telegram_id
+            ]
+        )
+    except sqlite3.IntegrityError as error:
+        raise AlreadyLinked() from error
+    
+    # Only route once the association has been committed
+    routing.link(discord_chat_id, telegram_chat_id)
+    shards.broadcast("chats_linked", (discord_chat_id, telegram_chat_id))
+    
+    
+def _flush_messages(connection: sqlite3.Connection) -> None:
+    """
+    Write every buffered message association in a single transaction.
+    """
+    
+    rows: list[message_buffer.MessageRow] = message_buffer.take()
+    
+    if not rows:
+        return
+    
+    sql: str = """
+    INSERT OR IGNORE INTO MessageAssociations VALUES (?, ?, ?, ?, ?);
+    """
+    
+    try:
+        with connection:
+            connection.executemany(sql, rows)
+    except sqlite3.IntegrityError:
+        # Don't let a single row (e.g. of a removed association)
+        # throw away the whole batch
+        for row in rows:
+            try:
+                with connection:
+                    connection.execute(sql, row)
+            except sqlite3.IntegrityError:
+                pass
+    
+    message_buffer.discard(rows)
+
+
+def _schedule_flush() -> None:
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    
+    _writer.submit(_call, _flush_messages).add_done_callback(
+        lambda flush: _on_flushed(loop, flush)
     )
-    connection.commit()
+
+
+def _on_flushed(loop: asyncio.AbstractEventLoop, flush: Future) -> None:
+    """
+    Runs on the writer's thread. Failed rows are still buffered
+    (so lookups find them): try again in a while.
+    """
     
+    if flush.cancelled() or not (error := flush.exception()):
+        return
     
-# TODO: handle exceptions and integrity checks
-def associate_messages(
+    print(
+        f"Couldn't write {message_buffer.size()} buffered message associations, "
+        f"retrying in {MESSAGE_BATCH_INTERVAL}s: {error!r}"
+    )
+    
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(loop.call_later, MESSAGE_BATCH_INTERVAL, _schedule_flush)
+
+
+async def associate_messages(
     *,
     discord_chat_id: int,
     discord_message_id: int,
@@ -129,177 +332,285 @@ def associate_messages(
     telegram_message_id: int,
     forward_date_unix: int
 ) -> None:
-    cursor.execute(
-        """
-        INSERT INTO MessageAssociations VALUES (?, ?, ?, ?, ?);
-        """,
-        [
-            discord_chat_id,
-            discord_message_id,
-            telegram_chat_id,
-            telegram_message_id,
-            forward_date_unix
-        ]
-    )
-    connection.commit()
+    """
+    Buffer a message association, which gets written with the others
+    every MESSAGE_BATCH_SIZE rows or MESSAGE_BATCH_INTERVAL seconds.
+    Lookups can find it right away anyway.
+    """
     
+    _buffer_messages([(
+        discord_chat_id,
+        discord_message_id,
+        telegram_chat_id,
+        telegram_message_id,
+        forward_date_unix
+    )])
 
-# TODO: handle exceptions and integrity checks
-def pend_association(
+
+async def associate_album(
     *,
-    uuid: str,
-    discord_chat_id: Optional[int] = None,
-    owner_discord_id: Optional[int] = None,
-    telegram_chat_id: Optional[int] = None,
-    owner_telegram_id: Optional[int] = None,
-    chat_name: str,
-    creation_date_unix: Optional[int]
+    discord_chat_id: int,
+    discord_messages: Sequence[tuple[int, int]],
+    telegram_chat_id: int,
+    telegram_message_ids: Sequence[int]
 ) -> None:
-    cursor.execute(
-        """
-        INSERT INTO PendingAssociations VALUES (?, ?, ?, ?, ?, ?, ?);
-        """,
-        [
-            uuid,
+    """
+    Buffer the associations of every item of an album with every
+    message (id, forward date) it was forwarded as, all at once:
+    they're committed in the same transaction.
+    """
+    
+    _buffer_messages([
+        (
             discord_chat_id,
-            owner_discord_id,
+            discord_message_id,
             telegram_chat_id,
-            owner_telegram_id,
-            chat_name,
-            creation_date_unix
-        ]
-    )
-    connection.commit()
+            telegram_message_id,
+            forward_date_unix
+        )
+        for discord_message_id, forward_date_unix in discord_messages
+        for telegram_message_id in telegram_message_ids
+    ])
+
+
+def _buffer_messages(rows: list[message_buffer.MessageRow]) -> None:
+    with tracing.span("database.buffer") as span:
+        size, schedule = message_buffer.add(rows)
+        
+        if span:
+            span.set(buffered=size)
+    
+    if size >= MESSAGE_BATCH_SIZE:
+        _schedule_flush()
+    elif schedule:
+        asyncio.get_running_loop().call_later(
+            MESSAGE_BATCH_INTERVAL,
+            _schedule_flush
+        )
     
 
-def accept_pending(
+async def accept_pending(
     uuid: str,
     discord_chat_id: Optional[int] = None,
     owner_discord_id: Optional[int] = None,
     telegram_chat_id: Optional[int] = None,
     owner_telegram_id: Optional[int] = None
-) -> str:
+) -> Optional[str]:
     """
-    Accept a pending association.
-    Returns the ids and the name of the chat this happened in.
+    Accept a pending association from the other platform.
+    Returns the name of the chat it was pended in,
+    or None if there is no such pending association.
+    Raises AlreadyLinked if the chats already are (or if
+    it was accepted twice at once).
     """
     
-    cursor.execute(
-        """
-        INSERT INTO Associations
-        SELECT
-            UUID,
-            coalesce(DiscordChatID, ?),
-            coalesce(TelegramChatID, ?),
-            coalesce(OwnerDiscordID, ?), 
-            coalesce(OwnerTelegramID, ?)
-        FROM PendingAssociations
-        WHERE UUID = ?;
-        """,
-        [
-            discord_chat_id,
-            telegram_chat_id,
-            owner_discord_id,
-            owner_telegram_id,
-            uuid
-        ]
+    pending: Optional[signals.PendingAssociation] = \
+        signals.get_pending_association(uuid)
+    
+    # Associations can't be accepted from the platform they were pended in
+    if not pending or (pending.discord_chat_id is None) == (discord_chat_id is None):
+        return None
+    
+    discord_chat_id = pending.discord_chat_id or discord_chat_id
+    telegram_chat_id = pending.telegram_chat_id or telegram_chat_id
+    
+    if discord_chat_id in routing.lookup_discord_chats(telegram_chat_id): # type: ignore
+        # It would be waited for until it expires otherwise
+        signals.resolve_pending_association(uuid, False)
+        raise AlreadyLinked()
+    
+    # Accepting the same one twice at once fails the second time,
+    # but it's left to the first to resolve
+    await associate_chats(
+        uuid=uuid,
+        discord_chat_id=discord_chat_id, # type: ignore
+        telegram_chat_id=telegram_chat_id, # type: ignore
+        owner_discord_id=pending.owner_discord_id or owner_discord_id, # type: ignore
+        owner_telegram_id=pending.owner_telegram_id or owner_telegram_id # type: ignore
     )
-    connection.commit()
     
-    chat_name: str = cursor.execute(
-        """
-        SELECT ChatName FROM PendingAssociations
-        WHERE UUID = ?
-        LIMIT 1;
-        """,
-        [uuid]
-    ).fetchone()[0]
+    signals.resolve_pending_association(uuid, True)
+    
+    return pending.chat_name
+
+
+def _sweep_message_associations(
+    connection: sqlite3.Connection,
+    cutoff_unix: int
+) -> int:
+    """
+    Delete up to RETENTION_BATCH_SIZE associations forwarded before the cutoff,
+    archiving them first if MESSAGE_ARCHIVE_NAME is set.
+    Returns how many were deleted.
+    """
     
-    delete_selected_pending_associations(uuid=uuid)
+    # Commits on success, rolls back (archive write included) on failure
+    with connection:
+        # The oldest rows first, straight from the ForwardDateUnix index
+        rows: list[tuple[int, ...]] = connection.execute(
+            """
+            DELETE FROM MessageAssociations
+            WHERE rowid IN (
+                SELECT rowid FROM MessageAssociations
+                WHERE ForwardDateUnix < ?
+                ORDER BY ForwardDateUnix
+                LIMIT ?
+            )
+            RETURNING
+                DiscordChatID,
+                DiscordMessageID,
+                TelegramChatID,
+                TelegramMessageID,
+                ForwardDateUnix;
+            """,
+            [cutoff_unix, RETENTION_BATCH_SIZE]
+        ).fetchall()
+        
+        if rows and archive_path:
+            # Every batch is its own gzip member: they read back as one file
+            with gzip.open(archive_path, "at", newline="") as archive:
+                csv.writer(archive).writerows(rows)
     
-    return chat_name
+    return len(rows)
 
 
-def is_association_pending(uuid: str) -> bool:
-    return bool(cursor.execute(
-        """
-        SELECT 1 FROM PendingAssociations
-        WHERE UUID = ?
-        LIMIT 1;
-        """,
-        [uuid]
-    ).fetchone())
+def _vacuum(connection: sqlite3.Connection) -> None:
+    # Give back to the filesystem the pages freed by the sweeps
+    connection.execute(
+        f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});"
+    ).fetchall()
 
 
-def delete_old_message_associations() -> None:
+async def sweep_message_associations() -> None:
     """
-    Delete 2 days (172800 seconds) old message associations.
-    This is a static limitation, so it's not recommended
-    to change this value any greater.
+    Delete message associations older than MESSAGE_RETENTION seconds,
+    every RETENTION_SWEEP_INTERVAL seconds, until cancelled.
+    Rows are deleted in small batches, so queued writes
+    (such as new messages) can go in between them.
     """
     
-    cursor.execute(
-        """
-        DELETE FROM MessageAssociations
-        WHERE (unixepoch() - ForwardDateUnix) >= 172800;
-        """
-    )
-    connection.commit()
+    while True:
+        cutoff_unix: int = int(time()) - MESSAGE_RETENTION
+        deleted: int = 0
+        
+        while (batch := await _write(
+            _sweep_message_associations,
+            cutoff_unix
+        )):
+            deleted += batch
+            
+            if batch < RETENTION_BATCH_SIZE:
+                break
+        
+        if deleted:
+            await _write(_vacuum)
+        
+        await asyncio.sleep(RETENTION_SWEEP_INTERVAL)
+    
+
+def _delete_message_associations(
+    connection: sqlite3.Connection,
+    discord_chat_id: int,
+    telegram_chat_id: int,
+    message_ids: list[int]
+) -> None:
+    placeholders: str = ", ".join("?" * len(message_ids))
     
+    # Two statements instead of an OR, so both can use an index
+    with connection:
+        connection.execute(
+            f"""
+            DELETE FROM MessageAssociations
+            WHERE DiscordChatID = ?
+            AND DiscordMessageID IN ({placeholders})
+            AND TelegramChatID = ?;
+            """,
+            [discord_chat_id, *message_ids, telegram_chat_id]
+        )
+        connection.execute(
+            f"""
+            DELETE FROM MessageAssociations
+            WHERE TelegramChatID = ?
+            AND TelegramMessageID IN ({placeholders})
+            AND DiscordChatID = ?;
+            """,
+            [telegram_chat_id, *message_ids, discord_chat_id]
+        )
+
 
-def delete_message_associations(
+async def delete_message_associations(
     discord_chat_id: int,
     telegram_chat_id: int,
     message_ids: list[int]
 ) -> None:
+    """
+    Delete the associations of the given messages,
+    be them either Discord's or Telegram's.
+    """
+    
     if not message_ids:
         return
     
-    cursor.execute(
-        """
-        DELETE FROM MessageAssociations
-        WHERE DiscordChatID = ?
-        AND TelegramChatID = ?
-        AND (DiscordMessageID {0} OR TelegramMessageID {0});
-        """.format(
-            f"IN ({', '.join(str(id) for id in message_ids)})"
-            if len(message_ids) > 1
-            else f"= {message_ids[0]}"
-        ),
-        [
-            discord_chat_id,
-            telegram_chat_id
-        ]
+    # Rows taken by a running flush will be deleted right after it
+    message_buffer.remove(discord_chat_id, telegram_chat_id, message_ids)
+    
+    await _write(
+        _delete_message_associations,
+        discord_chat_id,
+        telegram_chat_id,
+        message_ids
     )
-    connection.commit()
 
 
-def delete_selected_pending_associations(
+def lookup_avatar(telegram_user_id: int) -> Optional[avatars.Avatar]:
+    """
+    Synchronous: avatars are always kept in memory.
+    """
+    
+    return avatars.lookup(telegram_user_id)
+
+
+async def save_avatar(
     *,
-    uuid: Optional[str] = None,
-    unix: Optional[int] = None
+    telegram_user_id: int,
+    file_unique_id: Optional[str],
+    file_path: Optional[str],
+    update_date_unix: int
 ) -> None:
     """
-    Delete associations with the same UUID or older than a few minutes.
+    Only written if the picture (or where it's downloaded from) changed:
+    otherwise it's just fresh again, in memory.
     """
     
-    cursor.execute(
-        """
-        DELETE FROM PendingAssociations
-        WHERE UUID = ?
-        OR (unixepoch() - ?) >= ?
-        """,
-        [uuid, unix, PENDING_TIMEOUT]
+    cached: Optional[avatars.Avatar] = avatars.lookup(telegram_user_id)
+    avatar: avatars.Avatar = avatars.Avatar(
+        file_unique_id,
+        file_path,
+        update_date_unix
     )
-    connection.commit()
     
+    # Senders can use it right away, while it's being written
+    avatars.store(telegram_user_id, avatar)
+    
+    if cached and cached[:2] == avatar[:2]:
+        return
     
-def get_chat_ids(uuid: str) -> tuple[int, int]:
+    await _write(
+        _execute,
+        """
+        INSERT OR REPLACE INTO Avatars VALUES (?, ?, ?, ?);
+        """,
+        [telegram_user_id, *avatar]
+    )
+
+
+async def get_chat_ids(uuid: str) -> tuple[int, int]:
     """
     0 - Discord; 1 - Telegram
     """
     
-    return cursor.execute(
+    return await _read(
+        _fetchone,
         """
         SELECT DiscordChatID, TelegramChatID
         FROM Associations
@@ -307,36 +618,113 @@ def get_chat_ids(uuid: str) -> tuple[int, int]:
         LIMIT 1;
         """,
         [uuid]
-    ).fetchone()
+    )
+
+
+def _migrate(connection: sqlite3.Connection) -> None:
+    """
+    Apply, in order, every migration newer than the database's version.
+    Each one runs in its own transaction along with the version bump.
+    """
+    
+    version: int = connection.execute("PRAGMA user_version;").fetchone()[0]
+    
+    for migration in sorted((Path(__file__).parent / "migrations").glob("*.sql")):
+        migration_version: int = int(migration.name.split("_", 1)[0])
+        
+        if migration_version <= version:
+            continue
+        
+        try:
+            connection.executescript(
+                f"BEGIN;\n"
+                f"{migration.read_text()}\n"
+                f"PRAGMA user_version = {migration_version};\n"
+                f"COMMIT;"
+            )
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+        
+        print(f"Database migrated to version {migration_version}.")
+
+
+def _create_tables(connection: sqlite3.Connection) -> None:
+    # Freed pages can only be given back if this is set,
+    # which must happen outside of any transaction (so not in a migration)
+    if connection.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        # Existing databases only switch to it after a full vacuum
+        connection.execute("VACUUM;")
+    
+    _migrate(connection)
+    _load(connection)
+
+
+def _load(connection: sqlite3.Connection) -> None:
+    # Load every association in memory, so routing never hits the database
+    routing.load(connection.execute(
+        """
+        SELECT DiscordChatID, TelegramChatID FROM Associations;
+        """
+    ).fetchall())
+    
+    # Same for the avatars, so forwarding never waits on them
+    avatars.load(connection.execute(
+        """
+        SELECT TelegramUserID, FileUniqueID, FilePath, UpdateDateUnix
+        FROM Avatars;
+        """
+    ).fetchall())
 
 
 def close() -> None:
-    cursor.close()
-    connection.close()
+    # Let the queued statements finish before closing anything
+    _readers.shutdown(wait=True)
+    _writer.submit(_call, _flush_messages)
+    _writer.shutdown(wait=True)
+    
+    for connection in _connections:
+        connection.close()
+    
+    _connections.clear()
     
     print("Database closed successfully.")
 
 
-def init() -> None:
-    global connection, cursor
+def init(coordinator: bool = True) -> None:
+    """
+    Shard workers (not the coordinator) only load the database
+    the coordinator already created and migrated.
+    Linking chats is left to the coordinator too: it lets them know.
+    """
     
-    this_path: Path = Path(__file__).parent.resolve()
+    global database_path, archive_path, _writer, _readers
     
-    connection = sqlite3.connect(
-        database=this_path / f"{DATABASE_NAME}.db",
-        check_same_thread=False
+    database_path = Path(__file__).parent.resolve() / f"{DATABASE_NAME}.db"
+    archive_path = Path(__file__).parent.resolve() / f"{MESSAGE_ARCHIVE_NAME}.csv.gz" \
+    if MESSAGE_ARCHIVE_NAME else None
+    
+    # A single thread owns the only connection allowed to write,
+    # so writes are serialized without ever blocking an event loop
+    _writer = ThreadPoolExecutor(
+        max_workers=1,
+        thread_name_prefix="database-writer",
+        initializer=_connect,
+        initargs=(False,)
     )
-    cursor = connection.cursor()
+    
+    # Create the tables (readers can only open an existing database)
+    _writer.submit(_call, _create_tables if coordinator else _load).result()
     
     print("Connection with the database has been enstablished.")
-
-    # Create the tables
-    with open(this_path / f"create_tables.sql") as sql_script:
-        cursor.executescript(sql_script.read())
-        
-        # Commit the changes (necessary)
-        connection.commit()
     
-    print("Database tables loaded/created succesfully.")
+    # WAL lets these read while the writer is committing
+    _readers = ThreadPoolExecutor(
+        max_workers=DATABASE_READERS,
+        thread_name_prefix="database-reader",
+        initializer=_connect,
+        initargs=(True,)
+    )
     
-    # delete_old_message_associations()
+    print("Database tables loaded/created succesfully.")
@@ -0,0 +1,100 @@
+from threading import Lock
+from typing import Iterable
+
+# (DiscordChatID, DiscordMessageID, TelegramChatID, TelegramMessageID)
+MessageKey = tuple[int, int, int, int]
+# Same as above, followed by ForwardDateUnix
+MessageRow = tuple[int, int, int, int, int]
+
+# Rows waiting to be written. They are only dropped from here once
+# they have been committed, so lookups can always find them in one place.
+_rows: dict[MessageKey, int] = {}
+_lock: Lock = Lock()
+_flush_scheduled: bool = False
+
+
+def add(rows: Iterable[MessageRow]) -> tuple[int, bool]:
+    """
+    Buffer the rows all at once.
+    Returns the buffered rows count and whether a flush has to be scheduled.
+    """
+    global _flush_scheduled
+
+    with _lock:
+        for row in rows:
+            _rows[row[:4]] = row[4]
+
+        schedule: bool = not _flush_scheduled
+        _flush_scheduled = True
+
+        return len(_rows), schedule
+
+
+def size() -> int:
+    with _lock:
+        return len(_rows)
+
+
+def take() -> list[MessageRow]:
+    """
+    Get the rows to flush. They stay buffered until discard() is called.
+    """
+    global _flush_scheduled
+
+    with _lock:
+        _flush_scheduled = False
+
+        return [(*key, date) for key, date in _rows.items()]
+
+
+def discard(rows: Iterable[MessageRow]) -> None:
+    with _lock:
+        for row in rows:
+            _rows.pop(row[:4], None)
+
+
+def remove(
+    discord_chat_id: int,
+    telegram_chat_id: int,
+    message_ids: Iterable[int]
+) -> None:
+    ids: set[int] = set(message_ids)
+
+    with _lock:
+        for key in [
+            key for key in _rows
+            if key[0] == discord_chat_id
+            and key[2] == telegram_chat_id
+            and (key[1] in ids or key[3] in ids)
+        ]:
+            del _rows[key]
+
+
+def lookup_discord_messages(
+    telegram_chat_id: int,
+    telegram_message_id: int
+) -> list[tuple[int, int]]:
+    """
+    Returns (DiscordChatID, DiscordMessageID) pairs.
+    """
+
+    with _lock:
+        return [
+            (key[0], key[1]) for key in _rows
+            if key[2] == telegram_chat_id and key[3] == telegram_message_id
+        ]
+
+
+def lookup_telegram_messages(
+    discord_chat_id: int,
+    discord_message_id: int
+) -> list[tuple[int, int]]:
+    """
+    Returns (TelegramChatID, TelegramMessageID) pairs.
+    """
+
+    with _lock:
+        return [
+            (key[2], key[3]) for key in _rows
+            if key[0] == discord_chat_id and key[1] == discord_message_id
+        ]
@@ -1,5 +1,3 @@
-PRAGMA foreign_keys = ON;
-
 CREATE TABLE IF NOT EXISTS Associations (
     UUID TEXT PRIMARY KEY,
     DiscordChatID INTEGER NOT NULL,
@@ -23,25 +21,4 @@ CREATE TABLE IF NOT EXISTS MessageAssociations (
         ON DELETE CASCADE
 ) STRICT;
 
-CREATE TEMPORARY TABLE PendingAssociations (
-    UUID TEXT PRIMARY KEY,
-    DiscordChatID INTEGER UNIQUE,
-    OwnerDiscordID INTEGER UNIQUE,
-    TelegramChatID INTEGER UNIQUE,
-    OwnerTelegramID INTEGER UNIQUE,
-    ChatName TEXT NOT NULL,
-    CreationDateUnix INTEGER NOT NULL,
-    
-    CHECK((
-            (DiscordChatID NOTNULL AND OwnerDiscordID NOTNULL)
-            AND
-            (TelegramChatID ISNULL AND OwnerTelegramID ISNULL)
-        ) OR (
-            (DiscordChatID ISNULL AND OwnerDiscordID ISNULL)
-            AND
-            (TelegramChatID NOTNULL AND OwnerTelegramID NOTNULL)
-    ))
-), STRICT, WITHOUT ROWID;
-
 CREATE UNIQUE INDEX IF NOT EXISTS UUID ON Associations(UUID);
-CREATE UNIQUE INDEX UUID ON PendingAssociations(UUID);
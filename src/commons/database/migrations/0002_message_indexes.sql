@@ -0,0 +1,12 @@
+-- Lookups and deletes from Discord's side are already covered
+-- by the UNIQUE constraint, which is led by DiscordChatID.
+CREATE INDEX IF NOT EXISTS MessageAssociationsTelegram
+ON MessageAssociations(
+    TelegramChatID,
+    TelegramMessageID,
+    DiscordChatID,
+    DiscordMessageID
+);
+
+CREATE INDEX IF NOT EXISTS MessageAssociationsForwardDate
+ON MessageAssociations(ForwardDateUnix);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS Avatars (
+    TelegramUserID INTEGER PRIMARY KEY,
+    FileUniqueID TEXT,
+    FilePath TEXT,
+    UpdateDateUnix INTEGER NOT NULL
+) STRICT;
@@ -0,0 +1,54 @@
+from threading import Lock
+from typing import Iterable
+
+# Chats are linked in both directions, so both lookups are a dict access.
+# Sets are frozen and replaced as a whole, so readers never need the lock
+# and never see an half-updated association.
+_EMPTY: frozenset[int] = frozenset()
+_telegram_chats: dict[int, frozenset[int]] = {}
+_discord_chats: dict[int, frozenset[int]] = {}
+_lock: Lock = Lock()
+
+
+def lookup_telegram_chats(discord_chat_id: int) -> frozenset[int]:
+    return _telegram_chats.get(discord_chat_id, _EMPTY)
+
+
+def lookup_discord_chats(telegram_chat_id: int) -> frozenset[int]:
+    return _discord_chats.get(telegram_chat_id, _EMPTY)
+
+
+def count_discord_chats() -> int:
+    return len(_telegram_chats)
+
+
+def link(discord_chat_id: int, telegram_chat_id: int) -> None:
+    with _lock:
+        _telegram_chats[discord_chat_id] = \
+            _telegram_chats.get(discord_chat_id, _EMPTY) | {telegram_chat_id}
+        _discord_chats[telegram_chat_id] = \
+            _discord_chats.get(telegram_chat_id, _EMPTY) | {discord_chat_id}
+
+
+def load(associations: Iterable[tuple[int, int]]) -> None:
+    """
+    Replace the whole table with the given (Discord, Telegram) chat ids.
+    """
+    global _telegram_chats, _discord_chats
+
+    telegram_chats: dict[int, set[int]] = {}
+    discord_chats: dict[int, set[int]] = {}
+
+    for discord_chat_id, telegram_chat_id in associations:
+        telegram_chats.setdefault(discord_chat_id, set()).add(telegram_chat_id)
+        discord_chats.setdefault(telegram_chat_id, set()).add(discord_chat_id)
+
+    with _lock:
+        _telegram_chats = {
+            chat_id: frozenset(chat_ids)
+            for chat_id, chat_ids in telegram_chats.items()
+        }
+        _discord_chats = {
+            chat_id: frozenset(chat_ids)
+            for chat_id, chat_ids in discord_chats.items()
+        }
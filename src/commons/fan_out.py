@@ -0,0 +1,78 @@
+import asyncio
+from typing import Awaitable, Callable, Iterable, Optional
+from weakref import WeakValueDictionary
+from gvars import FAN_OUT_CONCURRENCY
+from time import monotonic
+from . import metrics, tracing
+
+# One lock per destination chat: whoever asks first sends first,
+# so chunks and messages keep their order inside every chat.
+# Locks are dropped as soon as nobody is waiting on them anymore.
+_chat_locks: WeakValueDictionary[tuple[str, int], asyncio.Lock] = \
+    WeakValueDictionary()
+_semaphore: asyncio.Semaphore = asyncio.Semaphore(FAN_OUT_CONCURRENCY)
+_failures = metrics.Counter(
+    "bridge_fan_out_failures_total",
+    "Chats a message or an edit couldn't be sent into.",
+    ("platform",)
+)
+
+
+async def _send_in_order(
+    platform: str,
+    chat_id: int,
+    send: Callable[[int], Awaitable[None]]
+) -> None:
+    lock: asyncio.Lock = _chat_locks.setdefault(
+        (platform, chat_id),
+        asyncio.Lock()
+    )
+
+    with tracing.span(f"{platform}.chat", chat_id=chat_id) as span:
+        queued: float = monotonic()
+
+        async with lock, _semaphore:
+            if span:
+                span.set(queued_ms=(monotonic() - queued) * 1000)
+
+            await send(chat_id)
+
+
+async def _send_now(
+    platform: str,
+    chat_id: int,
+    send: Callable[[int], Awaitable[None]]
+) -> None:
+    # Waiting for the chat's lock (or a free slot) would put it
+    # behind the new messages, whatever its priority
+    with tracing.span(f"{platform}.chat", chat_id=chat_id):
+        await send(chat_id)
+
+
+async def fan_out(
+    platform: str,
+    chat_ids: Iterable[int],
+    send: Callable[[int], Awaitable[None]],
+    ordered: bool = True
+) -> None:
+    """
+    Run send(chat_id) for all the chats of the platform at once,
+    at most FAN_OUT_CONCURRENCY at a time and in order inside every chat.
+    Unordered sends (edits) skip both, only queueing in the scheduler.
+    A failing chat doesn't stop the others; the first error is raised at the end.
+    """
+
+    error: Optional[BaseException] = None
+    send_chat: Callable[..., Awaitable[None]] = \
+        _send_in_order if ordered else _send_now
+
+    for result in await asyncio.gather(
+        *(send_chat(platform, chat_id, send) for chat_id in chat_ids),
+        return_exceptions=True
+    ):
+        if isinstance(result, BaseException):
+            _failures.inc(platform)
+            error = error or result
+
+    if error:
+        raise error
@@ -0,0 +1,36 @@
+import discord
+from typing import Any
+from gvars import DISCORD_MAX_MESSAGES
+
+# Only what forwarding and commands need: messages (and their content)
+# from servers and DMs, the servers' channels and their webhooks' changes
+LEAN_INTENTS: discord.Intents = discord.Intents(
+    guilds=True,
+    guild_messages=True,
+    dm_messages=True,
+    message_content=True,
+    webhooks=True
+)
+
+
+def get_client_options(profile: str) -> dict[str, Any]:
+    """
+    The Discord client's options for a profile:
+    - "lean" never receives nor caches members and presences,
+      so it doesn't have to request every server's members at startup;
+    - "full" gets every intent, with discord.py's default caches.
+    """
+
+    match profile:
+        case "lean":
+            return {
+                "intents": LEAN_INTENTS,
+                "member_cache_flags": discord.MemberCacheFlags.none(),
+                "chunk_guilds_at_startup": False,
+                "max_messages": DISCORD_MAX_MESSAGES
+            }
+
+        case "full":
+            return {"intents": discord.Intents.all()}
+
+    raise ValueError(f"Unknown Discord profile: {profile!r}")
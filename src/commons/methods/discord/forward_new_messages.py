@@ -1,10 +1,12 @@
-import asyncio, discord
+import discord
 from aiogram.types import User
-from typing import Optional, Union
+from typing import Optional, Sequence, Union
 from .manage_webhook import send_webhook_message
 from ..telegram.get_avatar_url import get_avatar
+from ..telegram.get_media import Media
+from ... import metrics, tracing
 from ...database import database
-from ... import commons
+from ...scheduler import Priority
 
 
 async def forward_new_messages(
@@ -17,24 +19,52 @@ async def forward_new_messages(
         discord.Message,
         discord.MessageReference,
         discord.PartialMessage
-    ]] = None
+    ]] = None,
+    priority: Priority = Priority.BULK,
+    media: Sequence[Media] = (),
+    album_message_ids: Sequence[int] = ()
 ) -> None:
+    """
+    album_message_ids are the album's other items, forwarded
+    in the same messages, if telegram_message_id is an album's.
+    """
+    
+    with tracing.span("get_avatar"):
+        avatar_url: Optional[str] = await get_avatar(from_user)
+    
     # Split text if it's too long.
-    for result in await send_webhook_message(
-        telegram_user=from_user,
-        avatar_url=asyncio.run_coroutine_threadsafe(
-            coro=get_avatar(from_user),
-            loop=commons.telegram_loop
-        ).result(),
-        chat_id=discord_chat_id,
-        text=text,
-        reference=reference
-    ):
-        if not result:
-            continue
-        
+    results: list[Union[discord.Message, discord.WebhookMessage, discord.PartialMessage]] = [
+        result
+        for result in await send_webhook_message(
+            telegram_user=from_user,
+            avatar_url=avatar_url,
+            chat_id=discord_chat_id,
+            text=text,
+            reference=reference,
+            priority=priority,
+            media=media
+        )
+        if result
+    ]
+    
+    metrics.messages.inc("telegram_to_discord", "forwarded", amount=len(results))
+    
+    if album_message_ids:
+        # Every item is associated with every message, at once
+        await database.associate_album(
+            discord_chat_id=discord_chat_id,
+            discord_messages=[
+                (result.id, int(result.created_at.timestamp())) # Date from Discord
+                for result in results
+            ],
+            telegram_chat_id=telegram_chat_id,
+            telegram_message_ids=[telegram_message_id, *album_message_ids]
+        )
+        return
+    
+    for result in results:
         # Register the messages to the database
-        database.associate_messages(
+        await database.associate_messages(
             discord_chat_id=discord_chat_id,
             discord_message_id=result.id,
             telegram_chat_id=telegram_chat_id,
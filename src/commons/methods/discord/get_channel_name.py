@@ -1,17 +1,24 @@
 import discord
-from typing import Any
+from typing import Any, Optional
 
 
-def get_channel_name(channel: Any) -> str:
+def get_channel_name(channel: Any, author: Optional[discord.abc.User] = None) -> str:
+    """
+    Name a channel from what's known about it, without any member cache.
+    A DM's recipient might not be known: if given, a message's author is used instead.
+    """
+    
     match channel:
+        case discord.DMChannel():
+            recipient: Optional[discord.abc.User] = author or channel.recipient
+            
+            return recipient.name if recipient else "Recipient"
+        
         case discord.abc.PrivateChannel():
-            return channel.recipients[0].name \
-            if isinstance(channel, discord.DMChannel) \
-            else getattr(channel, "name") or "Recipient"
+            return getattr(channel, "name") or "Recipient"
         
         case discord.PartialMessageable():
             return channel.guild.name if channel.guild else "Recipient"
         
         case _:
             return channel.name or "Recipient"
-    
\ No newline at end of file
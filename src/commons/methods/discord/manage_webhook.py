@@ -1,26 +1,145 @@
-import discord
-from typing import Optional, Union
+import asyncio, discord
+from typing import Awaitable, Callable, Optional, Sequence, TypeVar, Union
 from aiogram.types import User
-from async_lru import alru_cache
+from collections import OrderedDict
+from time import monotonic
 from textwrap import wrap
 from ....discord import discord_bot
+from ... import metrics, tracing
+from ...database import database
+from ...scheduler import Priority, schedule_discord
+from ..telegram.get_media import Media
+from . import upload_media
+from gvars import CHANNEL_CACHE_SLACK, CHANNEL_NEGATIVE_TTL, CHANNEL_TTL
 from limits import DISCORD_MESSAGE_LENGTH_LIMIT
 
+T = TypeVar("T")
 
-@alru_cache()
-async def get_channel(chat_id: int):
-    return discord_bot.bot.get_channel(chat_id) \
-    or await discord_bot.bot.fetch_channel(chat_id)
+Channel = Union[
+    discord.abc.GuildChannel,
+    discord.abc.PrivateChannel,
+    discord.Thread
+]
+WebhookChannel = Union[
+    discord.TextChannel,
+    discord.VoiceChannel,
+    discord.StageChannel
+]
+
+# Discord's JSON error code for deleted webhooks
+UNKNOWN_WEBHOOK: int = 10015
+
+# Channels by id, least recently used first, with when they expire.
+# None for the ones that couldn't be fetched.
+_channels: OrderedDict[int, tuple[Optional[Channel], float]] = OrderedDict()
+# Channels being fetched, by id
+_fetching: dict[int, asyncio.Future] = {}
+# Our webhook of each channel, by channel id
+_webhooks: dict[int, discord.Webhook] = {}
+_webhook_cache = metrics.Counter(
+    "bridge_webhook_cache_requests_total",
+    "Webhook lookups, by whether the webhook was cached.",
+    ("result",)
+)
+_channel_cache = metrics.Counter(
+    "bridge_channel_cache_requests_total",
+    "Channel lookups, by whether the channel (or its absence) was cached.",
+    ("result",)
+)
+
+
+def _store_channel(chat_id: int, channel: Optional[Channel], ttl: float) -> None:
+    _channels[chat_id] = (channel, monotonic() + ttl)
+    _channels.move_to_end(chat_id)
+    
+    # Sized to the linked channels, so they never push each other out
+    while len(_channels) > database.count_linked_discord_chats() + CHANNEL_CACHE_SLACK:
+        _channels.popitem(last=False)
+
+
+async def _fetch_channel(chat_id: int) -> Optional[Channel]:
+    try:
+        channel: Channel = await schedule_discord(
+            chat_id,
+            lambda: discord_bot.bot.fetch_channel(chat_id),
+            Priority.INTERACTIVE
+        )
+    except (discord.NotFound, discord.Forbidden):
+        # Don't ask again for a while: it's most likely gone for good
+        _store_channel(chat_id, None, CHANNEL_NEGATIVE_TTL)
+        return None
+    
+    _store_channel(chat_id, channel, CHANNEL_TTL)
+    
+    return channel
+
+
+async def get_channel(chat_id: int) -> Optional[Channel]:
+    """
+    The channel with the given id, or None if deleted or forbidden.
+    """
+    
+    if (entry := _channels.get(chat_id)) and entry[1] > monotonic():
+        _channels.move_to_end(chat_id)
+        _channel_cache.inc("hit" if entry[0] else "negative_hit")
+        return entry[0]
+    
+    _channel_cache.inc("miss")
+    
+    # Looking channels up in the gateway's cache goes through every server
+    if channel := discord_bot.bot.get_channel(chat_id):
+        _store_channel(chat_id, channel, CHANNEL_TTL)
+        return channel
+    
+    # Concurrent lookups share the same fetch
+    if not (fetching := _fetching.get(chat_id)):
+        fetching = _fetching[chat_id] = asyncio.ensure_future(_fetch_channel(chat_id))
+        fetching.add_done_callback(lambda _: _fetching.pop(chat_id, None))
+    
+    return await asyncio.shield(fetching)
+
+
+async def _get_parent(thread: discord.Thread) -> Optional[Channel]:
+    """
+    The thread's parent channel, or None (logging it) if not found.
+    """
+    
+    # Without the gateway (as in the shards' workers) it's never cached
+    if not (parent := thread.parent or await get_channel(thread.parent_id)):
+        print(f"Couldn't find the parent channel {thread.parent_id} of thread {thread.id}.")
+    
+    return parent
+
+
+def invalidate_channel(channel_id: int) -> None:
+    _channels.pop(channel_id, None)
+
+
+def invalidate_guild_channels(guild_id: int) -> None:
+    for channel_id, (channel, _) in list(_channels.items()):
+        if getattr(channel, "guild", None) and channel.guild.id == guild_id: # type: ignore
+            del _channels[channel_id]
+
+
+def invalidate_webhook(channel_id: int) -> None:
+    _webhooks.pop(channel_id, None)
 
 
 async def get_or_create_webhook(
-    channel: Union[
-        discord.TextChannel,
-        discord.VoiceChannel,
-        discord.StageChannel
-    ]
+    channel: WebhookChannel,
+    priority: Priority = Priority.BULK
 ) -> discord.Webhook:
-    webhooks: list[discord.Webhook] = await channel.webhooks()
+    if webhook := _webhooks.get(channel.id):
+        _webhook_cache.inc("hit")
+        return webhook
+    
+    _webhook_cache.inc("miss")
+    
+    webhooks: list[discord.Webhook] = await schedule_discord(
+        channel.id,
+        channel.webhooks,
+        priority
+    )
     webhook: discord.Webhook
     
     # If our webhook is not present, create it
@@ -28,15 +147,86 @@ async def get_or_create_webhook(
         if webhook.name == "telegram":
             break
     else:
-        webhook = await channel.create_webhook(
-            name="telegram"
+        webhook = await schedule_discord(
+            channel.id,
+            lambda: channel.create_webhook(
+                name="telegram"
+            ),
+            priority
         )
     
     # Get a partial webhook from the first webhook of the list
-    return discord.Webhook.from_url(
+    _webhooks[channel.id] = discord.Webhook.from_url(
         webhook.url,
         client=discord_bot.bot
     )
+    
+    return _webhooks[channel.id]
+
+
+async def _call_webhook(
+    channel: WebhookChannel,
+    call: Callable[[discord.Webhook], Awaitable[T]],
+    priority: Priority
+) -> T:
+    """
+    Run call(webhook) with the channel's webhook,
+    getting a new one if the cached one was deleted.
+    """
+    
+    for retry in (False, True):
+        with tracing.span("get_or_create_webhook"):
+            webhook: discord.Webhook = await get_or_create_webhook(channel, priority)
+        
+        try:
+            return await schedule_discord(
+                channel.id,
+                lambda: call(webhook),
+                priority,
+                webhook=True
+            )
+        except discord.NotFound as error:
+            if error.code != UNKNOWN_WEBHOOK or retry:
+                raise
+            
+            invalidate_webhook(channel.id)
+    
+    raise RuntimeError("Unreachable")
+
+
+def _get_media_link(media: Media, reason: str = "too large to forward") -> str:
+    """
+    What's sent instead of a file that can't be uploaded.
+    """
+    
+    if media.message_url:
+        return f"\n-# [{media.file_name}](<{media.message_url}>) ({reason})"
+    
+    return f"\n-# {media.file_name} ({reason})"
+
+
+async def _send_with_media(
+    send: Callable[[str, Sequence[Media]], Awaitable[T]],
+    text: str,
+    media: Sequence[Media]
+) -> T:
+    """
+    Run send(text, media), again without any file
+    that couldn't be downloaded (linked to instead).
+    """
+    
+    while True:
+        try:
+            return await send(text, media)
+        except upload_media.DownloadFailed as failed:
+            # Not the error itself: its url has the bot's token
+            print(
+                f"Couldn't download {failed.media.file_name} "
+                f"({type(failed.__cause__).__name__}), linking to it instead."
+            )
+            upload_media.files.inc("failed")
+            text += _get_media_link(failed.media, "couldn't be forwarded")
+            media = [item for item in media if item is not failed.media]
 
 
 async def send_webhook_message(
@@ -48,58 +238,124 @@ async def send_webhook_message(
         discord.Message,
         discord.MessageReference,
         discord.PartialMessage
-    ]] = None
-) -> list[Union[discord.Message, discord.WebhookMessage]]:
-    thread_name: str = discord.utils.MISSING
+    ]] = None,
+    priority: Priority = Priority.BULK,
+    media: Sequence[Media] = ()
+) -> list[Union[discord.Message, discord.WebhookMessage, discord.PartialMessage]]:
+    """
+    Send the text, split in as many messages as needed,
+    with the media (if any) attached to the first one.
+    """
+    
+    thread: discord.abc.Snowflake = discord.utils.MISSING
     
     # Get the channel the message has to be sent
-    match channel := await get_channel(chat_id):
+    with tracing.span("get_channel"):
+        channel = await get_channel(chat_id)
+    
+    # Too large files are linked to instead, as are
+    # the ones past what the whole message can take
+    if media and channel:
+        budget: int = upload_media.get_upload_limit(channel) # type: ignore
+        uploaded: list[Media] = []
+        
+        for item in media:
+            if upload_media.fits(item, budget):
+                uploaded.append(item)
+                budget -= item.file_size # type: ignore
+            else:
+                upload_media.files.inc("linked")
+                text += _get_media_link(item)
+        
+        media = uploaded
+    
+    match channel:
         # You can't send messages to categories or if the message was not found
         case discord.CategoryChannel() | None:
             return []
         
         # If the channel is a thread, take his parent
         case discord.Thread():
-            thread_name = channel.name
-            if not (channel := channel.parent):
+            thread = channel
+            if not (channel := await _get_parent(channel)):
                 return []
         
         # If a DM or a group, send the message regularly without webhooks
         case discord.abc.PrivateChannel():
-            return [
-                await channel.send( # type: ignore
-                    content=content,
-                    reference=reference
-                )
-                for content in wrap(
+            async def send_channel(
+                text: str,
+                media: Sequence[Media]
+            ) -> list[Union[discord.Message, discord.PartialMessage]]:
+                contents: list[str] = wrap(
                     text=f"### {telegram_user.full_name}\n{text}",
                     width=DISCORD_MESSAGE_LENGTH_LIMIT,
                     break_long_words=False,
                     replace_whitespace=False
                 )
-            ]
+                
+                return [
+                    await schedule_discord(
+                        channel.id,
+                        lambda: upload_media.send_channel_media(
+                            channel, # type: ignore
+                            content,
+                            media
+                        )
+                        if media and i == 0
+                        else channel.send( # type: ignore
+                            content=content,
+                            reference=reference
+                        ),
+                        priority
+                    )
+                    for i, content in enumerate(contents)
+                ]
+            
+            return await _send_with_media(send_channel, text, media) # type: ignore
             
     
     # You can't send messages to forums (as a channel) either
     if isinstance(channel, discord.channel.ForumChannel):
         return []
     
-    # For any other type, continue from here instead
-    return [
-        await (await get_or_create_webhook(channel)).send(
-            content=content,
-            username=f"{telegram_user.full_name} (from Telegram)",
-            avatar_url=avatar_url or discord.utils.MISSING,
-            thread_name=thread_name,
-            wait=True
-        )
-        for content in wrap(
-            text=text,
-            width=DISCORD_MESSAGE_LENGTH_LIMIT,
-            break_long_words=False,
-            replace_whitespace=False
-        )
-    ]
+    username: str = f"{telegram_user.full_name} (from Telegram)"
+    
+    # For any other type, continue from here instead.
+    # A file alone still needs a message to go with.
+    async def send_webhook(
+        text: str,
+        media: Sequence[Media]
+    ) -> list[Union[discord.WebhookMessage, discord.PartialMessage]]:
+        return [
+            await _call_webhook(
+                channel, # type: ignore
+                lambda webhook: upload_media.send_webhook_media(
+                    webhook,
+                    thread or channel, # type: ignore
+                    content,
+                    username,
+                    avatar_url,
+                    media
+                )
+                if media and i == 0
+                else webhook.send(
+                    content=content,
+                    username=username,
+                    avatar_url=avatar_url or discord.utils.MISSING,
+                    thread=thread,
+                    wait=True
+                ),
+                priority
+            )
+            for i, content in enumerate(wrap(
+                text=text,
+                width=DISCORD_MESSAGE_LENGTH_LIMIT,
+                break_long_words=False,
+                replace_whitespace=False
+            ) or [""])
+        ]
+    
+    return await _send_with_media(send_webhook, text, media) # type: ignore
 
 
 async def edit_webhook_message(
@@ -109,15 +365,25 @@ async def edit_webhook_message(
     text: str,
     first_call: bool
 ) -> Optional[Union[discord.Message, discord.WebhookMessage]]:
+    """
+    Edit a forwarded message by its id, without fetching it first.
+    """
+    
+    thread: discord.abc.Snowflake = discord.utils.MISSING
+    
     # Get the channel the message has to be sent
-    match channel := await get_channel(chat_id):
+    with tracing.span("get_channel"):
+        channel = await get_channel(chat_id)
+    
+    match channel:
         # This shouldn't be the case in the first place
         case discord.CategoryChannel() | None:
             return
         
         # If the channel is a thread, take his parent
         case discord.threads.Thread():
-            if not (channel := channel.parent):
+            thread = channel
+            if not (channel := await _get_parent(channel)):
                 return
         
         case discord.ForumChannel():
@@ -125,12 +391,16 @@ async def edit_webhook_message(
         
         # If a DM or a group, edit the message regularly without webhooks
         case discord.abc.PrivateChannel():
-            return await (await channel.fetch_message(message_id)).edit( # type: ignore
-                content=(
-                    f"### {telegram_user.full_name}\n{text}"
-                    if first_call
-                    else text
-                )
+            return await schedule_discord(
+                channel.id,
+                lambda: channel.get_partial_message(message_id).edit( # type: ignore
+                    content=(
+                        f"### {telegram_user.full_name}\n{text}"
+                        if first_call
+                        else text
+                    )
+                ),
+                Priority.INTERACTIVE
             )
     
     # You can't send messages to forums (as a channel) either
@@ -138,37 +408,56 @@ async def edit_webhook_message(
         return
     
     # For any other type, continue from here instead
-    
-    return await (
-        await (
-            await get_or_create_webhook(channel)
-        ).fetch_message(message_id)
-    ).edit(content=text)
+    return await _call_webhook(
+        channel,
+        lambda webhook: webhook.edit_message(
+            message_id,
+            content=text,
+            thread=thread
+        ),
+        Priority.INTERACTIVE
+    )
 
 
 async def delete_webhook_messages(
     chat_id: int,
     message_ids: list[int],
 ) -> None:
+    """
+    Delete forwarded messages by their ids, without fetching them first.
+    """
+    
+    thread: discord.abc.Snowflake = discord.utils.MISSING
     
     # Get the channel the message has to be deleted
-    match channel := await get_channel(chat_id):
+    with tracing.span("get_channel"):
+        channel = await get_channel(chat_id)
+    
+    match channel:
         # This shouldn't be the case in the first place
         case discord.CategoryChannel() | None:
             return
         
-        # If the channel is a thread, take his parent
+        # Threads are deleted from directly, but use their parent's webhook
         case discord.threads.Thread():
-            if not (channel := channel.parent):
+            thread = channel
+            if not (channel := await _get_parent(channel)):
                 return
         
         case discord.ForumChannel():
             pass
 
-        # If a DM or a group, delete the message regularly
+        # If a DM or a group, delete the messages regularly.
+        # There's no bulk delete here, so queue them all at once instead
         case discord.abc.PrivateChannel():
-            for message_id in message_ids:
-                await (await channel.fetch_message(message_id)).delete() # type: ignore
+            await asyncio.gather(*(
+                schedule_discord(
+                    channel.id,
+                    channel.get_partial_message(message_id).delete, # type: ignore
+                    Priority.INTERACTIVE
+                )
+                for message_id in message_ids
+            ))
                 
             return
     
@@ -176,7 +465,30 @@ async def delete_webhook_messages(
     if isinstance(channel, discord.ForumChannel):
         return
     
-    await channel.delete_messages([
-        channel.get_partial_message(message_id)
-        for message_id in message_ids
-    ])
\ No newline at end of file
+    messageable: Union[WebhookChannel, discord.Thread] = \
+        thread if isinstance(thread, discord.Thread) else channel
+    
+    try:
+        await schedule_discord(
+            channel.id,
+            lambda: messageable.delete_messages([
+                messageable.get_partial_message(message_id)
+                for message_id in message_ids
+            ]),
+            Priority.INTERACTIVE
+        )
+    except discord.Forbidden:
+        # Without the permission to manage messages,
+        # the webhook can still delete its own ones
+        await asyncio.gather(*(
+            _call_webhook(
+                channel,
+                lambda webhook, message_id=message_id: \
+                    webhook.delete_message(
+                        message_id,
+                        thread=thread
+                    ),
+                Priority.INTERACTIVE
+            )
+            for message_id in message_ids
+        ))
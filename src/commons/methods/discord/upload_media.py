@@ -0,0 +1,211 @@
+import aiohttp, asyncio, discord
+from aiohttp.payload import AsyncIterablePayload
+from typing import Any, AsyncIterable, AsyncIterator, Optional, Sequence, Union
+from tokens import DISCORD_TOKEN
+from gvars import MEDIA_CHUNK_SIZE, MEDIA_UPLOAD_CONCURRENCY
+from limits import DISCORD_UPLOAD_LIMIT
+from ... import metrics
+from ..telegram.get_media import Media
+
+Messageable = Union[
+    discord.TextChannel,
+    discord.VoiceChannel,
+    discord.StageChannel,
+    discord.Thread,
+    discord.DMChannel,
+    discord.GroupChannel
+]
+
+# Shared by the downloads and the uploads
+_session: Optional[aiohttp.ClientSession] = None
+# Each upload holds about a chunk (and the sockets' buffers), whatever the file's size
+_uploads: asyncio.Semaphore = asyncio.Semaphore(MEDIA_UPLOAD_CONCURRENCY)
+files = metrics.Counter(
+    "bridge_media_total",
+    "Files sent to Discord: uploaded, or linked to when too large or failed to download.",
+    ("result",)
+)
+
+
+class DownloadFailed(Exception):
+    """
+    A file couldn't be downloaded from Telegram, failing its whole upload.
+    """
+
+    def __init__(self, media: Media) -> None:
+        super().__init__(media.file_name)
+        self.media = media
+
+
+class _StreamPayload(AsyncIterablePayload):
+    """
+    An async iterable of a known size, so the upload
+    has a Content-Length instead of being chunked.
+    """
+
+    def __init__(self, value: AsyncIterable[bytes], size: int, **kwargs: Any) -> None:
+        super().__init__(value, **kwargs)
+        self._size = size
+
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+
+    if not _session or _session.closed:
+        _session = aiohttp.ClientSession()
+
+    return _session
+
+
+async def close() -> None:
+    if _session:
+        await _session.close()
+
+
+def get_upload_limit(channel: Optional[Messageable]) -> int:
+    """
+    The most, in bytes, that can be uploaded into the channel
+    with a message (all its files together).
+    """
+
+    guild: Optional[discord.Guild] = getattr(channel, "guild", None)
+
+    # discord.py still reports the old limit for servers without boosts
+    return max(DISCORD_UPLOAD_LIMIT, guild.filesize_limit) \
+    if guild and guild.premium_tier >= 2 else DISCORD_UPLOAD_LIMIT
+
+
+def fits(media: Media, limit: int) -> bool:
+    """
+    Whether the file can be downloaded and uploaded.
+    """
+
+    return media.file_url is not None \
+    and media.file_size is not None and media.file_size <= limit
+
+
+async def _raise_for_status(response: aiohttp.ClientResponse) -> None:
+    if response.status < 400:
+        return
+
+    data: Union[dict[str, Any], str] = await response.json() \
+    if response.content_type == "application/json" else await response.text()
+
+    match response.status:
+        case 403:
+            raise discord.Forbidden(response, data) # type: ignore
+        case 404:
+            raise discord.NotFound(response, data) # type: ignore
+        case _:
+            raise discord.HTTPException(response, data) # type: ignore
+
+
+async def _download(media: Media) -> AsyncIterator[bytes]:
+    """
+    The file's chunks, only requested once the upload gets to it.
+    """
+
+    try:
+        async with _get_session().get(media.file_url) as download: # type: ignore
+            download.raise_for_status()
+
+            async for chunk in download.content.iter_chunked(MEDIA_CHUNK_SIZE):
+                yield chunk
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        raise DownloadFailed(media) from error
+
+
+async def _upload(
+    url: str,
+    payload: dict[str, Any],
+    media: Sequence[Media],
+    headers: Optional[dict[str, str]] = None
+) -> dict[str, Any]:
+    """
+    Stream the files from Telegram into a new message, one after
+    the other and a chunk at a time. Their sizes must be known.
+    Raises DownloadFailed if one of them can't be downloaded.
+    """
+
+    payload["attachments"] = [
+        {"id": i, "filename": item.file_name}
+        for i, item in enumerate(media)
+    ]
+    form: aiohttp.MultipartWriter = aiohttp.MultipartWriter("form-data")
+    form.append_json(payload).set_content_disposition(
+        "form-data",
+        name="payload_json"
+    )
+
+    for i, item in enumerate(media):
+        form.append_payload(_StreamPayload(
+            _download(item),
+            item.file_size, # type: ignore
+            content_type=item.mime_type
+        )).set_content_disposition(
+            "form-data",
+            name=f"files[{i}]",
+            filename=item.file_name
+        )
+
+    try:
+        async with _uploads, _get_session().post(url, data=form, headers=headers) as response:
+            await _raise_for_status(response)
+            files.inc("uploaded", amount=len(media))
+
+            return await response.json()
+    except aiohttp.ClientError as error:
+        # The failed download aborted the upload: tell which one it was
+        if isinstance(error.__cause__, DownloadFailed):
+            raise error.__cause__ from error.__cause__.__cause__
+
+        raise
+
+
+async def send_webhook_media(
+    webhook: discord.Webhook,
+    channel: Union[discord.TextChannel, discord.VoiceChannel, discord.StageChannel, discord.Thread],
+    content: str,
+    username: str,
+    avatar_url: Optional[str],
+    media: Sequence[Media]
+) -> discord.PartialMessage:
+    """
+    Send a message with the files through the webhook, into channel (or its thread).
+    """
+
+    url: str = f"{discord.http.Route.BASE}/webhooks/{webhook.id}/{webhook.token}?wait=true"
+
+    if isinstance(channel, discord.Thread):
+        url += f"&thread_id={channel.id}"
+
+    data: dict[str, Any] = await _upload(
+        url,
+        {
+            "content": content,
+            "username": username,
+            **({"avatar_url": avatar_url} if avatar_url else {})
+        },
+        media
+    )
+
+    return channel.get_partial_message(int(data["id"]))
+
+
+async def send_channel_media(
+    channel: Union[discord.DMChannel, discord.GroupChannel],
+    content: str,
+    media: Sequence[Media]
+) -> discord.PartialMessage:
+    """
+    Send a message with the files as the bot, for DMs and groups.
+    """
+
+    data: dict[str, Any] = await _upload(
+        f"{discord.http.Route.BASE}/channels/{channel.id}/messages",
+        {"content": content},
+        media,
+        {"Authorization": f"Bot {DISCORD_TOKEN}"}
+    )
+
+    return discord.PartialMessage(channel=channel, id=int(data["id"]))
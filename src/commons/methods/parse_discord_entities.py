@@ -1,11 +1,11 @@
 # pip install git+https://github.com/david-why/discord-markdown-ast-parser.git#egg=discord-markdown-ast-parser
-import re
 from discord_markdown_ast_parser import parse
 from discord_markdown_ast_parser.parser import Node, NodeType
 from aiogram.types import MessageEntity, LinkPreviewOptions
 from aiogram.enums.message_entity_type import MessageEntityType
+from bisect import bisect_right
+from itertools import accumulate
 from typing import Optional
-from textwrap import wrap
 from limits import TELEGRAM_MESSAGE_LENGTH_LIMIT
 
 TelegramContents = tuple[str, list[MessageEntity], LinkPreviewOptions]
@@ -25,39 +25,104 @@ TelegramContents = tuple[str, list[MessageEntity], LinkPreviewOptions]
 # || are not supported by Telegram anyway, so there's nothing to fix
 
 
-def _parse_nodes(offset: int, nodes: list[Node]) -> TelegramContents:
-    link_preview_options: LinkPreviewOptions = LinkPreviewOptions()
-    text_link_without_preview: bool = False
+# Entities are built as [type, offset, length, url, language]
+# and only turned into MessageEntity once their offsets are final
+_RawEntity = list
+
+_MODIFIERS: dict[NodeType, MessageEntityType] = {
+    NodeType.ITALIC: MessageEntityType.ITALIC,
+    NodeType.BOLD: MessageEntityType.BOLD,
+    NodeType.UNDERLINE: MessageEntityType.UNDERLINE,
+    NodeType.STRIKETHROUGH: MessageEntityType.STRIKETHROUGH,
+    NodeType.SPOILER: MessageEntityType.SPOILER,
+    NodeType.QUOTE_BLOCK: MessageEntityType.BLOCKQUOTE,
+    NodeType.CODE_INLINE: MessageEntityType.CODE,
+    NodeType.CODE_BLOCK: MessageEntityType.PRE
+}
+
+
+class _Text:
+    """
+    The text of a single nesting level, joined only once at the end.
+    Keeps track of the last backslash and newlines,
+    so it knows if it ends in an escape without scanning itself.
+    """
     
-    markdownless_text: str = ""
-    entities: list[MessageEntity] = []
-    deferred_cursor: int = 0
+    def __init__(self) -> None:
+        self.parts: list[str] = []
+        self.length: int = 0
+        self.last_backslash: int = -1
+        # The last two newlines, the last one at the end
+        self.newlines: tuple[int, int] = (-1, -1)
+    
+    def append(self, text: str) -> None:
+        if not text:
+            return
+        
+        if (backslash := text.rfind("\\")) != -1:
+            self.last_backslash = self.length + backslash
+        
+        if (newline := text.rfind("\n")) != -1:
+            previous: int = text.rfind("\n", 0, newline)
+            
+            self.newlines = (
+                self.length + previous if previous != -1 else self.newlines[1],
+                self.length + newline
+            )
+        
+        self.parts.append(text)
+        self.length += len(text)
+    
+    def ends_with(self, character: str) -> bool:
+        return bool(self.parts) and self.parts[-1][-1] == character
     
+    def is_escaped(self) -> bool:
+        """
+        Same as re.search(r"\\\\(.*)\\\\?$", text):
+        a backslash with no newline after it, other than a final one.
+        """
+        
+        if self.last_backslash == -1:
+            return False
+        
+        if self.newlines[1] == self.length - 1:
+            return self.newlines[0] < self.last_backslash
+        
+        return self.newlines[1] < self.last_backslash
     
-    def append(
-        results: TelegramContents,
-        type: MessageEntityType,
-        *,
-        url: Optional[str] = None,
-        language: Optional[str] = None
-    ) -> None:
-        nonlocal markdownless_text, entities, deferred_cursor
-
-        deferred_cursor = len(markdownless_text)
-
-        # Handle escaping TODO
-        if not re.subn(r"\\(.*)\\?$", r"\1", markdownless_text, flags=re.NOFLAG)[1]:
-            entities.append(MessageEntity(
-                type=type,
-                offset=offset + deferred_cursor,
-                length=len(results[0]),
-                url=url,
-                language=language
-            ))
+    def cut_link(self, cursor: int) -> None:
+        """
+        Remove the "[" at the cursor and the "](" at the end.
+        Rare enough that rebuilding the whole level is fine.
+        """
         
-        markdownless_text += results[0]
-        entities.extend(results[1])
+        text: str = self.join()
         
+        self.__init__()
+        self.append(text[:cursor] + text[cursor + 1:-2])
+    
+    def join(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        
+        return self.parts[0] if self.parts else ""
+
+
+def _parse_nodes(
+    offset: int,
+    nodes: list[Node],
+    text: _Text,
+    entities: list[_RawEntity]
+) -> Optional[bool]:
+    """
+    Append the text of the nodes to this level's text,
+    and their entities to the entities, in a single pass.
+    Returns whether the last link had its preview disabled, if any.
+    """
+    
+    link_preview_disabled: Optional[bool] = None
+    text_link_without_preview: bool = False
+    deferred_cursor: int = 0
     
     for node in nodes:
         if text_link_without_preview: # damn library bugs...
@@ -66,137 +131,216 @@ def _parse_nodes(offset: int, nodes: list[Node]) -> TelegramContents:
         
         match node.node_type:
             case NodeType.TEXT if node.text_content:
-                markdownless_text += node.text_content
+                text.append(node.text_content)
+            
+            case node_type if node_type in _MODIFIERS and node.children:
+                deferred_cursor = text.length
                 
-            case NodeType.ITALIC if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.ITALIC
-                )
+                # Handle escaping TODO
+                entity: Optional[_RawEntity] = None if text.is_escaped() else [
+                    _MODIFIERS[node_type],
+                    offset + deferred_cursor,
+                    0,
+                    None,
+                    node.code_lang
+                ]
                 
-            case NodeType.BOLD if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.BOLD
-                )
+                if entity:
+                    entities.append(entity)
                 
-            case NodeType.UNDERLINE if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.UNDERLINE
+                # As before, only blockquotes move their children's offsets
+                children: _Text = _Text()
+                _parse_nodes(
+                    offset=offset + text.length
+                    if node_type is NodeType.QUOTE_BLOCK
+                    else offset,
+                    nodes=node.children,
+                    text=children,
+                    entities=entities
                 )
                 
-            case NodeType.STRIKETHROUGH if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.STRIKETHROUGH
-                )
-            
-            case NodeType.SPOILER if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.SPOILER
-                )
+                if entity:
+                    entity[2] = children.length
+                
+                text.append(children.join())
+                
+            case NodeType.URL_WITH_PREVIEW | NodeType.URL_WITHOUT_PREVIEW \
+            if node.url:
+                with_preview: bool = node.node_type is NodeType.URL_WITH_PREVIEW
                 
-            case NodeType.URL_WITH_PREVIEW if node.url:
-                # If the link is not in a markdown...
-                if not markdownless_text or markdownless_text[-1] != "(":
-                    markdownless_text += node.url
-                else:
-                    # Remove the parenthesis ( "[.*](" )
-                    # Probably an oversight by the developer of the library
-                    markdownless_text = \
-                        markdownless_text[:deferred_cursor] + \
-                        markdownless_text[deferred_cursor + 1:-2]
-                        
-                    entities.append(MessageEntity(
-                        type=MessageEntityType.TEXT_LINK,
-                        offset=offset + deferred_cursor,
-                        length=len(markdownless_text) - deferred_cursor,
-                        url=node.url[:-1] # remove ) from the URL; another oversight
-                    ))
-                    
-                link_preview_options = LinkPreviewOptions(
-                    is_disabled=False
-                )
-            
-            case NodeType.URL_WITHOUT_PREVIEW if node.url:
                 # If the link is not in a markdown...
-                if not markdownless_text or markdownless_text[-1] != "(":
-                    markdownless_text += node.url
+                if not text.ends_with("("):
+                    text.append(node.url)
                 else:
                     # Remove the parenthesis ( "[.*](" )
                     # Probably an oversight by the developer of the library
-                    markdownless_text = \
-                        markdownless_text[:deferred_cursor] + \
-                        markdownless_text[deferred_cursor + 1:-2]
+                    text.cut_link(deferred_cursor)
                     
-                    entities.append(MessageEntity(
-                        type=MessageEntityType.TEXT_LINK,
-                        offset=offset + deferred_cursor,
-                        length=len(markdownless_text) - deferred_cursor,
-                        url=node.url # here the oversight is moved
-                    ))
+                    entities.append([
+                        MessageEntityType.TEXT_LINK,
+                        offset + deferred_cursor,
+                        text.length - deferred_cursor,
+                        # With a preview, ) ends up in the URL; without
+                        # one, it ends up in the next node, which is skipped
+                        node.url[:-1] if with_preview else node.url,
+                        None
+                    ])
                     
-                    text_link_without_preview = True # remove ) from the URL next iteration
+                    text_link_without_preview = not with_preview
                 
-                link_preview_options = LinkPreviewOptions(
-                    is_disabled=True
-                )
-                
-            case NodeType.QUOTE_BLOCK if node.children:
-                append(
-                    results=_parse_nodes(
-                        offset=offset + len(markdownless_text),
-                        nodes=node.children
-                    ),
-                    type=MessageEntityType.BLOCKQUOTE
-                )
-            
-            case NodeType.CODE_INLINE if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.CODE
-                )
-            
-            case NodeType.CODE_BLOCK if node.children:
-                append(
-                    results=_parse_nodes(offset, node.children),
-                    type=MessageEntityType.PRE,
-                    language=node.code_lang
-                )
+                link_preview_disabled = not with_preview
+    
+    return link_preview_disabled
+
 
-    return markdownless_text, entities, link_preview_options
+def _get_utf16_positions(text: str) -> Optional[list[int]]:
+    """
+    Telegram counts offsets in UTF-16 code units:
+    characters outside of the BMP (most emojis) count as two.
+    Returns the UTF-16 position of every character (and of the end),
+    or None if they are the same as the characters' indexes.
+    """
+    
+    if text.isascii() or len(text.encode("utf-16-le")) == 2 * len(text):
+        return None
+    
+    return list(accumulate(
+        (2 if ord(character) > 0xFFFF else 1 for character in text),
+        initial=0
+    ))
+
+
+def _to_utf16(text: str, entities: list[_RawEntity]) -> list[MessageEntity]:
+    positions: Optional[list[int]] = _get_utf16_positions(text)
+    
+    def convert(index: int) -> int:
+        return positions[min(max(index, 0), len(text))] if positions else index
+    
+    return [
+        MessageEntity(
+            type=type,
+            offset=convert(offset),
+            length=convert(offset + length) - convert(offset),
+            url=url,
+            language=language
+        )
+        for type, offset, length, url, language in entities
+    ]
 
 
 def parse_markdown(offset: int, text: str) -> TelegramContents:
-    return _parse_nodes(offset, parse(text[offset:]))
+    """
+    Parse the text after the offset, which is kept as is.
+    Returns the parsed text (without the first offset characters),
+    its entities (counting those too) and the link preview options.
+    """
+    
+    parsed_text: _Text = _Text()
+    entities: list[_RawEntity] = []
+    
+    link_preview_disabled: Optional[bool] = _parse_nodes(
+        offset=offset,
+        nodes=parse(text[offset:]),
+        text=parsed_text,
+        entities=entities
+    )
+    markdownless_text: str = parsed_text.join()
+    
+    return (
+        markdownless_text,
+        _to_utf16(text[:offset] + markdownless_text, entities),
+        LinkPreviewOptions(is_disabled=link_preview_disabled)
+        if link_preview_disabled is not None
+        else LinkPreviewOptions()
+    )
+
+
+def _split(
+    text: str,
+    positions: Optional[list[int]],
+    limit: int
+) -> list[tuple[int, int]]:
+    """
+    Split the text in (start, end) chunks of at most limit UTF-16 units,
+    preferably on newlines, then on spaces (which are dropped).
+    """
+    
+    chunks: list[tuple[int, int]] = []
+    start: int = 0
+    
+    while start < len(text):
+        # The furthest character that still fits
+        end: int = min(
+            len(text),
+            bisect_right(positions, positions[start] + limit) - 1
+            if positions
+            else start + limit
+        )
+        next_start: int = end
+        
+        if end < len(text):
+            # Don't give up more than half of the chunk for a newline
+            if (cut := text.rfind("\n", start + (end - start) // 2, end + 1)) != -1 \
+            or (cut := text.rfind(" ", start + 1, end + 1)) != -1:
+                end, next_start = cut, cut + 1
+        
+        chunks.append((start, end))
+        start = next_start
+    
+    return chunks
 
 
 def get_entities_wrapped(
     suffix: str,
     text: str
 ) -> tuple[list[str], list[list[MessageEntity]], LinkPreviewOptions]:
-    wrapped_text: list[str] = []
-    entities: list[list[MessageEntity]] = []
-    link_preview_options: LinkPreviewOptions = LinkPreviewOptions()
-    
-    for i, content in enumerate(
-        iterable=wrap(
-            suffix + text,
-            TELEGRAM_MESSAGE_LENGTH_LIMIT,
-            break_long_words=False,
-            replace_whitespace=False
-        ),
-        start=0
-    ):
-        results: TelegramContents = parse_markdown(
-            offset=len(suffix) if i == 0 else 0,
-            text=content
-        )
+    """
+    Parse the text once, then split it (and its entities)
+    in messages that fit in Telegram's limit.
+    The suffix is put before the text, as is.
+    """
+    
+    markdownless_text, entities, link_preview_options = parse_markdown(
+        offset=len(suffix),
+        text=suffix + text
+    )
+    full_text: str = suffix + markdownless_text
+    positions: Optional[list[int]] = _get_utf16_positions(full_text)
+    
+    chunks: list[tuple[int, int]] = _split(
+        full_text,
+        positions,
+        TELEGRAM_MESSAGE_LENGTH_LIMIT
+    )
+    # Entities count in UTF-16 units
+    bounds: list[tuple[int, int]] = [
+        (positions[start], positions[end]) if positions else (start, end)
+        for start, end in chunks
+    ]
+    starts: list[int] = [start for start, _ in bounds]
+    wrapped_entities: list[list[MessageEntity]] = [[] for _ in chunks]
+    
+    # Clip every entity to the chunks it spans, counting from their start
+    for entity in entities:
+        entity_end: int = entity.offset + entity.length
         
-        wrapped_text.append((suffix + results[0]) if i == 0 else results[0])
-        entities.append(results[1])
-        link_preview_options = results[2]
-
-    return wrapped_text, entities, link_preview_options
+        for i in range(
+            max(0, bisect_right(starts, entity.offset) - 1),
+            len(bounds)
+        ):
+            start, end = bounds[i]
+            
+            if start >= entity_end:
+                break
+            
+            if (length := min(end, entity_end) - max(start, entity.offset)) > 0:
+                wrapped_entities[i].append(entity.model_copy(update={
+                    "offset": max(start, entity.offset) - start,
+                    "length": length
+                }))
+    
+    return (
+        [full_text[start:end] for start, end in chunks],
+        wrapped_entities,
+        link_preview_options
+    )
@@ -1,8 +1,41 @@
+import re
 from aiogram.types import MessageEntity
 from aiogram.enums.message_entity_type import MessageEntityType
-from discord.utils import escape_markdown
 from typing import Optional
 
+# Anything Discord's markdown could pick up: a backslash before it
+# is always rendered as the character alone, so everything is escaped
+_MARKDOWN: re.Pattern[str] = re.compile(
+    r"[\\*_~`|\[\]]|^[ \t]*[-#>]",
+    re.MULTILINE
+)
+
+# (opener, closer) for the entities that just wrap their text
+_MARKERS: dict[MessageEntityType, tuple[str, str]] = {
+    MessageEntityType.BOLD: ("**", "**"),
+    MessageEntityType.ITALIC: ("_", "_"),
+    MessageEntityType.UNDERLINE: ("__", "__"),
+    MessageEntityType.STRIKETHROUGH: ("~~", "~~"),
+    MessageEntityType.SPOILER: ("||", "||"),
+    MessageEntityType.CODE: ("`", "`")
+}
+
+_BLOCKQUOTES: tuple[MessageEntityType, ...] = (
+    MessageEntityType.BLOCKQUOTE,
+    MessageEntityType.EXPANDABLE_BLOCKQUOTE
+)
+
+# Their text is written as is
+_VERBATIM: tuple[MessageEntityType, ...] = (
+    MessageEntityType.CODE,
+    MessageEntityType.PRE,
+    MessageEntityType.URL
+)
+
+
+def _escape(text: str) -> str:
+    return _MARKDOWN.sub(lambda match: f"{match[0][:-1]}\\{match[0][-1]}", text)
+
 
 def parse_markdown(
     original_text: str,
@@ -10,75 +43,96 @@ def parse_markdown(
     disable_link_preview: bool = False
 ) -> str:
     if not entities:
-        return escape_markdown(original_text, ignore_links=False)
-    
-    markdown_text: str = ""
-    cursor: int = 0 # Always moved to the end of each entity
-    blockquote_end: int = 0
-    
-    for entity in entities:
-        entity_end: int = entity.offset + entity.length
-        
-        text_slice: str = ""
-        if cursor >= blockquote_end: # Not inside a blockquote
-            text_slice += original_text[cursor:entity.offset]
-        else:
-            text_slice = original_text[
-                cursor:(
-                    entity.offset
-                    if entity.offset < blockquote_end # Next entity starts inside blockquote
-                    else blockquote_end # Include all inside the blockquote
-                )
-            ].replace('\n', "\n> ")
-            text_slice += original_text[blockquote_end:entity.offset]
-        
-        text_slice = escape_markdown(text_slice, ignore_links=False)
-        entity_text: str = original_text[entity.offset:entity_end]
+        return _escape(original_text)
+
+    # Telegram counts offsets in UTF-16 code units: characters outside
+    # of the BMP (most emojis) count as two. Only if there are any,
+    # the text is sliced as UTF-16, two bytes per unit
+    utf16_text: Optional[bytes] = original_text.encode("utf-16-le")
+
+    if len(utf16_text) == 2 * len(original_text):
+        utf16_text = None
+
+    def get_text(start: int, end: Optional[int] = None) -> str:
+        if utf16_text is None:
+            return original_text[start:end]
+
+        return utf16_text[
+            2 * start:None if end is None else 2 * end
+        ].decode("utf-16-le", errors="replace")
+
+    # (position, is opener, order, entity): at the same position
+    # entities close before others open, the inner ones first
+    events: list[tuple[int, int, tuple[int, int], MessageEntity]] = []
+
+    for i, entity in enumerate(entities):
+        start: int = entity.offset
+        end: int = entity.offset + entity.length
+
+        events.append((start, 1, (-end, i), entity))
+        events.append((end, 0, (-start, -i), entity))
+
+    events.sort(key=lambda event: event[:3])
+
+    markdown: list[str] = []
+    cursor: int = 0
+    verbatim: int = 0
+    quoted: bool = False
+    # Quoted lines only get their "> " once something is written on them,
+    # so the line right after a blockquote isn't quoted too
+    quote_line_pending: bool = False
+
+    def write(text: str, escape: bool) -> None:
+        nonlocal quote_line_pending
+
+        if not text:
+            return
+
+        if escape:
+            text = _escape(text)
+
+        if quoted:
+            if quote_line_pending:
+                markdown.append("> ")
+
+            text = text.replace("\n", "\n> ")
+
+            if quote_line_pending := text.endswith("\n> "):
+                text = text[:-2]
+
+        markdown.append(text)
+
+    for position, is_opener, _, entity in events:
+        write(get_text(cursor, position), escape=not verbatim)
+        cursor = position
 
         match entity.type:
-            case MessageEntityType.BOLD:
-                text_slice += f"**{entity_text}**"
-            
-            case MessageEntityType.ITALIC:
-                text_slice += f"_{entity_text}_"
-                
-            case MessageEntityType.UNDERLINE:
-                text_slice += f"__{entity_text}__"
-                
-            case MessageEntityType.STRIKETHROUGH:
-                text_slice += f"~~{entity_text}~~"
-                
-            case MessageEntityType.SPOILER:
-                text_slice += f"||{entity_text}||"
-                
-            case MessageEntityType.CODE:
-                text_slice += f"`{entity_text}`"
-            
+            case type if type in _MARKERS:
+                write(_MARKERS[type][not is_opener], escape=False)
+
             case MessageEntityType.PRE:
-                text_slice += f"```{entity.language}\n{entity_text}```"
-                
+                write(
+                    f"```{entity.language or ""}\n" if is_opener else "```",
+                    escape=False
+                )
+
             case MessageEntityType.TEXT_LINK:
-                text_slice += (
-                    f"[{entity_text}](<{entity.url}>)"
-                    if disable_link_preview
-                    else f"[{entity_text}]({entity.url})"
+                write(
+                    "[" if is_opener
+                    else f"](<{entity.url}>)" if disable_link_preview
+                    else f"]({entity.url})",
+                    escape=False
                 )
-            
-            case MessageEntityType.BLOCKQUOTE | \
-            MessageEntityType.EXPANDABLE_BLOCKQUOTE:
-                markdown_text += f"{text_slice}> "
-                
-                blockquote_end = entity_end
-                cursor = entity.offset
-                continue
-            case _:
-                text_slice += entity_text
-
-        markdown_text += text_slice
-        cursor = entity.offset + entity.length
-    else:
-        if blockquote_end:
-            markdown_text += original_text[cursor:blockquote_end].replace('\n', "\n> ")
-            cursor = blockquote_end
-        
-        return markdown_text + original_text[cursor:]
+
+            case MessageEntityType.URL if disable_link_preview:
+                write("<" if is_opener else ">", escape=False)
+
+            case type if type in _BLOCKQUOTES:
+                quoted = quote_line_pending = bool(is_opener)
+
+        if entity.type in _VERBATIM:
+            verbatim += 1 if is_opener else -1
+
+    write(get_text(cursor), escape=not verbatim)
+
+    return "".join(markdown)
@@ -1,29 +1,100 @@
+import asyncio
+from aiogram import Bot
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from aiogram.types import User
+from time import time
 from typing import Optional
 from tokens import TELEGRAM_TOKEN
-from async_lru import alru_cache
+from gvars import AVATAR_TTL, TELEGRAM_API_SERVER
+from limits import TELEGRAM_FILE_LINK_LIFETIME
+from ... import metrics
+from ...database import database
+from ...database.avatars import Avatar
 
+_server: TelegramAPIServer = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) \
+if TELEGRAM_API_SERVER else PRODUCTION
 
-@alru_cache(ttl=60*60*24)
-async def get_avatar(user: User) -> Optional[str]:
-    if not user.bot:
-        return None
+# Users whose avatar is being fetched, so it's only fetched once at a time
+_refreshes: dict[int, asyncio.Task[None]] = {}
+_avatar_cache = metrics.Counter(
+    "bridge_avatar_cache_requests_total",
+    "Avatar lookups: fresh, stale (served, then refreshed), expired or missing.",
+    ("result",)
+)
+
+
+def _get_url(avatar: Avatar) -> Optional[str]:
+    # Discord will download the image from the url and upload
+    # it to their own servers (so the telegram token won't be shared).
+    return _server.file_url(TELEGRAM_TOKEN, avatar.file_path) \
+    if avatar.file_path else None
 
+
+async def _refresh(bot: Bot, user_id: int) -> None:
+    file_unique_id: Optional[str] = None
     file_path: Optional[str] = None
 
     try:
         # Get the profile photos of the user
-        pfps = await user.bot.get_user_profile_photos(user.id, 0, 1)
-        
-        # Get the file from the file id of the current profile picture of the user
-        file_path = (await user.bot.get_file(pfps.photos[0][0].file_id)).file_path
-    except:
-        # If, for any reason that can also be the user not having
-        # set a profile photo, it fails, then return no avatar.
+        pfps = await bot.get_user_profile_photos(user_id, 0, 1)
+
+        if pfps.photos:
+            file_unique_id = pfps.photos[0][0].file_unique_id
+            # Resolved every time: file paths don't last forever,
+            # even if the profile picture didn't change
+            file_path = (await bot.get_file(pfps.photos[0][0].file_id)).file_path
+    except Exception as error:
+        # If it fails, keep the old avatar (if any) and try again
+        # once it goes stale, or on the next message if there's none
+        print(f"Couldn't refresh the avatar of {user_id}: {error!r}")
+        return
+
+    await database.save_avatar(
+        telegram_user_id=user_id,
+        file_unique_id=file_unique_id,
+        file_path=file_path,
+        update_date_unix=int(time())
+    )
+
+
+def _schedule_refresh(bot: Bot, user_id: int) -> asyncio.Task[None]:
+    if not (task := _refreshes.get(user_id)):
+        task = _refreshes[user_id] = asyncio.create_task(_refresh(bot, user_id))
+        task.add_done_callback(lambda _: _refreshes.pop(user_id, None))
+
+    return task
+
+
+async def get_avatar(user: User) -> Optional[str]:
+    """
+    Get the avatar from memory, refreshing it in the background
+    once it's older than AVATAR_TTL.
+    Only users that were never seen before (or not since their
+    avatar's link expired) wait for the Bot API.
+    """
+
+    if not user.bot:
         return None
-    
-    # Return the file path as an URL.
-    # Discord will then download the image from the url and upload
-    # it to their own servers (so the telegram token won't be shared).
-    return f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}" \
-    if file_path else None
+
+    if avatar := database.lookup_avatar(user.id):
+        age: float = time() - avatar.update_date_unix
+
+        if age < AVATAR_TTL:
+            _avatar_cache.inc("hit")
+            return _get_url(avatar)
+
+        # Its link still works while it's refreshed
+        if age < TELEGRAM_FILE_LINK_LIFETIME:
+            _avatar_cache.inc("stale")
+            _schedule_refresh(user.bot, user.id)
+            return _get_url(avatar)
+
+        _avatar_cache.inc("expired")
+    else:
+        _avatar_cache.inc("miss")
+
+    # Shielded, so a cancelled send doesn't cancel it for everyone
+    await asyncio.shield(_schedule_refresh(user.bot, user.id))
+
+    return _get_url(avatar) \
+    if (avatar := database.lookup_avatar(user.id)) else None
@@ -0,0 +1,118 @@
+import aiohttp
+from aiogram import Bot
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import File, Message
+from typing import NamedTuple, Optional
+from tokens import TELEGRAM_TOKEN
+from gvars import TELEGRAM_API_SERVER
+from limits import TELEGRAM_DOWNLOAD_LIMIT
+from ...scheduler import schedule_telegram_file
+
+_server: TelegramAPIServer = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) \
+if TELEGRAM_API_SERVER else PRODUCTION
+
+
+class Media(NamedTuple):
+    file_id: str
+    file_name: str
+    mime_type: str
+    # In bytes, None if Telegram didn't tell
+    file_size: Optional[int]
+    # The original message's, for files that can't be uploaded.
+    # None in private chats and basic groups.
+    message_url: Optional[str]
+    # Where to download it from, with the bot's token: never share it.
+    # None if it's too large to.
+    file_url: Optional[str] = None
+
+
+def find_media(message: Message) -> Optional[Media]:
+    """
+    The file a message carries, if any (the largest size, for photos),
+    without resolving where to download it from.
+    """
+    
+    file_id: str
+    file_name: str
+    mime_type: Optional[str] = None
+    file_size: Optional[int]
+
+    match message:
+        case Message(photo=[*_, photo]):
+            file_id, file_size = photo.file_id, photo.file_size
+            file_name, mime_type = f"{photo.file_unique_id}.jpg", "image/jpeg"
+
+        case Message(video=video) if video:
+            file_id, file_size, mime_type = video.file_id, video.file_size, video.mime_type
+            file_name = video.file_name or f"{video.file_unique_id}.mp4"
+
+        case Message(animation=animation) if animation:
+            file_id, file_size, mime_type = animation.file_id, animation.file_size, animation.mime_type
+            file_name = animation.file_name or f"{animation.file_unique_id}.mp4"
+
+        case Message(audio=audio) if audio:
+            file_id, file_size, mime_type = audio.file_id, audio.file_size, audio.mime_type
+            file_name = audio.file_name or f"{audio.file_unique_id}.mp3"
+
+        case Message(voice=voice) if voice:
+            file_id, file_size = voice.file_id, voice.file_size
+            file_name, mime_type = f"{voice.file_unique_id}.ogg", voice.mime_type
+
+        case Message(video_note=video_note) if video_note:
+            file_id, file_size = video_note.file_id, video_note.file_size
+            file_name, mime_type = f"{video_note.file_unique_id}.mp4", "video/mp4"
+
+        case Message(sticker=sticker) if sticker:
+            file_id, file_size = sticker.file_id, sticker.file_size
+            file_name = f"{sticker.file_unique_id}." + (
+                "webm" if sticker.is_video else "tgs" if sticker.is_animated else "webp"
+            )
+
+        # Last, as animations come with a document too
+        case Message(document=document) if document:
+            file_id, file_size, mime_type = document.file_id, document.file_size, document.mime_type
+            file_name = document.file_name or document.file_unique_id
+
+        case _:
+            return None
+
+    return Media(
+        file_id=file_id,
+        file_name=file_name,
+        mime_type=mime_type or "application/octet-stream",
+        file_size=file_size,
+        message_url=message.get_url()
+    )
+
+
+async def get_media(bot: Bot, message: Message) -> Optional[Media]:
+    """
+    Like find_media, resolving where to download the file from
+    once for all the chats it's forwarded into.
+    Files that can't be resolved are left unresolved: they're linked to.
+    """
+
+    if not (media := find_media(message)):
+        return None
+
+    if media.file_size and media.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        return media
+
+    try:
+        file: File = await schedule_telegram_file(
+            message.chat.id,
+            lambda: bot.get_file(media.file_id)
+        )
+    except (TelegramAPIError, aiohttp.ClientError) as error:
+        print(f"Couldn't resolve {media.file_name}, linking to it instead: {error!r}")
+        return media
+
+    if not file.file_path:
+        return media
+
+    # Uploads need it, and not every message tells it
+    return media._replace(
+        file_url=_server.file_url(TELEGRAM_TOKEN, file.file_path),
+        file_size=file.file_size or media.file_size
+    )
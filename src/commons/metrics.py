@@ -0,0 +1,246 @@
+import threading
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Iterator, Optional
+from gvars import METRICS_HOST, METRICS_PORT
+
+Labels = tuple[str, ...]
+
+# Seconds, from a fast API call to a slow retry-after
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+# Seconds, for what runs in-process (conversions, SQLite statements)
+FAST_BUCKETS: tuple[float, ...] = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1
+)
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs: list[str] = [
+        f'{name}="{value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")}"'
+        for name, value in zip(names, values)
+    ]
+
+    if extra:
+        pairs.append(extra)
+
+    return f"{{{",".join(pairs)}}}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    type: str = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Labels = (),
+        collect: Optional[Callable[[], dict[Labels, float]]] = None
+    ) -> None:
+        """
+        collect, if given, is called on every scrape to get the values
+        (by label values) instead of them being recorded as they happen.
+        """
+
+        self.name: str = name
+        self.help: str = help
+        self.labels: Labels = labels
+        self.collect: Optional[Callable[[], dict[Labels, float]]] = collect
+        # Recorded from the database's threads too
+        self._lock: threading.Lock = threading.Lock()
+
+        _registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples()
+        ])
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, such as the messages forwarded.
+    """
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Labels = (),
+        collect: Optional[Callable[[], dict[Labels, float]]] = None
+    ) -> None:
+        super().__init__(name, help, labels, collect)
+        self._values: dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values: dict[Labels, float] = self.collect() if self.collect \
+            else dict(self._values)
+
+        return [
+            f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+            for labels, value in values.items()
+        ]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, such as a queue's depth.
+    """
+
+    type = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    """
+    How values (usually durations, in seconds) are distributed.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Labels = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets: tuple[float, ...] = buckets
+        # Per label values: the count of each bucket, the last one being +Inf
+        self._counts: dict[Labels, list[int]] = {}
+        self._sums: dict[Labels, float] = {}
+
+    def observe(self, *labels: str, value: float) -> None:
+        with self._lock:
+            if not (counts := self._counts.get(labels)):
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+
+            counts[bisect_left(self.buckets, value)] += 1
+            self._sums[labels] = self._sums.get(labels, 0) + value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """
+        Observe how long the with block takes (even if it raises).
+        """
+
+        start: float = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=perf_counter() - start)
+
+    def samples(self) -> list[str]:
+        lines: list[str] = []
+
+        with self._lock:
+            values: list[tuple[Labels, list[int], float]] = [
+                (labels, list(counts), self._sums[labels])
+                for labels, counts in self._counts.items()
+            ]
+
+        for labels, counts, total in values:
+            cumulative: int = 0
+
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                le: str = bound if isinstance(bound, str) else _format_value(bound)
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(self.labels, labels, f'le="{le}"')} {cumulative}"
+                )
+
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+
+        return lines
+
+
+_registry: list[_Metric] = []
+_runner: Optional[web.AppRunner] = None
+
+# Shared by both bots. Directions are "telegram_to_discord" and "discord_to_telegram".
+messages = Counter(
+    "bridge_messages_total",
+    "Messages and edits received, and forwarded or edited into each linked chat.",
+    ("direction", "event")
+)
+forwarding = Histogram(
+    "bridge_forwarding_seconds",
+    "Time to forward a message or an edit into all its linked chats.",
+    ("direction", "event")
+)
+conversion = Histogram(
+    "bridge_conversion_seconds",
+    "Time to convert a message's markdown and split it.",
+    ("direction",),
+    FAST_BUCKETS
+)
+
+
+def render() -> str:
+    """
+    All the metrics, in Prometheus' text format.
+    """
+
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+async def _handle(_: web.Request) -> web.Response:
+    return web.Response(
+        body=render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start() -> None:
+    """
+    Serve /metrics on METRICS_HOST:METRICS_PORT, if a port is set.
+    """
+    global _runner
+
+    if METRICS_PORT is None:
+        return
+
+    app: web.Application = web.Application()
+    app.router.add_get("/metrics", _handle)
+
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+
+    print(f"Metrics served on http://{METRICS_HOST}:{METRICS_PORT}/metrics.")
+
+
+async def stop() -> None:
+    global _runner
+
+    if _runner:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,356 @@
+import asyncio, contextvars, discord, heapq
+from aiogram.exceptions import TelegramRetryAfter
+from dataclasses import dataclass, field
+from enum import IntEnum
+from itertools import count
+from time import monotonic
+from typing import Any, Awaitable, Callable, Hashable, Optional, TypeVar
+from gvars import SCHEDULER_MAX_RETRIES
+from . import metrics, tracing
+from limits import (
+    DISCORD_CHANNEL_RATE,
+    DISCORD_GLOBAL_RATE,
+    DISCORD_WEBHOOK_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_GROUP_RATE
+)
+
+T = TypeVar("T")
+
+
+class Priority(IntEnum):
+    # Edits, deletes and command replies
+    INTERACTIVE = 0
+    # New messages
+    BULK = 1
+
+
+class TokenBucket:
+    """
+    Allows rate[0] calls every rate[1] seconds, all at once if needed.
+    """
+
+    def __init__(self, rate: tuple[int, float]) -> None:
+        self.capacity: float = rate[0]
+        self.refill: float = rate[0] / rate[1]
+        self.tokens: float = self.capacity
+        self.updated: float = monotonic()
+        self.blocked_until: float = 0
+
+    def delay(self) -> float:
+        """
+        Seconds to wait before a token is available.
+        """
+
+        now: float = monotonic()
+
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.refill
+        )
+        self.updated = now
+
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        return max(0, (1 - self.tokens) / self.refill)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """
+        Don't let anything through for the given seconds (e.g. on a retry-after).
+        """
+
+        self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+
+
+@dataclass(order=True)
+class _Job:
+    priority: Priority
+    sequence: int
+    # "telegram" or "discord"
+    platform: str = field(compare=False)
+    call: Callable[[], Awaitable[Any]] = field(compare=False)
+    # The first bucket is the destination's, which gets blocked on retry-afters
+    buckets: list[TokenBucket] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    # For traces: when it was queued and started, time spent
+    # waiting for rate limits and calls made (retries included)
+    queued: float = field(default_factory=monotonic, compare=False)
+    started: float = field(default=0, compare=False)
+    rate_limit_wait: float = field(default=0, compare=False)
+    attempts: int = field(default=0, compare=False)
+
+
+# Each destination (platform, chat id) has its own queue, drained by its own worker.
+# Files have their own ("telegram file", chat id) ones, not to wait behind the sends.
+_queues: dict[tuple[str, int], list[_Job]] = {}
+_workers: set[asyncio.Task] = set()
+_buckets: dict[Hashable, TokenBucket] = {}
+_sequence = count()
+
+_telegram_bucket: TokenBucket = TokenBucket(TELEGRAM_GLOBAL_RATE)
+_discord_bucket: TokenBucket = TokenBucket(DISCORD_GLOBAL_RATE)
+
+
+def _get_platform(key: tuple[str, int]) -> str:
+    return key[0].split(" ", 1)[0]
+
+
+def _get_queue_depths() -> dict[tuple[str, ...], float]:
+    depths: dict[tuple[str, ...], float] = {("telegram",): 0, ("discord",): 0}
+
+    for key, queue in _queues.items():
+        depths[(_get_platform(key),)] += len(queue)
+
+    return depths
+
+
+_queue_depth = metrics.Gauge(
+    "bridge_scheduler_queue_depth",
+    "API calls waiting for their turn.",
+    ("platform",),
+    _get_queue_depths
+)
+_api_calls = metrics.Histogram(
+    "bridge_api_call_seconds",
+    "Outbound API calls' duration, by outcome.",
+    ("platform", "outcome")
+)
+_rate_limit_waits = metrics.Histogram(
+    "bridge_rate_limit_wait_seconds",
+    "Time API calls waited for the rate limits (token buckets and retry-afters).",
+    ("platform",)
+)
+_retry_afters = metrics.Counter(
+    "bridge_retry_afters_total",
+    "API calls rejected for hitting a rate limit, then retried.",
+    ("platform",)
+)
+
+
+def share_global_limits(processes: int) -> None:
+    """
+    Split the bots' global limits evenly among the processes
+    calling the APIs with the same tokens (shard workers).
+    """
+    global _telegram_bucket, _discord_bucket
+
+    def share(rate: tuple[int, float]) -> tuple[int, float]:
+        # A share of the rate, in bursts as small as needed
+        calls: int = max(1, rate[0] // processes)
+
+        return calls, rate[1] * calls * processes / rate[0]
+
+    _telegram_bucket = TokenBucket(share(TELEGRAM_GLOBAL_RATE))
+    _discord_bucket = TokenBucket(share(DISCORD_GLOBAL_RATE))
+
+
+def _get_bucket(key: Hashable, rate: tuple[int, float]) -> TokenBucket:
+    if not (bucket := _buckets.get(key)):
+        bucket = _buckets[key] = TokenBucket(rate)
+
+    return bucket
+
+
+async def _acquire(buckets: list[TokenBucket]) -> float:
+    """
+    Wait for every bucket to have a token and take them.
+    Returns how long it waited.
+    """
+
+    waited: float = 0
+
+    # Tokens are only taken once every bucket has one available,
+    # so waiting on a bucket doesn't waste the others' tokens
+    while delay := max(bucket.delay() for bucket in buckets):
+        await asyncio.sleep(delay)
+        waited += delay
+
+    for bucket in buckets:
+        bucket.take()
+
+    return waited
+
+
+def _get_retry_after(error: Exception) -> Optional[float]:
+    match error:
+        case TelegramRetryAfter():
+            return error.retry_after
+
+        case discord.RateLimited():
+            return error.retry_after
+
+        case discord.HTTPException() if error.status == 429:
+            return float(error.response.headers.get("Retry-After", 1))
+
+    return None
+
+
+async def _run(job: _Job) -> Any:
+    job.started = monotonic()
+
+    for attempt in range(SCHEDULER_MAX_RETRIES + 1):
+        waited: float = await _acquire(job.buckets)
+        _rate_limit_waits.observe(job.platform, value=waited)
+        job.rate_limit_wait += waited
+        job.attempts += 1
+        start: float = monotonic()
+
+        try:
+            result: Any = await job.call()
+        except Exception as error:
+            retry_after: Optional[float] = _get_retry_after(error)
+            _api_calls.observe(
+                job.platform,
+                "error" if retry_after is None else "rate_limited",
+                value=monotonic() - start
+            )
+
+            if retry_after is None or attempt == SCHEDULER_MAX_RETRIES:
+                raise
+
+            _retry_afters.inc(job.platform)
+            job.buckets[0].block(retry_after)
+        else:
+            _api_calls.observe(job.platform, "ok", value=monotonic() - start)
+
+            return result
+
+
+async def _work(key: tuple[str, int]) -> None:
+    queue: list[_Job] = _queues[key]
+
+    try:
+        while queue:
+            job: _Job = heapq.heappop(queue)
+
+            # The caller isn't waiting anymore
+            if job.future.done():
+                continue
+
+            try:
+                result: Any = await _run(job)
+            except Exception as error:
+                if not job.future.done():
+                    job.future.set_exception(error)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+    finally:
+        # Jobs are only left here if the worker got cancelled
+        for job in queue:
+            job.future.cancel()
+
+        del _queues[key]
+
+
+async def _schedule(
+    key: tuple[str, int],
+    buckets: list[TokenBucket],
+    call: Callable[[], Awaitable[T]],
+    priority: Priority
+) -> T:
+    job: _Job = _Job(
+        priority=priority,
+        sequence=next(_sequence),
+        platform=_get_platform(key),
+        call=call,
+        buckets=buckets,
+        future=asyncio.get_running_loop().create_future()
+    )
+
+    if (queue := _queues.get(key)) is None:
+        queue = _queues[key] = []
+
+        # Keep a reference, or the worker could be garbage collected.
+        # It serves everyone, so it doesn't inherit the caller's trace.
+        worker: asyncio.Task = asyncio.create_task(
+            _work(key),
+            context=contextvars.Context()
+        )
+        _workers.add(worker)
+        worker.add_done_callback(_workers.discard)
+
+    heapq.heappush(queue, job)
+
+    # The call runs in the worker's task, so it's traced from here
+    with tracing.span(
+        f"{job.platform}.api",
+        chat_id=key[1],
+        priority=priority.name
+    ) as span:
+        try:
+            return await job.future
+        finally:
+            if span:
+                span.set(
+                    queued_ms=((job.started or monotonic()) - job.queued) * 1000,
+                    rate_limit_wait_ms=job.rate_limit_wait * 1000,
+                    attempts=job.attempts
+                )
+
+
+async def schedule_telegram(
+    chat_id: int,
+    call: Callable[[], Awaitable[T]],
+    priority: Priority = Priority.BULK
+) -> T:
+    """
+    Run a Telegram API call directed to the chat,
+    respecting both the chat's and the bot's limits.
+    """
+
+    buckets: list[TokenBucket] = [
+        _get_bucket(("telegram", chat_id), TELEGRAM_CHAT_RATE),
+        _telegram_bucket
+    ]
+
+    # Groups and channels have negative ids and a stricter limit
+    if chat_id < 0:
+        buckets.append(
+            _get_bucket(("telegram group", chat_id), TELEGRAM_GROUP_RATE)
+        )
+
+    return await _schedule(("telegram", chat_id), buckets, call, priority)
+
+
+async def schedule_discord(
+    channel_id: int,
+    call: Callable[[], Awaitable[T]],
+    priority: Priority = Priority.BULK,
+    *,
+    webhook: bool = False
+) -> T:
+    """
+    Run a Discord API call directed to the channel,
+    respecting the channel's (or its webhook's) and the bot's limits.
+    """
+
+    return await _schedule(
+        ("discord", channel_id),
+        [
+            _get_bucket(("discord webhook", channel_id), DISCORD_WEBHOOK_RATE)
+            if webhook
+            else _get_bucket(("discord", channel_id), DISCORD_CHANNEL_RATE),
+            _discord_bucket
+        ],
+        call,
+        priority
+    )
+
+
+async def schedule_telegram_file(
+    chat_id: int,
+    call: Callable[[], Awaitable[T]],
+    priority: Priority = Priority.BULK
+) -> T:
+    """
+    Run a Telegram API call about a file from the chat (getFile),
+    respecting the bot's limit only: the chat's are for sending.
+    """
+
+    return await _schedule(("telegram file", chat_id), [_telegram_bucket], call, priority)
@@ -1,5 +1,89 @@
 import asyncio
-from gvars import PENDING_TIMEOUT, PENDING_CHECKS_INTERVAL
+from dataclasses import dataclass, field
+from heapq import heappop, heappush
+from time import time
+from typing import Optional
+from gvars import PENDING_TIMEOUT
+
+
+@dataclass
+class PendingAssociation:
+    uuid: str
+    chat_name: str
+    creation_date_unix: int
+    discord_chat_id: Optional[int] = None
+    owner_discord_id: Optional[int] = None
+    telegram_chat_id: Optional[int] = None
+    owner_telegram_id: Optional[int] = None
+    # Set to whether the association was accepted or not
+    accepted: asyncio.Future[bool] = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future()
+    )
+
+
+_pending: dict[str, PendingAssociation] = {}
+# (expiration unix, UUID), the soonest to expire first
+_expirations: list[tuple[int, str]] = []
+
+
+def _expire() -> None:
+    """
+    Reject the associations which have been pending for too long.
+    """
+
+    now: float = time()
+
+    while _expirations and _expirations[0][0] <= now:
+        resolve_pending_association(heappop(_expirations)[1], False)
+
+
+def pend_association(
+    *,
+    uuid: str,
+    discord_chat_id: Optional[int] = None,
+    owner_discord_id: Optional[int] = None,
+    telegram_chat_id: Optional[int] = None,
+    owner_telegram_id: Optional[int] = None,
+    chat_name: str,
+    creation_date_unix: int
+) -> None:
+    """
+    Pend an association from either Discord's or Telegram's side.
+    A chat can only have one pending association: older ones are rejected.
+    """
+
+    _expire()
+
+    for pending in list(_pending.values()):
+        if (discord_chat_id and pending.discord_chat_id == discord_chat_id) \
+        or (telegram_chat_id and pending.telegram_chat_id == telegram_chat_id):
+            resolve_pending_association(pending.uuid, False)
+
+    _pending[uuid] = PendingAssociation(
+        uuid=uuid,
+        chat_name=chat_name,
+        creation_date_unix=creation_date_unix,
+        discord_chat_id=discord_chat_id,
+        owner_discord_id=owner_discord_id,
+        telegram_chat_id=telegram_chat_id,
+        owner_telegram_id=owner_telegram_id
+    )
+    heappush(_expirations, (creation_date_unix + PENDING_TIMEOUT, uuid))
+
+
+def get_pending_association(uuid: str) -> Optional[PendingAssociation]:
+    _expire()
+
+    return _pending.get(uuid)
+
+
+def resolve_pending_association(uuid: str, accepted: bool) -> None:
+    """
+    Stop pending the association, waking up whoever is waiting for it.
+    """
+
+    if (pending := _pending.pop(uuid, None)) and not pending.accepted.done():
+        pending.accepted.set_result(accepted)
 
 
 async def wait_association_acceptance(uuid: str) -> bool:
@@ -7,14 +91,16 @@ async def wait_association_acceptance(uuid: str) -> bool:
     Wait for the association with the same UUID to complete.
     Returns False if the association was not completed.
     """
-    from ..commons.database import database
-    
-    for _ in range((PENDING_TIMEOUT / PENDING_CHECKS_INTERVAL).__floor__()):
-        await asyncio.sleep(PENDING_CHECKS_INTERVAL)
-        if not database.is_association_pending(uuid):
-            return True
-    else:
-        from time import time
-        
-        database.delete_selected_pending_associations(unix=int(time()))
+
+    if not (pending := get_pending_association(uuid)):
+        return False
+
+    try:
+        # Shielded, so the timeout doesn't cancel the future
+        return await asyncio.wait_for(
+            asyncio.shield(pending.accepted),
+            timeout=pending.creation_date_unix + PENDING_TIMEOUT - time()
+        )
+    except TimeoutError:
+        resolve_pending_association(uuid, False)
         return False
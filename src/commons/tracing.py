@@ -0,0 +1,237 @@
+import aiohttp, asyncio, json, random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from os import urandom
+from time import perf_counter_ns, time_ns
+from typing import Any, Iterator, Optional
+from gvars import (
+    TRACE_EXPORT_INTERVAL,
+    TRACE_FILE,
+    TRACE_OTLP_ENDPOINT,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_THRESHOLD
+)
+
+SERVICE_NAME: str = "telegram-discord-forwarder"
+# If exporting falls behind, newer traces are dropped past this
+MAX_FINISHED_SPANS: int = 100_000
+
+
+@dataclass
+class _Trace:
+    trace_id: str
+    # Sampled traces are always exported, others only if slow
+    sampled: bool
+    spans: list["Span"] = field(default_factory=list)
+
+
+@dataclass
+class Span:
+    trace: _Trace
+    name: str
+    span_id: str
+    parent_id: Optional[str]
+    attributes: dict[str, Any]
+    start_unix_ns: int = field(default_factory=time_ns)
+    duration_ns: int = 0
+    error: Optional[str] = None
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+
+# The span being recorded in the current task.
+# Tasks copy it when created, so spans started in fan_out's
+# tasks are children of the message's one.
+_current: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+# Finished spans of traces to export
+_finished: list[Span] = []
+_enabled: bool = bool(
+    (TRACE_FILE or TRACE_OTLP_ENDPOINT)
+    and (TRACE_SAMPLE_RATE or TRACE_SLOW_THRESHOLD is not None)
+)
+
+
+@contextmanager
+def _record(span: Span) -> Iterator[Span]:
+    token = _current.set(span)
+    start: int = perf_counter_ns()
+
+    try:
+        yield span
+    except BaseException as error:
+        span.error = repr(error)
+        raise
+    finally:
+        span.duration_ns = perf_counter_ns() - start
+        _current.reset(token)
+        span.trace.spans.append(span)
+
+
+@contextmanager
+def trace(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Start a new trace (e.g. for an incoming message), whose root span
+    lasts as long as the with block.
+    Yields None if the trace isn't recorded.
+    """
+
+    if not _enabled:
+        yield None
+        return
+
+    sampled: bool = random.random() < TRACE_SAMPLE_RATE
+
+    # Without a slow threshold, unsampled traces aren't even recorded
+    if not sampled and TRACE_SLOW_THRESHOLD is None:
+        yield None
+        return
+
+    root: Span = Span(
+        trace=_Trace(urandom(16).hex(), sampled),
+        name=name,
+        span_id=urandom(8).hex(),
+        parent_id=None,
+        attributes=attributes
+    )
+
+    try:
+        with _record(root):
+            yield root
+    finally:
+        if (sampled or root.duration_ns >= TRACE_SLOW_THRESHOLD * 1e9) \
+        and len(_finished) < MAX_FINISHED_SPANS: # type: ignore
+            _finished.extend(root.trace.spans)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """
+    Time the with block as a child of the current span.
+    Yields None (and costs next to nothing) outside of recorded traces.
+    """
+
+    if not (parent := _current.get()):
+        yield None
+        return
+
+    with _record(Span(
+        trace=parent.trace,
+        name=name,
+        span_id=urandom(8).hex(),
+        parent_id=parent.span_id,
+        attributes=attributes
+    )) as child:
+        yield child
+
+
+def _to_json(span: Span) -> dict[str, Any]:
+    return {
+        "trace_id": span.trace.trace_id,
+        "span_id": span.span_id,
+        "parent_id": span.parent_id,
+        "name": span.name,
+        "start_unix_ns": span.start_unix_ns,
+        "duration_ms": span.duration_ns / 1e6,
+        "attributes": span.attributes,
+        "error": span.error
+    }
+
+
+def _to_otlp_value(value: Any) -> dict[str, Any]:
+    match value:
+        case bool():
+            return {"boolValue": value}
+        case int():
+            # 64 bits integers are strings in OTLP's JSON
+            return {"intValue": str(value)}
+        case float():
+            return {"doubleValue": value}
+
+    return {"stringValue": str(value)}
+
+
+def _to_otlp(spans: list[Span]) -> dict[str, Any]:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": SERVICE_NAME}}
+        ]},
+        "scopeSpans": [{
+            "scope": {"name": "bridge"},
+            "spans": [
+                {
+                    "traceId": span.trace.trace_id,
+                    "spanId": span.span_id,
+                    "parentSpanId": span.parent_id or "",
+                    "name": span.name,
+                    # Internal
+                    "kind": 1,
+                    "startTimeUnixNano": str(span.start_unix_ns),
+                    "endTimeUnixNano": str(span.start_unix_ns + span.duration_ns),
+                    "attributes": [
+                        {"key": key, "value": _to_otlp_value(value)}
+                        for key, value in span.attributes.items()
+                    ],
+                    "status": {"code": 2, "message": span.error}
+                    if span.error else {"code": 1}
+                }
+                for span in spans
+            ]
+        }]
+    }]}
+
+
+def _write_lines(spans: list[Span]) -> None:
+    with open(TRACE_FILE, "a", encoding="utf-8") as file: # type: ignore
+        file.writelines(
+            json.dumps(_to_json(span), default=str) + "\n" for span in spans
+        )
+
+
+async def _export(session: Optional[aiohttp.ClientSession]) -> None:
+    if not _finished:
+        return
+
+    spans: list[Span] = _finished.copy()
+    _finished.clear()
+
+    if TRACE_FILE:
+        await asyncio.to_thread(_write_lines, spans)
+
+    if session:
+        try:
+            async with session.post(
+                TRACE_OTLP_ENDPOINT, # type: ignore
+                json=_to_otlp(spans)
+            ) as response:
+                response.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            # Traces are best effort: drop them rather than piling them up
+            print(f"Couldn't export {len(spans)} spans: {error!r}")
+
+
+async def export_traces() -> None:
+    """
+    Export finished traces every TRACE_EXPORT_INTERVAL seconds,
+    to TRACE_FILE (as JSON lines) and/or TRACE_OTLP_ENDPOINT (as OTLP/HTTP JSON).
+    Runs until cancelled, exporting what's left before returning.
+    """
+
+    if not _enabled:
+        return
+
+    session: Optional[aiohttp.ClientSession] = aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=10)
+    ) if TRACE_OTLP_ENDPOINT else None
+
+    try:
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await _export(session)
+    finally:
+        try:
+            await _export(session)
+        finally:
+            if session:
+                await session.close()
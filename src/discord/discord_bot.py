@@ -1,19 +1,50 @@
-import discord, asyncio
+import discord, yarl
 from tokens import DISCORD_TOKEN
+from gvars import (
+    DISCORD_API_BASE,
+    DISCORD_AUTO_SHARDED,
+    DISCORD_GATEWAY,
+    DISCORD_PROFILE,
+    DISCORD_SHARD_COUNT
+)
 from limits import TELEGRAM_MESSAGE_LENGTH_LIMIT
-from discord.ext.commands import Bot, Context
-from typing import Optional
+from discord.ext.commands import AutoShardedBot, Bot, Context
+from typing import Any, Optional, Union
 from uuid import uuid4
-from ..commons import commons, signals
+from ..commons import metrics, signals, tracing
+from .. import shards
+from ..commons.fan_out import fan_out
+from ..commons.scheduler import Priority, schedule_discord, schedule_telegram
 from ..commons.database import database
 from ..telegram import telegram_bot
 from ..commons.methods.parse_discord_entities import get_entities_wrapped
 from ..commons.methods.discord.get_channel_name import get_channel_name
+from ..commons.methods.discord.client_profile import get_client_options
+from ..commons.methods.discord import manage_webhook, upload_media
 
-bot = Bot(
-    command_prefix="/",
-    intents=discord.Intents.all()
-)
+COMMAND_PREFIX: str = "/"
+
+# discord.py has no option for these, but reads them from here
+if DISCORD_API_BASE:
+    discord.http.Route.BASE = DISCORD_API_BASE
+
+if DISCORD_GATEWAY:
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(DISCORD_GATEWAY)
+
+bot: Union[Bot, AutoShardedBot]
+
+# Past 2500 servers, Discord requires splitting them among gateway connections
+if DISCORD_AUTO_SHARDED:
+    bot = AutoShardedBot(
+        command_prefix=COMMAND_PREFIX,
+        shard_count=DISCORD_SHARD_COUNT,
+        **get_client_options(DISCORD_PROFILE)
+    )
+else:
+    bot = Bot(
+        command_prefix=COMMAND_PREFIX,
+        **get_client_options(DISCORD_PROFILE)
+    )
 
 
 @bot.event
@@ -32,197 +63,385 @@ async def on_disconnect() -> None:
     print(f"Discord bot @{bot.user.name} shat down successfully.")
 
 
+@bot.event
+async def on_webhooks_update(channel: discord.abc.GuildChannel) -> None:
+    # Our webhook might have been edited or deleted
+    manage_webhook.invalidate_webhook(channel.id)
+
+
+@bot.event
+async def on_guild_channel_update(
+    before: discord.abc.GuildChannel,
+    after: discord.abc.GuildChannel
+) -> None:
+    # Renamed, moved, or its permissions changed
+    manage_webhook.invalidate_channel(after.id)
+
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel) -> None:
+    manage_webhook.invalidate_channel(channel.id)
+    manage_webhook.invalidate_webhook(channel.id)
+
+
+@bot.event
+async def on_thread_update(before: discord.Thread, after: discord.Thread) -> None:
+    # Archived, locked or renamed
+    manage_webhook.invalidate_channel(after.id)
+
+
+@bot.event
+async def on_thread_remove(thread: discord.Thread) -> None:
+    # We can't see it anymore
+    manage_webhook.invalidate_channel(thread.id)
+
+
+@bot.event
+async def on_raw_thread_delete(payload: discord.RawThreadDeleteEvent) -> None:
+    # Raw, as the thread might not be in discord.py's cache
+    manage_webhook.invalidate_channel(payload.thread_id)
+
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild) -> None:
+    # Kicked or banned, or the server was deleted
+    manage_webhook.invalidate_guild_channels(guild.id)
+
+
 @bot.command()
 async def associate(ctx: Context, *args: str) -> None:
     reply: Optional[discord.Message] = None
     
     if args:
-        chat_name: str = database.accept_pending(
-            uuid=args[0],
-            discord_chat_id=ctx.channel.id,
-            owner_discord_id=ctx.author.id
-        )
+        accepted_chat_name: Optional[str]
+        
+        try:
+            accepted_chat_name = await database.accept_pending(
+                uuid=args[0],
+                discord_chat_id=ctx.channel.id,
+                owner_discord_id=ctx.author.id
+            )
+        except database.AlreadyLinked:
+            await schedule_discord(
+                ctx.channel.id,
+                lambda: ctx.send(
+                    content="These chats are already linked.",
+                    reference=ctx.message
+                ),
+                Priority.INTERACTIVE
+            )
+            return
+        
+        if not accepted_chat_name:
+            await schedule_discord(
+                ctx.channel.id,
+                lambda: ctx.send(
+                    content="This association doesn't exist or has expired.",
+                    reference=ctx.message
+                ),
+                Priority.INTERACTIVE
+            )
+            return
+        
+        chat_name: str = accepted_chat_name
     else:
         uuid: str = str(uuid4())
         
-        database.pend_association(
+        signals.pend_association(
             uuid=uuid,
             discord_chat_id=ctx.channel.id,
             owner_discord_id=ctx.author.id,
-            chat_name=get_channel_name(ctx.channel),
+            chat_name=get_channel_name(ctx.channel, ctx.author),
             creation_date_unix=int(ctx.message.created_at.timestamp())
         )
         
-        reply = await ctx.send(f"Use this on Telegram: `/associate {uuid}`")
+        reply = await schedule_discord(
+            ctx.channel.id,
+            lambda: ctx.send(f"Use this on Telegram: `/associate {uuid}`"),
+            Priority.INTERACTIVE
+        )
         
         if not await signals.wait_association_acceptance(uuid):
             return
     
-        chat_name: str = asyncio.run_coroutine_threadsafe(
-            coro=telegram_bot.bot.get_chat(database.get_chat_ids(uuid)[1]),
-            loop=commons.telegram_loop
-        ).result().full_name
+        telegram_chat_id: int = (await database.get_chat_ids(uuid))[1]
+        chat_name: str = (await schedule_telegram(
+            telegram_chat_id,
+            lambda: telegram_bot.bot.get_chat(telegram_chat_id),
+            Priority.INTERACTIVE
+        )).full_name
     
-    await ctx.send(
-        content=f"Association with ***{chat_name}*** went smoothly!",
-        reference=reply or ctx.message
+    await schedule_discord(
+        ctx.channel.id,
+        lambda: ctx.send(
+            content=f"Association with ***{chat_name}*** went smoothly!",
+            reference=reply or ctx.message
+        ),
+        Priority.INTERACTIVE
     )
 
 
-@bot.event
-async def on_message(message: discord.Message) -> None:
-    # Process normal commands instead if the context is valid
-    if (await bot.get_context(message)).valid:
-        await bot.process_commands(message)
-        return
-    
-    # Ignore messages sent from bots
-    if message.author.bot:
-        return
-    
-    forward_to: set[int] = database.lookup_telegram_chats(message.channel.id)
-    
-    if not forward_to:
-        return
-    
+async def forward_message(
+    discord_chat_id: int,
+    discord_message_id: int,
+    author_name: Optional[str],
+    text: str,
+    forward_to: frozenset[int]
+) -> None:
+    """
+    Forward a message into the given linked Telegram chats.
+    """
     
-    wrapped_text, entities, link_preview_options = get_entities_wrapped(
-        suffix=f"{message.author.global_name}\n",
-        text=message.content
-    )
-
-    # Lookup all the chats the message has to be forwarded into
-    for chat_id in forward_to:
-        # Split text if it's too long.
-        for i, content in enumerate(wrapped_text, 0):
-            result = asyncio.run_coroutine_threadsafe(
-                coro=telegram_bot.bot.send_message(
-                    chat_id=chat_id,
-                    text=content,
-                    entities=entities[i],
-                    link_preview_options=link_preview_options
-                ),
-                loop=commons.telegram_loop
-            ).result()
-            
-            if not result:
-                continue
-            
-            # Register the message to the database
-            database.associate_messages(
-                discord_chat_id=message.channel.id,
-                discord_message_id=message.id,
-                telegram_chat_id=chat_id,
-                telegram_message_id=result.message_id,
-                forward_date_unix=int(result.date.timestamp()) # Date from Telegram
+    with tracing.trace(
+        "discord.message",
+        chat_id=discord_chat_id,
+        message_id=discord_message_id,
+        chats=len(forward_to)
+    ):
+        with metrics.conversion.time("discord_to_telegram"), tracing.span("convert"):
+            wrapped_text, entities, link_preview_options = get_entities_wrapped(
+                suffix=f"{author_name}\n",
+                text=text
             )
-    
-    # Now process normal commands
-    await bot.process_commands(message)
 
-
-@bot.event
-async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent) -> None:
-    message = payload.data
-    
-    # Ignore messages sent from bots
-    if message["author"].get("bot", False):
-        return
-
-    associations: dict[int, list[int]] = database.lookup_telegram_messages(
-        discord_chat_id=payload.channel_id,
-        discord_message_id=payload.message_id
-    )
-    
-    # If there were no associations, for some reason
-    if not associations:
-        return
-    
-    wrapped_text, entities, link_preview_options = get_entities_wrapped(
-        suffix=f"{message["author"].get("global_name")} (edited)\n",
-        text=message["content"]
-    )
-    messages_to_edit: int = len(wrapped_text)
-    
-    # Lookup all the chats the message has to be edited
-    for chat_id, message_ids in associations.items():
-        for i, message_id in enumerate(message_ids, 0):
-            # If the new message is shorter in messages length
-            if i >= messages_to_edit:
-                messages_to_delete: list[int] = message_ids[i:]
-                
-                asyncio.run_coroutine_threadsafe(
-                    coro=telegram_bot.bot.delete_messages(
+        async def forward(chat_id: int) -> None:
+            # Split text if it's too long.
+            for i, content in enumerate(wrapped_text, 0):
+                result = await schedule_telegram(
+                    chat_id,
+                    lambda: telegram_bot.bot.send_message(
                         chat_id=chat_id,
-                        message_ids=messages_to_delete
-                    ),
-                    loop=commons.telegram_loop
+                        text=content,
+                        entities=entities[i],
+                        link_preview_options=link_preview_options
+                    )
                 )
                 
-                database.delete_message_associations(
-                    discord_chat_id=payload.channel_id,
+                if not result:
+                    continue
+                
+                metrics.messages.inc("discord_to_telegram", "forwarded")
+                
+                # Register the message to the database
+                await database.associate_messages(
+                    discord_chat_id=discord_chat_id,
+                    discord_message_id=discord_message_id,
                     telegram_chat_id=chat_id,
-                    message_ids=messages_to_delete
+                    telegram_message_id=result.message_id,
+                    forward_date_unix=int(result.date.timestamp()) # Date from Telegram
                 )
+        
+        # Forward the message into all the linked chats at once
+        with metrics.forwarding.time("discord_to_telegram", "message"):
+            await fan_out("telegram", forward_to, forward)
+
+
+async def forward_edit(
+    discord_chat_id: int,
+    discord_message_id: int,
+    message: dict[str, Any],
+    telegram_chat_ids: Optional[frozenset[int]] = None
+) -> None:
+    """
+    Edit a message's forwards (message being the edit's raw data),
+    only in telegram_chat_ids if given.
+    """
+    
+    with tracing.trace(
+        "discord.edit",
+        chat_id=discord_chat_id,
+        message_id=discord_message_id
+    ) as root:
+        associations: dict[int, list[int]] = await database.lookup_telegram_messages(
+            discord_chat_id=discord_chat_id,
+            discord_message_id=discord_message_id
+        )
+        
+        # Other shards edit the others
+        if telegram_chat_ids is not None:
+            associations = {
+                chat_id: message_ids
+                for chat_id, message_ids in associations.items()
+                if chat_id in telegram_chat_ids
+            }
+        
+        # If there were no associations, for some reason
+        if not associations:
+            return
+        
+        if root:
+            root.set(chats=len(associations))
+        
+        metrics.messages.inc("discord_to_telegram", "edit_received")
+
+        with metrics.conversion.time("discord_to_telegram"), tracing.span("convert"):
+            wrapped_text, entities, link_preview_options = get_entities_wrapped(
+                suffix=f"{message["author"].get("global_name")} (edited)\n",
+                text=message["content"]
+            )
+        messages_to_edit: int = len(wrapped_text)
+        
+        async def edit(chat_id: int) -> None:
+            message_ids: list[int] = associations[chat_id]
+            
+            for i, message_id in enumerate(message_ids, 0):
+                # If the new message is shorter in messages length
+                if i >= messages_to_edit:
+                    messages_to_delete: list[int] = message_ids[i:]
+                    
+                    await schedule_telegram(
+                        chat_id,
+                        lambda: telegram_bot.bot.delete_messages(
+                            chat_id=chat_id,
+                            message_ids=messages_to_delete
+                        ),
+                        Priority.INTERACTIVE
+                    )
+                    
+                    await database.delete_message_associations(
+                        discord_chat_id=discord_chat_id,
+                        telegram_chat_id=chat_id,
+                        message_ids=messages_to_delete
+                    )
+                    
+                    return
                 
-                break
-            else:
-                asyncio.run_coroutine_threadsafe(
-                    coro=telegram_bot.bot.edit_message_text(
+                await schedule_telegram(
+                    chat_id,
+                    lambda: telegram_bot.bot.edit_message_text(
                         text=wrapped_text[i],
                         chat_id=chat_id,
                         message_id=message_id,
                         entities=entities[i],
                         link_preview_options=link_preview_options
                     ),
-                    loop=commons.telegram_loop
+                    Priority.INTERACTIVE
                 )
-        else:
-            if len(message_ids) >= len(wrapped_text):
-                break
+                metrics.messages.inc("discord_to_telegram", "edited")
             
             # If the edit message is longer than what Telegram can handle (unprobable)
             
             # Split text if it's too long.
-            for i, content in enumerate(wrapped_text[i:], i): # type: ignore
-                result = asyncio.run_coroutine_threadsafe(
-                    coro=telegram_bot.bot.send_message(
+            for i, content in enumerate(
+                wrapped_text[len(message_ids):],
+                len(message_ids)
+            ):
+                result = await schedule_telegram(
+                    chat_id,
+                    lambda: telegram_bot.bot.send_message(
                         chat_id=chat_id,
                         text=content,
                         entities=entities[i],
                         link_preview_options=link_preview_options,
-                        reply_to_message_id=message_id # type: ignore
+                        reply_to_message_id=message_ids[-1]
                     ),
-                    loop=commons.telegram_loop
-                ).result()
+                    Priority.INTERACTIVE
+                )
                 
                 if not result:
                     continue
                 
                 # Register the message to the database
-                database.associate_messages(
-                    discord_chat_id=payload.channel_id,
-                    discord_message_id=payload.message_id,
+                await database.associate_messages(
+                    discord_chat_id=discord_chat_id,
+                    discord_message_id=discord_message_id,
                     telegram_chat_id=chat_id,
                     telegram_message_id=result.message_id,
                     forward_date_unix=int(result.date.timestamp()) # Date from Telegram
-                )   
+                )
         
+        # Edit the message in all the chats it was forwarded into at once
+        with metrics.forwarding.time("discord_to_telegram", "edit"):
+            await fan_out("telegram", associations, edit, ordered=False)
+
+
+@bot.event
+async def on_message(message: discord.Message) -> None:
+    forward_to: frozenset[int] = database.lookup_telegram_chats(message.channel.id)
+
+    # Unlinked channels can only hold commands: skip
+    # building a context for anything else
+    if not forward_to:
+        if message.content.startswith(COMMAND_PREFIX):
+            await bot.process_commands(message)
+
+        return
+
+    # Process normal commands instead if the context is valid
+    if (await bot.get_context(message)).valid:
+        await bot.process_commands(message)
+        return
+
+    # Ignore messages sent from bots
+    if message.author.bot:
+        return
+    
+    metrics.messages.inc("discord_to_telegram", "received")
+
+    if shards.enabled():
+        shards.dispatch(
+            "discord_message",
+            {
+                "discord_chat_id": message.channel.id,
+                "discord_message_id": message.id,
+                "author_name": message.author.global_name,
+                "text": message.content
+            },
+            ((message.channel.id, chat_id) for chat_id in forward_to)
+        )
+    else:
+        await forward_message(
+            discord_chat_id=message.channel.id,
+            discord_message_id=message.id,
+            author_name=message.author.global_name,
+            text=message.content,
+            forward_to=forward_to
+        )
+    
+    # Now process normal commands
+    await bot.process_commands(message)
 
-async def _launch() -> None:
-    # Memorize the current loop
-    commons.discord_loop = asyncio.get_event_loop()
+
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent) -> None:
+    message = payload.data
     
+    # Ignore messages sent from bots
+    if message["author"].get("bot", False):
+        return
+
+    if shards.enabled():
+        # Only the shards owning a linked pair can have forwarded it
+        shards.dispatch(
+            "discord_edit",
+            {
+                "discord_chat_id": payload.channel_id,
+                "discord_message_id": payload.message_id,
+                "message": message
+            },
+            (
+                (payload.channel_id, chat_id)
+                for chat_id in database.lookup_telegram_chats(payload.channel_id)
+            )
+        )
+        return
+    
+    await forward_edit(payload.channel_id, payload.message_id, message)
+
+
+async def start() -> None:
     await bot.start(DISCORD_TOKEN)
 
 
-def close() -> None:
-    asyncio.run_coroutine_threadsafe(
-        coro=bot.close(),
-        loop=commons.discord_loop
-    )
+async def login() -> None:
+    """
+    Log in without connecting to the gateway,
+    for processes that only call the API (shard workers).
+    """
+    
+    await bot.login(DISCORD_TOKEN)
 
 
-def init() -> None:
-    global bot
-    commons.runner.run(_launch())
+async def close() -> None:
+    await bot.close()
+    await upload_media.close()
@@ -0,0 +1,305 @@
+import asyncio, multiprocessing, queue, signal, sys
+from multiprocessing.process import BaseProcess
+from multiprocessing.synchronize import Event
+from types import ModuleType
+from typing import Any, Iterable, Optional
+from zlib import crc32
+import gvars
+
+# (Discord chat id, Telegram chat id) of a linked pair
+Pair = tuple[int, int]
+# Kind (see _forward), payload and the worker's pairs it goes to
+Update = tuple[str, Any, list[Pair]]
+
+# Seconds between checks that the coordinator is still alive
+ORPHAN_CHECK_INTERVAL: float = 1
+
+# Each worker's process and the queue it gets its updates from
+_workers: list[tuple[BaseProcess, multiprocessing.Queue]] = []
+# Set by each worker once it can forward
+_ready: list[Event] = []
+
+
+def enabled() -> bool:
+    return bool(_workers)
+
+
+def shard_of(pair: Pair) -> int:
+    """
+    The worker owning a linked pair.
+    Unlike hash(), crc32 is the same in every process and run.
+    """
+
+    return crc32(f"{pair[0]}:{pair[1]}".encode()) % len(_workers)
+
+
+def dispatch(kind: str, payload: Any, pairs: Iterable[Pair]) -> None:
+    """
+    Hand an update to the workers owning its linked pairs,
+    each one only getting its own.
+    """
+
+    by_shard: dict[int, list[Pair]] = {}
+
+    for pair in pairs:
+        by_shard.setdefault(shard_of(pair), []).append(pair)
+
+    for shard, shard_pairs in by_shard.items():
+        process, updates = _workers[shard]
+
+        if not process.is_alive():
+            print(f"Shard {shard} exited ({process.exitcode}): dropping a {kind}.")
+            continue
+
+        updates.put((kind, payload, shard_pairs))
+
+
+def broadcast(kind: str, payload: Any) -> None:
+    """
+    Hand an update to every worker, such as a change they all need
+    to know about. It's queued in order with the forwards.
+    """
+
+    for process, updates in _workers:
+        if process.is_alive():
+            updates.put((kind, payload, []))
+
+
+def start() -> None:
+    """
+    Start SHARD_WORKERS worker processes, if set.
+    They get this process' settings and tokens, even if changed at runtime.
+    """
+
+    if not gvars.SHARD_WORKERS:
+        return
+
+    import tokens
+
+    settings: dict[str, Any] = {
+        name: value for name, value in vars(gvars).items() if name.isupper()
+    }
+    secrets: dict[str, str] = {
+        "TELEGRAM_TOKEN": tokens.TELEGRAM_TOKEN,
+        "DISCORD_TOKEN": tokens.DISCORD_TOKEN
+    }
+    # Forking would copy the loops and threads already running
+    context = multiprocessing.get_context("spawn")
+
+    for shard in range(gvars.SHARD_WORKERS):
+        updates: multiprocessing.Queue = context.Queue()
+        ready: Event = context.Event()
+        process: BaseProcess = context.Process(
+            target=_run_worker,
+            args=(shard, settings, secrets, updates, ready),
+            name=f"shard-{shard}",
+            daemon=True
+        )
+        process.start()
+        _workers.append((process, updates))
+        _ready.append(ready)
+
+    print(f"Started {len(_workers)} shard workers.")
+
+
+async def wait_until_ready() -> None:
+    """
+    Wait for every worker to be ready to forward, so updates are only
+    received once they can be: they'd queue up meanwhile otherwise.
+    Raises if a worker exited instead.
+    """
+
+    for shard, ((process, _), ready) in enumerate(zip(_workers, _ready)):
+        while not await asyncio.to_thread(ready.wait, ORPHAN_CHECK_INTERVAL):
+            if not process.is_alive():
+                raise RuntimeError(
+                    f"Shard {shard} exited ({process.exitcode}) before being ready."
+                )
+
+
+async def stop() -> None:
+    """
+    Let the workers forward what they got, then wait for them to exit.
+    """
+
+    for _, updates in _workers:
+        updates.put(None)
+
+    for process, updates in _workers:
+        await asyncio.to_thread(process.join)
+        updates.close()
+
+    _workers.clear()
+    _ready.clear()
+
+
+# Worker side: the bridge's modules are only imported
+# once the coordinator's settings are applied
+
+
+def _receive(updates: multiprocessing.Queue) -> tuple[list[Update], bool]:
+    """
+    Wait for the next updates, taking all the queued ones at once.
+    Also returns whether to stop after them: once told to,
+    or if the coordinator died.
+    """
+
+    batch: list[Update] = []
+
+    while True:
+        try:
+            update: Optional[Update] = updates.get_nowait() if batch \
+            else updates.get(timeout=ORPHAN_CHECK_INTERVAL)
+        except queue.Empty:
+            if batch:
+                return batch, False
+
+            if not (parent := multiprocessing.parent_process()) or not parent.is_alive():
+                return batch, True
+
+            continue
+
+        if update is None:
+            return batch, True
+
+        batch.append(update)
+
+
+async def _forward(kind: str, payload: Any, pairs: list[Pair]) -> None:
+    from aiogram.types import Message
+    from .commons.database import routing
+    from .discord import discord_bot
+    from .telegram import telegram_bot
+
+    match kind:
+        case "telegram_message" | "telegram_edit":
+            message: Message = Message.model_validate(
+                payload,
+                context={"bot": telegram_bot.bot}
+            )
+            discord_chat_ids: frozenset[int] = frozenset(pair[0] for pair in pairs)
+
+            if kind == "telegram_message":
+                await telegram_bot.forward_message(
+                    message,
+                    message.from_user, # type: ignore
+                    discord_chat_ids
+                )
+            else:
+                await telegram_bot.forward_edit(
+                    message,
+                    message.from_user, # type: ignore
+                    discord_chat_ids
+                )
+
+        case "telegram_album":
+            album: list[Message] = [
+                Message.model_validate(item, context={"bot": telegram_bot.bot})
+                for item in payload
+            ]
+
+            await telegram_bot.forward_album(
+                album,
+                album[0].from_user, # type: ignore
+                frozenset(pair[0] for pair in pairs)
+            )
+
+        case "discord_message":
+            await discord_bot.forward_message(
+                **payload,
+                forward_to=frozenset(pair[1] for pair in pairs)
+            )
+
+        case "discord_edit":
+            await discord_bot.forward_edit(
+                **payload,
+                telegram_chat_ids=frozenset(pair[1] for pair in pairs)
+            )
+
+        case "chats_linked":
+            routing.link(*payload)
+
+
+async def _work(shard: int, updates: multiprocessing.Queue, ready: Event) -> None:
+    from .commons import metrics, scheduler, tracing
+    from .discord import discord_bot
+    from .telegram import telegram_bot
+
+    # The bots' global limits are shared with the other workers
+    scheduler.share_global_limits(gvars.SHARD_WORKERS)
+
+    await metrics.start()
+    exporter: asyncio.Task = asyncio.create_task(tracing.export_traces())
+    # Only the API is needed: the coordinator receives the updates
+    await discord_bot.login()
+    ready.set()
+
+    forwarding: set[asyncio.Task] = set()
+
+    async def forward(update: Update) -> None:
+        try:
+            await _forward(*update)
+        except Exception as error:
+            print(f"Shard {shard} couldn't forward a {update[0]}: {error!r}")
+
+    stopped: bool = False
+
+    try:
+        while not stopped:
+            batch, stopped = await asyncio.to_thread(_receive, updates)
+
+            # In order, like polling does: the chats' locks keep them that way
+            for update in batch:
+                task: asyncio.Task = asyncio.create_task(forward(update))
+                forwarding.add(task)
+                task.add_done_callback(forwarding.discard)
+
+        await asyncio.gather(*forwarding)
+    finally:
+        exporter.cancel()
+
+        await discord_bot.close()
+        await telegram_bot.bot.session.close()
+        await metrics.stop()
+        await asyncio.gather(exporter, return_exceptions=True)
+
+
+def _run_worker(
+    shard: int,
+    settings: dict[str, Any],
+    secrets: dict[str, str],
+    updates: multiprocessing.Queue,
+    ready: Event
+) -> None:
+    # Ctrl+C reaches the whole process group: workers are stopped by
+    # the coordinator instead, once it stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Before the bridge's modules import them
+    for name, value in settings.items():
+        setattr(gvars, name, value)
+
+    tokens: ModuleType = ModuleType("tokens")
+    tokens.__dict__.update(secrets)
+    sys.modules["tokens"] = tokens
+
+    # Each worker serves its metrics on the following ports,
+    # and writes its own traces
+    if gvars.METRICS_PORT is not None:
+        gvars.METRICS_PORT += 1 + shard
+
+    if gvars.TRACE_FILE:
+        gvars.TRACE_FILE = f"{gvars.TRACE_FILE}.shard-{shard}"
+
+    from .commons import commons
+    from .commons.database import database
+
+    commons.init()
+    # The coordinator created, migrated (and sweeps) the database
+    database.init(coordinator=False)
+
+    try:
+        commons.runner.run(_work(shard, updates, ready))
+    finally:
+        commons.close()
+        database.close()
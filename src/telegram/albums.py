@@ -0,0 +1,104 @@
+import asyncio
+from aiogram.types import Message
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from gvars import ALBUM_WINDOW
+from limits import ALBUM_ITEMS_LIMIT
+
+# (chat id, media group id)
+AlbumKey = tuple[int, str]
+
+# Items received so far of the albums being collected, and
+# an event set whenever one more comes (restarting the window)
+_albums: dict[AlbumKey, tuple[list[Message], asyncio.Event]] = {}
+# The last album of each chat not forwarded yet, or the last message
+# queued behind one: set once it's forwarded, letting the next one go
+_tails: dict[int, asyncio.Future[None]] = {}
+
+
+def pending(chat_id: int) -> bool:
+    """
+    Whether messages of the chat have to be queued behind an album.
+    """
+
+    return chat_id in _tails
+
+
+def _enqueue(chat_id: int) -> tuple[Optional[asyncio.Future[None]], asyncio.Future[None]]:
+    previous: Optional[asyncio.Future[None]] = _tails.get(chat_id)
+    done: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+    _tails[chat_id] = done
+
+    return previous, done
+
+
+def _release(chat_id: int, done: asyncio.Future[None]) -> None:
+    done.set_result(None)
+
+    if _tails.get(chat_id) is done:
+        del _tails[chat_id]
+
+
+@asynccontextmanager
+async def queued(chat_id: int) -> AsyncIterator[None]:
+    """
+    Wait for the chat's pending albums (and the messages queued
+    behind them) to be forwarded, forwarding inside this.
+    """
+
+    previous, done = _enqueue(chat_id)
+
+    try:
+        if previous:
+            # Shielded, so a cancelled message doesn't cancel it for the others
+            await asyncio.shield(previous)
+
+        yield
+    finally:
+        _release(chat_id, done)
+
+
+@asynccontextmanager
+async def collect(message: Message) -> AsyncIterator[Optional[list[Message]]]:
+    """
+    Wait for the rest of the message's album, until no more items
+    came for ALBUM_WINDOW seconds or it's full.
+    Gives its items, in order, to the first item's caller only:
+    the others get None, as they're forwarded along with it.
+    The chat's later messages are queued behind it until it's
+    forwarded inside this, so they can't overtake it.
+    """
+
+    key: AlbumKey = (message.chat.id, message.media_group_id) # type: ignore
+
+    if album := _albums.get(key):
+        album[0].append(message)
+        album[1].set()
+        yield None
+        return
+
+    items: list[Message] = [message]
+    more: asyncio.Event = asyncio.Event()
+    _albums[key] = (items, more)
+    previous, done = _enqueue(message.chat.id)
+
+    try:
+        try:
+            while len(items) < ALBUM_ITEMS_LIMIT:
+                more.clear()
+
+                try:
+                    await asyncio.wait_for(more.wait(), ALBUM_WINDOW)
+                except TimeoutError:
+                    break
+        finally:
+            # Any later item starts an album of its own
+            del _albums[key]
+
+        if previous:
+            await asyncio.shield(previous)
+
+        # Updates can be handled out of order
+        yield sorted(items, key=lambda item: item.message_id)
+    finally:
+        _release(message.chat.id, done)
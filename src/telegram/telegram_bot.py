@@ -1,24 +1,38 @@
-import asyncio
+import asyncio, discord, signal
+from contextlib import suppress
 from uuid import uuid4
 from aiogram import Bot, Dispatcher
-from aiogram.types import Message
+from aiogram.types import Message, User
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import CommandObject
 from aiogram.filters.command import Command
 from tokens import TELEGRAM_TOKEN
+from gvars import TELEGRAM_API_SERVER, TELEGRAM_WEBHOOK_URL
 from limits import DISCORD_MESSAGE_LENGTH_LIMIT
-from typing import Optional
+from typing import Optional, Union
 from textwrap import wrap
-from ..commons import commons, signals
+from ..commons import metrics, signals, tracing
+from .. import shards
+from ..commons.fan_out import fan_out
+from ..commons.scheduler import Priority, schedule_telegram
 from ..commons.database import database
 from ..commons.methods.parse_telegram_entities import parse_markdown
 from ..commons.methods.discord.manage_webhook import edit_webhook_message, get_channel, delete_webhook_messages
 from ..commons.methods.discord.get_channel_name import get_channel_name
 from ..commons.methods.discord.forward_new_messages import forward_new_messages
+from ..commons.methods.telegram.get_media import Media, find_media, get_media
+from . import albums, webhook
 
 dp = Dispatcher()
+# Set to stop serving the webhook, when used instead of polling
+_stop_webhook: asyncio.Event = asyncio.Event()
 bot = Bot(
     token=TELEGRAM_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+    if TELEGRAM_API_SERVER
+    else None,
     default=DefaultBotProperties(
         parse_mode=None
     )
@@ -43,15 +57,39 @@ async def associate(message: Message, command: CommandObject) -> None:
     reply: Optional[Message] = None
     
     if command.args:
-        chat_name: str = database.accept_pending(
-            uuid=command.args,
-            telegram_chat_id=message.chat.id,
-            owner_telegram_id=message.from_user.id,
-        )
+        accepted_chat_name: Optional[str]
+        
+        try:
+            accepted_chat_name = await database.accept_pending(
+                uuid=command.args,
+                telegram_chat_id=message.chat.id,
+                owner_telegram_id=message.from_user.id,
+            )
+        except database.AlreadyLinked:
+            await schedule_telegram(
+                message.chat.id,
+                lambda: message.reply(
+                    text="These chats are already linked."
+                ),
+                Priority.INTERACTIVE
+            )
+            return
+        
+        if not accepted_chat_name:
+            await schedule_telegram(
+                message.chat.id,
+                lambda: message.reply(
+                    text="This association doesn't exist or has expired."
+                ),
+                Priority.INTERACTIVE
+            )
+            return
+        
+        chat_name: str = accepted_chat_name
     else:
         uuid: str = str(uuid4())
 
-        database.pend_association(
+        signals.pend_association(
             uuid=uuid,
             telegram_chat_id=message.chat.id,
             owner_telegram_id=message.from_user.id,
@@ -59,151 +97,346 @@ async def associate(message: Message, command: CommandObject) -> None:
             creation_date_unix=int(message.date.timestamp())
         )
         
-        reply = await message.answer(
-            text=f"Use this on Discord: <code>/associate {uuid}</code>",
-            parse_mode="HTML"
+        reply = await schedule_telegram(
+            message.chat.id,
+            lambda: message.answer(
+                text=f"Use this on Discord: <code>/associate {uuid}</code>",
+                parse_mode="HTML"
+            ),
+            Priority.INTERACTIVE
         )
         
         if not await signals.wait_association_acceptance(uuid):
             return
     
         try:
-            chat_name: str = get_channel_name(asyncio.run_coroutine_threadsafe(
-                coro=get_channel(database.get_chat_ids(uuid)[0]),
-                loop=commons.discord_loop
-            ).result())
+            chat_name: str = get_channel_name(
+                await get_channel((await database.get_chat_ids(uuid))[0])
+            )
         except:
             chat_name: str = "Pending Channel"
     
-    await message.answer(
-        text=f"Association with <b><i>{chat_name}</i></b> went smoothly!",
-        parse_mode="HTML",
-        reply_to_message_id=(reply or message).message_id
+    await schedule_telegram(
+        message.chat.id,
+        lambda: message.answer(
+            text=f"Association with <b><i>{chat_name}</i></b> went smoothly!",
+            parse_mode="HTML",
+            reply_to_message_id=(reply or message).message_id
+        ),
+        Priority.INTERACTIVE
     )
 
 
-@dp.message()
-async def on_message(message: Message) -> None:
-    if not message.text \
-    or not (from_user := message.from_user):
-        return
+async def _resolve_media(message: Message) -> Optional[Media]:
+    with tracing.span("get_media"):
+        return await get_media(bot, message)
 
-    forward_to: set[int] = database.lookup_discord_chats(message.chat.id)
-    
-    if not forward_to:
-        return
 
-    text: str = parse_markdown(
-        original_text=message.text,
-        entities=message.entities,
-        disable_link_preview=(
-            isinstance(message.link_preview_options.is_disabled, bool)
-            if message.link_preview_options
-            else False
-        )
-    )
+async def forward_message(message: Message, from_user: User, forward_to: frozenset[int]) -> None:
+    """
+    Forward a message into the given linked Discord chats.
+    """
     
-    # Lookup all the chats the message has to be forwarded into
-    for chat_id in forward_to:
-        asyncio.run_coroutine_threadsafe(
-            coro=forward_new_messages(
+    with tracing.trace(
+        "telegram.message",
+        chat_id=message.chat.id,
+        message_id=message.message_id,
+        chats=len(forward_to)
+    ):
+        with metrics.conversion.time("telegram_to_discord"), tracing.span("convert"):
+            # Media comes with a caption instead
+            text: str = parse_markdown(
+                original_text=message.text or message.caption or "",
+                entities=message.entities or message.caption_entities,
+                disable_link_preview=(
+                    isinstance(message.link_preview_options.is_disabled, bool)
+                    if message.link_preview_options
+                    else False
+                )
+            )
+        
+        # Resolved once for all the chats, but waited for in each chat's
+        # turn: messages sent right after can't overtake this one meanwhile
+        resolving: asyncio.Task[Optional[Media]] = \
+            asyncio.ensure_future(_resolve_media(message))
+        
+        async def forward(chat_id: int) -> None:
+            media: Optional[Media] = await asyncio.shield(resolving)
+            
+            await forward_new_messages(
                 text=text,
                 from_user=from_user,
                 discord_chat_id=chat_id,
                 telegram_chat_id=message.chat.id,
-                telegram_message_id=message.message_id
-            ),
-            loop=commons.discord_loop
-        )
+                telegram_message_id=message.message_id,
+                media=[media] if media else []
+            )
+        
+        # Forward the message into all the linked chats at once
+        with metrics.forwarding.time("telegram_to_discord", "message"):
+            await fan_out("discord", forward_to, forward)
 
 
-@dp.edited_message()
-async def on_message_edit(edited_message: Message) -> None:
-    if not edited_message.text \
-    or not (from_user := edited_message.from_user):
-        return
+async def forward_album(album: list[Message], from_user: User, forward_to: frozenset[int]) -> None:
+    """
+    Forward an album's items into the given linked Discord chats, as a single message.
+    """
     
-    associations: dict[int, list[int]] = database.lookup_discord_messages(
-        telegram_chat_id=edited_message.chat.id,
-        telegram_message_id=edited_message.message_id
-    )
+    first: Message = album[0]
     
-    # If there were no associations, for some reason
-    if not associations:
-        return
-    
-    wrapped_text: list[str] = wrap(
-        text=parse_markdown(
-            original_text=edited_message.text,
-            entities=edited_message.entities,
-            disable_link_preview=(
-                isinstance(edited_message.link_preview_options.is_disabled, bool)
-                if edited_message.link_preview_options
-                else False
+    with tracing.trace(
+        "telegram.album",
+        chat_id=first.chat.id,
+        message_id=first.message_id,
+        items=len(album),
+        chats=len(forward_to)
+    ):
+        with metrics.conversion.time("telegram_to_discord"), tracing.span("convert"):
+            # Usually, only the first item has a caption
+            text: str = "\n".join(
+                parse_markdown(
+                    original_text=item.caption, # type: ignore
+                    entities=item.caption_entities
+                )
+                for item in album
+                if item.caption
             )
-        ),
-        width=DISCORD_MESSAGE_LENGTH_LIMIT,
-        break_long_words=False,
-        replace_whitespace=False
-    )
-    messages_to_edit: int = len(wrapped_text)
+        
+        # Like forward_message, in each chat's turn
+        resolving: asyncio.Future[list[Optional[Media]]] = \
+            asyncio.gather(*(_resolve_media(item) for item in album))
+        
+        async def forward(chat_id: int) -> None:
+            media: list[Optional[Media]] = await asyncio.shield(resolving)
+            
+            await forward_new_messages(
+                text=text,
+                from_user=from_user,
+                discord_chat_id=chat_id,
+                telegram_chat_id=first.chat.id,
+                telegram_message_id=first.message_id,
+                media=[item for item in media if item],
+                album_message_ids=[item.message_id for item in album[1:]]
+            )
+        
+        # Forward the album into all the linked chats at once
+        with metrics.forwarding.time("telegram_to_discord", "message"):
+            await fan_out("discord", forward_to, forward)
+
+
+async def forward_edit(
+    edited_message: Message,
+    from_user: User,
+    discord_chat_ids: Optional[frozenset[int]] = None
+) -> None:
+    """
+    Edit a message's forwards, only in discord_chat_ids if given.
+    """
     
-    for chat_id, message_ids in associations.items():
-        for i, message_id in enumerate(message_ids, 0):
-            # If the new message is shorter in messages length
-            if i >= messages_to_edit:
-                messages_to_delete: list[int] = message_ids[i:]
-                
-                asyncio.run_coroutine_threadsafe(
-                    coro=delete_webhook_messages(chat_id, messages_to_delete),
-                    loop=commons.discord_loop
-                )
+    with tracing.trace(
+        "telegram.edit",
+        chat_id=edited_message.chat.id,
+        message_id=edited_message.message_id
+    ) as root:
+        associations: dict[int, list[int]] = await database.lookup_discord_messages(
+            telegram_chat_id=edited_message.chat.id,
+            telegram_message_id=edited_message.message_id
+        )
+        
+        # Other shards edit the others
+        if discord_chat_ids is not None:
+            associations = {
+                chat_id: message_ids
+                for chat_id, message_ids in associations.items()
+                if chat_id in discord_chat_ids
+            }
+        
+        # If there were no associations, for some reason
+        if not associations:
+            return
+        
+        if root:
+            root.set(chats=len(associations))
+        
+        metrics.messages.inc("telegram_to_discord", "edit_received")
+
+        with metrics.conversion.time("telegram_to_discord"), tracing.span("convert"):
+            wrapped_text: list[str] = wrap(
+                text=parse_markdown(
+                    original_text=edited_message.text or edited_message.caption or "",
+                    entities=edited_message.entities or edited_message.caption_entities,
+                    disable_link_preview=(
+                        isinstance(edited_message.link_preview_options.is_disabled, bool)
+                        if edited_message.link_preview_options
+                        else False
+                    )
+                ),
+                width=DISCORD_MESSAGE_LENGTH_LIMIT,
+                break_long_words=False,
+                replace_whitespace=False
+            ) or [""] # A file's message stays, even without a caption
+        messages_to_edit: int = len(wrapped_text)
+        
+        async def edit(chat_id: int) -> None:
+            message_ids: list[int] = associations[chat_id]
+            result: Optional[Union[discord.Message, discord.WebhookMessage]] = None
+            
+            for i, message_id in enumerate(message_ids, 0):
+                # If the new message is shorter in messages length
+                if i >= messages_to_edit:
+                    messages_to_delete: list[int] = message_ids[i:]
+                    
+                    await delete_webhook_messages(chat_id, messages_to_delete)
+                    
+                    await database.delete_message_associations(
+                        discord_chat_id=chat_id,
+                        telegram_chat_id=edited_message.chat.id,
+                        message_ids=messages_to_delete
+                    )
+                    
+                    return
                 
-                database.delete_message_associations(
-                    discord_chat_id=chat_id,
-                    telegram_chat_id=edited_message.chat.id,
-                    message_ids=messages_to_delete
+                result = await edit_webhook_message(
+                    telegram_user=from_user,
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    text=wrapped_text[i],
+                    first_call=i == 0
                 )
-                
-                break
-            else:
-                result = asyncio.run_coroutine_threadsafe(
-                    coro=edit_webhook_message(
-                        telegram_user=from_user,
-                        chat_id=chat_id,
-                        message_id=message_id,
-                        text=wrapped_text[i],
-                        first_call=i == 0
-                    ),
-                    loop=commons.discord_loop
-                ).result()
-        else:
+                metrics.messages.inc("telegram_to_discord", "edited")
+            
             if len(message_ids) >= len(wrapped_text):
-                break
+                return
             
             # If the edit message is longer than what Discord can handle (probable)
+            
+            await forward_new_messages(
+                text="".join(wrapped_text[len(message_ids):]),
+                from_user=from_user,
+                discord_chat_id=chat_id,
+                telegram_chat_id=edited_message.chat.id,
+                telegram_message_id=edited_message.message_id,
+                reference=result,
+                priority=Priority.INTERACTIVE
+            )
+        
+        # Edit the message in all the chats it was forwarded into at once
+        with metrics.forwarding.time("telegram_to_discord", "edit"):
+            await fan_out("discord", associations, edit, ordered=False)
 
-            asyncio.run_coroutine_threadsafe(
-                coro=forward_new_messages(
-                    text="".join(wrapped_text[i:]), # type: ignore
-                    from_user=from_user,
-                    discord_chat_id=chat_id,
-                    telegram_chat_id=edited_message.chat.id,
-                    telegram_message_id=edited_message.message_id,
-                    reference=result # type: ignore
-                ),
-                loop=commons.discord_loop
+
+@dp.message()
+async def on_message(message: Message) -> None:
+    if not (message.text or find_media(message)) \
+    or not (from_user := message.from_user):
+        return
+
+    forward_to: frozenset[int] = database.lookup_discord_chats(message.chat.id)
+    
+    if not forward_to:
+        return
+
+    metrics.messages.inc("telegram_to_discord", "received")
+    
+    if message.media_group_id:
+        await on_album_item(message, from_user, forward_to)
+        return
+    
+    # Albums are only forwarded once complete: wait for them,
+    # or this would overtake them
+    if albums.pending(message.chat.id):
+        async with albums.queued(message.chat.id):
+            await on_single_message(message, from_user, forward_to)
+        return
+    
+    await on_single_message(message, from_user, forward_to)
+
+
+async def on_single_message(message: Message, from_user: User, forward_to: frozenset[int]) -> None:
+    if shards.enabled():
+        shards.dispatch(
+            "telegram_message",
+            message.model_dump(mode="json", by_alias=True, exclude_none=True),
+            ((chat_id, message.chat.id) for chat_id in forward_to)
+        )
+        return
+    
+    await forward_message(message, from_user, forward_to)
+
+
+async def on_album_item(message: Message, from_user: User, forward_to: frozenset[int]) -> None:
+    async with albums.collect(message) as album:
+        # The first item's handler forwards them all
+        if not album:
+            return
+        
+        if shards.enabled():
+            shards.dispatch(
+                "telegram_album",
+                [item.model_dump(mode="json", by_alias=True, exclude_none=True) for item in album],
+                ((chat_id, message.chat.id) for chat_id in forward_to)
+            )
+            return
+        
+        await forward_album(album, from_user, forward_to)
+
+
+@dp.edited_message()
+async def on_message_edit(edited_message: Message) -> None:
+    # Only the caption of media can be edited from here
+    if not (edited_message.text or find_media(edited_message)) \
+    or not (from_user := edited_message.from_user):
+        return
+    
+    if shards.enabled():
+        # Only the shards owning a linked pair can have forwarded it
+        shards.dispatch(
+            "telegram_edit",
+            edited_message.model_dump(mode="json", by_alias=True, exclude_none=True),
+            (
+                (chat_id, edited_message.chat.id)
+                for chat_id in database.lookup_discord_chats(edited_message.chat.id)
             )
+        )
+        return
+    
+    await forward_edit(edited_message, from_user)
 
 
-async def _launch() -> None:
-    # Memorize the current loop
-    commons.telegram_loop = asyncio.get_event_loop()
+async def start() -> None:
+    """
+    Poll, or serve the webhook if TELEGRAM_WEBHOOK_URL is set,
+    until a SIGINT or SIGTERM is received or stop() is called.
+    """
     
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if not TELEGRAM_WEBHOOK_URL:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(
+            bot,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        return
+    
+    # Like aiogram does for polling
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    
+    # Not supported on Windows
+    with suppress(NotImplementedError):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, _stop_webhook.set)
+    
+    _stop_webhook.clear()
+    
+    try:
+        await webhook.serve(dp, bot, _stop_webhook)
+    finally:
+        with suppress(NotImplementedError):
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
 
 
-def init() -> None:
-    global dp, bot
-    commons.runner.run(_launch())
+async def stop() -> None:
+    if TELEGRAM_WEBHOOK_URL:
+        _stop_webhook.set()
+    else:
+        await dp.stop_polling()
@@ -0,0 +1,75 @@
+import asyncio, secrets, yarl
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from typing import Any
+from gvars import (
+    TELEGRAM_WEBHOOK_CONCURRENCY,
+    TELEGRAM_WEBHOOK_HOST,
+    TELEGRAM_WEBHOOK_PORT,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_WEBHOOK_URL
+)
+
+# Telegram doesn't allow more
+MAX_CONNECTIONS: int = 100
+
+
+class _BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Answers Telegram right away and handles the update in the background,
+    but only TELEGRAM_WEBHOOK_CONCURRENCY at a time: past that, requests
+    wait for a slot, so Telegram slows down instead of updates piling up.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str) -> None:
+        super().__init__(dispatcher, bot, secret_token=secret_token)
+        self._slots: asyncio.Semaphore = asyncio.Semaphore(TELEGRAM_WEBHOOK_CONCURRENCY)
+
+    async def _background_feed_update(self, bot: Bot, update: dict[str, Any]) -> None:
+        try:
+            await super()._background_feed_update(bot, update)
+        finally:
+            self._slots.release()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+
+        try:
+            return await super()._handle_request_background(bot, request)
+        except:
+            # The update won't be handled, so it won't release its slot
+            self._slots.release()
+            raise
+
+
+async def serve(dispatcher: Dispatcher, bot: Bot, stop: asyncio.Event) -> None:
+    """
+    Set the webhook and serve it until stop is set.
+    Only the updates the dispatcher handles are delivered.
+    """
+
+    secret_token: str = TELEGRAM_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    app: web.Application = web.Application()
+    _BoundedRequestHandler(dispatcher, bot, secret_token).register(
+        app,
+        path=yarl.URL(TELEGRAM_WEBHOOK_URL).path or "/"
+    )
+    # Runs the dispatcher's startup and shutdown handlers like polling does
+    setup_application(app, dispatcher, bot=bot)
+
+    runner: web.AppRunner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, TELEGRAM_WEBHOOK_HOST, TELEGRAM_WEBHOOK_PORT).start()
+        await bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL, # type: ignore
+            secret_token=secret_token,
+            allowed_updates=dispatcher.resolve_used_update_types(),
+            max_connections=min(TELEGRAM_WEBHOOK_CONCURRENCY, MAX_CONNECTIONS)
+        )
+
+        await stop.wait()
+    finally:
+        await runner.cleanup()